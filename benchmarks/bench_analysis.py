@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""Time the analysis functions on millions of events: coincidences between
+two detectors, clusters across three, sliding rates and the barometric fit.
+Needs numpy.
+
+Usage: bench_analysis.py [events per detector]
+"""
+
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from analysis import barometric_coefficient, coincidence_clusters, coincidences, inter_arrival, sliding_rates, \
+    window_means
+
+
+def timed(name, fn, *args):
+    start = time.time()
+    result = fn(*args)
+    print("%-24s %.3fs" % (name + ':', time.time() - start))
+    return result
+
+
+def main(n):
+    random = numpy.random.RandomState(0)
+    duration = n / 10.0  # 10 events/s per detector
+
+    shared = numpy.sort(random.uniform(0, duration, n // 100))
+    detectors = [numpy.sort(numpy.concatenate((random.uniform(0, duration, n - len(shared)),
+                                               shared + random.normal(0, 1e-5, len(shared)))))
+                 for _ in range(3)]
+    pressures = 1013 + 10 * numpy.sin(detectors[0] / 86400.0)
+
+    ia, ib = timed("coincidences (2)", coincidences, detectors[0], detectors[1], 1e-4)
+    print("  %d pairs, %d expected from shared showers" % (len(ia), len(shared)))
+    clusters = timed("clusters (3)", coincidence_clusters, detectors, 1e-4)
+    print("  %d clusters" % len(clusters[0]))
+    edges, rates = timed("sliding rates", sliding_rates, detectors[0], 600, 60)
+    means = timed("window pressures", window_means, detectors[0], pressures, edges, 600)
+    timed("barometric fit", barometric_coefficient, rates, means)
+    timed("inter-arrival", inter_arrival, detectors[0])
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000000)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Compare the JSON event log with the columnar archive: bytes per event,
+write throughput, and the time to load one column for analysis. Loading the
+archive needs numpy.
+
+Usage: bench_archive.py [number of events]
+"""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from archive import ArchiveWriter, load
+from event import Event
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": 21.3, "humidity": 45.0}
+        self.barometer     = {"temperature": 21.5, "pressure": 1013.2, "altitude": 120.0}
+        self.vibration     = {"direction": 0, "count": 0}
+        self.magnetometer  = {"x": 0.1, "y": 0.2, "z": 0.3}
+        self.accelerometer = {"x": 0.0, "y": 0.0, "z": 1.0}
+        self.location      = {"latitude": 46.2, "longitude": 6.1, "altitude": 430.0}
+        self.timing        = {"uptime": 1234, "counter_frequency": 42000000, "time_string": "12:00:00"}
+        self.status        = {"queue_size": 0, "missed_events": 0, "buffer_error": 0, "temp_status": 1,
+                              "baro_status": 1, "accel_status": 1, "mag_status": 1, "gps_status": 1}
+
+
+def write_log(path, events):
+    with open(path, 'w') as f:
+        for event in events:
+            f.write("%s %s\n" % (time.strftime('%Y-%m-%d %H:%M:%S,000'), event.to_json()))
+
+
+def read_log(path):
+    with open(path, 'r') as f:
+        return [json.loads(line[line.index('{'):])['barometer']['pressure'] for line in f]
+
+
+def write_archive(directory, events):
+    writer = ArchiveWriter(directory)
+    for event in events:
+        writer.append_event(event)
+    writer.close()
+
+
+def main(n):
+    sensors = Sensors()
+    events = [Event("b8:27:eb:00:00:00", i, sensors, 'cosmic') for i in range(n)]
+    directory = tempfile.mkdtemp(prefix='cosmicpi-archive-')
+    log_path = os.path.join(directory, 'cosmicpi.log')
+    archive_dir = os.path.join(directory, 'archive')
+
+    try:
+        start = time.time()
+        write_log(log_path, events)
+        log_write = time.time() - start
+
+        for event in events:
+            event.serialized = None
+
+        start = time.time()
+        write_archive(archive_dir, events)
+        archive_write = time.time() - start
+
+        archive_size = sum(os.path.getsize(os.path.join(archive_dir, name)) for name in os.listdir(archive_dir))
+        print("JSON log: %6.0f bytes/event  write %8.0f events/s" % (os.path.getsize(log_path) / float(n),
+                                                                     n / log_write))
+        print("Archive:  %6.0f bytes/event  write %8.0f events/s" % (archive_size / float(n), n / archive_write))
+
+        start = time.time()
+        read_log(log_path)
+        print("Load barometer.pressure from the JSON log: %.3fs" % (time.time() - start))
+
+        start = time.time()
+        load(archive_dir, names=['barometer.pressure'])
+        print("Load barometer.pressure from the archive:  %.3fs" % (time.time() - start))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
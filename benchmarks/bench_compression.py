@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""Compare the compression of batches of events: ratio and CPU time per event
+for each encoding and level, with and without the shared dictionary, for
+several batch sizes. Run it on the detector's own hardware to pick a level,
+LZ4 needs the lz4 package.
+
+Usage: bench_compression.py [number of events]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+import envelope
+from envelope import DEFLATE, LZ4, Compressor, decode
+from event import Event
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": 21.3, "humidity": 45.0}
+        self.barometer     = {"temperature": 21.5, "pressure": 1013.2, "altitude": 120.0}
+        self.vibration     = {"direction": 0, "count": 0}
+        self.magnetometer  = {"x": 0.1, "y": 0.2, "z": 0.3}
+        self.accelerometer = {"x": 0.0, "y": 0.0, "z": 1.0}
+        self.location      = {"latitude": 46.2, "longitude": 6.1, "altitude": 430.0}
+        self.timing        = {"uptime": 1234, "counter_frequency": 42000000, "time_string": "12:00:00"}
+        self.status        = {"queue_size": 0, "missed_events": 0, "buffer_error": 0, "temp_status": 1,
+                              "baro_status": 1, "accel_status": 1, "mag_status": 1, "gps_status": 1}
+        self.event         = None
+
+
+def messages(n):
+    """Event messages as the publisher queues them, JSON-encoded twice."""
+    random.seed(0)
+    sensors = Sensors()
+    start = time.time()
+    result = []
+    for i in range(n):
+        sensors.timing = {"uptime": 1234 + i, "counter_frequency": 42000000 + random.randint(-3, 3),
+                          "time_string": time.strftime('%H:%M:%S', time.gmtime(start + i))}
+        sensors.barometer = {"temperature": round(21.5 + random.gauss(0, 0.05), 2),
+                             "pressure": round(1013.2 + random.gauss(0, 0.05), 2), "altitude": 120.0}
+        sensors.event = {"evt": i, "ticks": random.randint(0, 41999999)}
+        event = Event("b8:27:eb:00:00:00", i, sensors, 'cosmic', start + i + random.random())
+        result.append(json.dumps(event.to_json()))
+    return result
+
+
+def run(events, encoding, level, dictionary, batch):
+    compressor = Compressor(encoding, level, dictionary)
+    batches = [events[i:i + batch] for i in range(0, len(events), batch)]
+
+    start = time.time()
+    envelopes = [compressor.compress(messages) for messages in batches]
+    compress = time.time() - start
+
+    start = time.time()
+    for body, headers in envelopes:
+        decode(body, encoding, headers)
+    decompress = time.time() - start
+
+    body, headers = envelopes[0]
+    assert decode(body, encoding, headers) == batches[0]
+    print("%-7s %2d %-4s %5d  %6.2f  %6.1f  %6.1f" % (
+        encoding, level, 'yes' if compressor.dictionary is not None else 'no', batch, compressor.ratio(),
+        1e6 * compress / len(events), 1e6 * decompress / len(events)))
+
+
+def main(n):
+    events = messages(n)
+    print("%d events, %.0f bytes each" % (n, sum(len(event) for event in events) / float(n)))
+    print("encoding  level dict batch  ratio  us/event compress, decompress")
+    encodings = [(DEFLATE, level) for level in (1, 6, 9)]
+    if envelope.lz4 is not None:
+        encodings += [(LZ4, 0), (LZ4, 9)]
+    for batch in (1, 10, 100):
+        for encoding, level in encodings:
+            for dictionary in (False, True):
+                run(events, encoding, level, dictionary, batch)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
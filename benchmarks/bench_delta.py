@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Measure the bytes published with delta encoding against full events, on a
+simulated stream of cosmic, vibration and weather events with noisy sensors,
+and check that the decoder rebuilds every event.
+
+Usage: bench_delta.py [number of events]
+"""
+
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from delta_encoding import DeltaDecoder, DeltaEncoder
+from event import Event
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": 21.3, "humidity": 45.0}
+        self.barometer     = {"temperature": 21.5, "pressure": 1013.2, "altitude": 120.0}
+        self.vibration     = {"direction": 0, "count": 0}
+        self.magnetometer  = {"x": 0.1, "y": 0.2, "z": 0.3}
+        self.accelerometer = {"x": 0.0, "y": 0.0, "z": 1.0}
+        self.location      = {"latitude": 46.2, "longitude": 6.1, "altitude": 430.0}
+        self.timing        = {"uptime": 1234, "counter_frequency": 42000000, "time_string": "12:00:00"}
+        self.status        = {"queue_size": 0, "missed_events": 0, "buffer_error": 0, "temp_status": 1,
+                              "baro_status": 1, "accel_status": 1, "mag_status": 1, "gps_status": 1}
+        self.event         = None
+
+
+def stream(n):
+    """Yield (time, kind, sensors) for one cosmic event a second, with a
+    weather update every 5 seconds and a vibration now and then."""
+    random.seed(0)
+    sensors = Sensors()
+    start = time.time()
+    for i in range(n):
+        now = start + i
+        sensors.timing = {"uptime": 1234 + i, "counter_frequency": 42000000 + random.randint(-3, 3),
+                          "time_string": time.strftime('%H:%M:%S', time.gmtime(now))}
+        if i % 5 == 0:
+            sensors.temperature = {"temperature": round(21.3 + random.gauss(0, 0.05), 2),
+                                   "humidity": round(45.0 + random.gauss(0, 0.2), 1)}
+            sensors.barometer = {"temperature": round(21.5 + random.gauss(0, 0.05), 2),
+                                 "pressure": round(1013.2 + random.gauss(0, 0.05), 2), "altitude": 120.0}
+            yield now, 'weather', sensors
+        if i % 97 == 0:
+            sensors.vibration = {"direction": random.randint(0, 3), "count": i}
+            yield now, 'vibration', sensors
+        sensors.event = {"evt": i, "ticks": random.randint(0, 41999999)}
+        yield now, 'cosmic', sensors
+
+
+def main(n):
+    events = [Event("b8:27:eb:00:00:00", i, sensors, kind, now)
+              for i, (now, kind, sensors) in enumerate(stream(n))]
+    full = sum(len(event.to_json()) for event in events)
+
+    encoder = DeltaEncoder()
+    start = time.time()
+    messages = [encoder.encode(event, event.timestamp) for event in events]
+    elapsed = time.time() - start
+
+    decoder = DeltaDecoder()
+    rebuilt = [decoder.decode(message) for message in messages if message is not None]
+    assert len(rebuilt) == len(events) - encoder.deduplicated and None not in rebuilt
+    assert all(event["sequence"] == json.loads(message)["sequence"]
+               for event, message in zip(rebuilt, [m for m in messages if m is not None]))
+
+    print("Full events: %d bytes, %.0f bytes/event" % (full, full / float(len(events))))
+    print("Delta:       %d bytes, %.0f bytes/event, %.1f%% saved" % (
+        encoder.sent_bytes, encoder.sent_bytes / float(len(events)), 100 * encoder.savings()))
+    print("%d keyframes, %d deltas, %d weather events deduplicated, encoding %.0f events/s" % (
+        encoder.keyframes, encoder.deltas, encoder.deduplicated, len(events) / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
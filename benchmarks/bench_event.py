@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Measure events/s for building an event and handing it to the broker and
+the file log, comparing the previous dict-copying, double-encoding Event
+with the current one.
+
+Usage: bench_event.py [number of events]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from event import Event
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": "21.3", "humidity": "45.0"}
+        self.barometer     = {"temperature": "21.5", "pressure": "1013.2", "altitude": "120.0"}
+        self.vibration     = {"direction": "0", "count": "0"}
+        self.magnetometer  = {"x": "0.1", "y": "0.2", "z": "0.3"}
+        self.accelerometer = {"x": "0.0", "y": "0.0", "z": "1.0"}
+        self.location      = {"latitude": "46.2", "longitude": "6.1", "altitude": "430.0"}
+        self.timing        = {"uptime": "1234", "counter_frequency": "42000000", "time_string": "12:00:00"}
+        self.status        = {"queue_size": "0", "missed_events": "0", "buffer_error": "0", "temp_status": "1",
+                              "baro_status": "1", "accel_status": "1", "mag_status": "1", "gps_status": "1"}
+        self.event         = {"evt": "1", "ticks": "123456"}
+
+
+class OldEvent(object):
+    def __init__(self, detector_id, sequence_number, sensors):
+        self.detector_id = detector_id
+        self.sequence = {"number": sequence_number}
+        self.date = {"date": time.asctime(time.gmtime(time.time()))}
+        self.__dict__.update(sensors.__dict__)
+
+    def to_json(self):
+        return json.dumps(self.__dict__)
+
+
+def old(n, sensors):
+    for i in range(n):
+        evt = OldEvent("b8:27:eb:00:00:00", i, sensors)
+        json.dumps(evt.to_json())  # broker
+        evt.to_json()  # file log
+
+
+def new(n, sensors):
+    for i in range(n):
+        evt = Event("b8:27:eb:00:00:00", i, sensors)
+        pkt = evt.to_json()
+        json.dumps(pkt)  # broker, default double-encoded mode
+        evt.to_json()  # file log, gets the string serialized for the broker
+
+
+def new_raw(n, sensors):
+    for i in range(n):
+        Event("b8:27:eb:00:00:00", i, sensors).to_json()
+
+
+def main(n):
+    sensors = Sensors()
+    for name, fn in (('before', old), ('after', new), ('after, raw_json', new_raw)):
+        start = time.time()
+        fn(n, sensors)
+        elapsed = time.time() - start
+        print("%-16s %.0f events/s" % (name + ':', n / elapsed))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Measure the cost of indexing the event log and the time to query one hour
+of it, with the index and with a full scan of the log.
+
+Usage: bench_log_index.py [number of events, one every 2 seconds]
+"""
+
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from logging.handlers import TimedRotatingFileHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from event import Event
+from log_index import index_handlers, index_path, matching, query
+
+KINDS = ('cosmic', 'cosmic', 'cosmic', 'vibration', 'weather')
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": 21.3, "humidity": 45.0}
+        self.barometer     = {"temperature": 21.5, "pressure": 1013.2, "altitude": 120.0}
+        self.vibration     = {"direction": 0, "count": 0}
+        self.magnetometer  = {"x": 0.1, "y": 0.2, "z": 0.3}
+        self.accelerometer = {"x": 0.0, "y": 0.0, "z": 1.0}
+        self.location      = {"latitude": 46.2, "longitude": 6.1, "altitude": 430.0}
+        self.timing        = {"uptime": 1234, "counter_frequency": 42000000, "time_string": "12:00:00"}
+        self.status        = {"queue_size": 0, "missed_events": 0, "buffer_error": 0, "temp_status": 1,
+                              "baro_status": 1, "accel_status": 1, "mag_status": 1, "gps_status": 1}
+
+
+def write(path, n, start, indexed):
+    logger = logging.getLogger('bench-%s' % indexed)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = TimedRotatingFileHandler(path, when='midnight')
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger.addHandler(handler)
+    if indexed:
+        index_handlers(logger)
+
+    sensors = Sensors()
+    begin = time.time()
+    for i in range(n):
+        event = Event("b8:27:eb:00:00:00", i, sensors, KINDS[i % len(KINDS)])
+        event.timestamp = start + i * 2
+        event.date = {"date": time.asctime(time.gmtime(event.timestamp))}
+        logger.info(event.to_json(), extra={'event_kind': event.kind, 'event_time': event.timestamp})
+    elapsed = time.time() - begin
+    handler.close()
+    return elapsed
+
+
+def main(n):
+    directory = tempfile.mkdtemp(prefix='cosmicpi-index-')
+    try:
+        start = time.time() - n * 2
+        plain = write(os.path.join(directory, 'plain.log'), n, start, False)
+        indexed = write(os.path.join(directory, 'indexed.log'), n, start, True)
+        path = os.path.join(directory, 'indexed.log')
+        print("Logging: %.0f events/s without the index, %.0f with it, index is %.1f%% of the log" % (
+            n / plain, n / indexed, 100.0 * os.path.getsize(index_path(path)) / os.path.getsize(path)))
+
+        first, last = start + n, start + n + 3600
+
+        begin = time.time()
+        found = sum(1 for _ in query(path, first, last, ['vibration']))
+        print("One hour of vibration events with the index: %d in %.3fs" % (found, time.time() - begin))
+
+        begin = time.time()
+        with open(path, 'rb') as f:
+            found = sum(1 for line in f if matching(line, first, last) is not None)
+        print("One hour of events with a full scan:         %d in %.3fs" % (found, time.time() - begin))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""Measure the time the acquisition thread spends logging each event:
+formatting the message eagerly or lazily, writing it synchronously or
+through the log queue, and with the level filtered. The file handler stalls
+for 20 ms every 500 records, as SD cards do when they flush. Events are
+logged back to back, then one per millisecond, closer to a real detector.
+
+Usage: bench_logging.py [number of events]
+"""
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from event import Event
+from log_queue import LogQueue, queue_handlers
+
+STALL_EVERY = 500
+STALL = 0.02
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": 21.3, "humidity": 45.0}
+        self.barometer     = {"temperature": 21.5, "pressure": 1013.2, "altitude": 120.0}
+        self.vibration     = {"direction": 0, "count": 0}
+        self.magnetometer  = {"x": 0.1, "y": 0.2, "z": 0.3}
+        self.accelerometer = {"x": 0.0, "y": 0.0, "z": 1.0}
+        self.location      = {"latitude": 46.2, "longitude": 6.1, "altitude": 430.0}
+        self.timing        = {"uptime": 1234, "counter_frequency": 42000000, "time_string": "12:00:00"}
+        self.status        = {"queue_size": 0, "missed_events": 0, "buffer_error": 0, "temp_status": 1,
+                              "baro_status": 1, "accel_status": 1, "mag_status": 1, "gps_status": 1}
+        self.event         = {"evt": 1, "ticks": 123456}
+
+
+class StallingFileHandler(logging.FileHandler):
+    def emit(self, record):
+        logging.FileHandler.emit(self, record)
+        self.records = getattr(self, 'records', 0) + 1
+        if self.records % STALL_EVERY == 0:
+            time.sleep(STALL)
+
+
+def make_logger(name, path, level=logging.INFO):
+    logger = logging.getLogger('bench.' + name)
+    logger.propagate = False
+    logger.setLevel(level)
+    handler = StallingFileHandler(path)
+    handler.setFormatter(logging.Formatter('[%(asctime)s] %(levelname)8s [%(filename)-25s %(lineno)4s] %(message)s'))
+    logger.addHandler(handler)
+    return logger
+
+
+def run(name, logger, events, lazy, pause=0):
+    worst = 0.0
+    elapsed = 0.0
+    for event in events:
+        before = time.time()
+        if lazy:
+            logger.info("Cosmic event: %s", event)
+        else:
+            logger.info("Cosmic event: %s" % event)
+        taken = time.time() - before
+        worst = max(worst, taken)
+        elapsed += taken
+        if pause:
+            time.sleep(pause)
+    print("%-30s %7.1f us/event  worst %6.2f ms" % (name + ':', elapsed / len(events) * 1e6, worst * 1000))
+    return elapsed
+
+
+def main(n):
+    sensors = Sensors()
+    events = [Event("b8:27:eb:00:00:00", i, sensors, 'cosmic', time.time(), 'gps') for i in range(n)]
+    directory = tempfile.mkdtemp(prefix='cosmicpi-logging-')
+    try:
+        path = lambda name: os.path.join(directory, name + '.log')
+
+        base = run("eager, synchronous", make_logger('eager', path('eager')), events, False)
+        run("lazy, synchronous", make_logger('lazy', path('lazy')), events, True)
+        run("eager, level filtered", make_logger('filtered', path('filtered'), logging.WARNING), events, False)
+        run("lazy, level filtered", make_logger('lazyfiltered', path('lazyfiltered'), logging.WARNING), events, True)
+
+        log_queue = LogQueue(n)
+        logger = make_logger('queued', path('queued'))
+        queue_handlers(logger, log_queue)
+        log_queue.start()
+        queued = run("lazy, queued", logger, events, True)
+        start = time.time()
+        log_queue.stop()
+        stats = log_queue.stats()
+        print("Log thread caught up %.2fs later, high water %d, %d records dropped" % (
+            time.time() - start, stats['high_water'], stats['drops']))
+        print("Acquisition thread time saved: %.1f us/event" % ((base - queued) / n * 1e6))
+
+        paced = events[:min(n, 2 * STALL_EVERY)]
+        print("\nOne event per millisecond, %d events:" % len(paced))
+        run("eager, synchronous", make_logger('paced', path('paced')), paced, False, 0.001)
+        log_queue = LogQueue(n)
+        logger = make_logger('pacedqueued', path('pacedqueued'))
+        queue_handlers(logger, log_queue)
+        log_queue.start()
+        run("lazy, queued", logger, paced, True, 0.001)
+        log_queue.stop()
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Compare the typed line parser with the previous quote-rewriting json.loads
+path over a serial capture, with and without converting the values to numbers
+afterwards.
+
+Usage: bench_parser.py [capture file] [repeat]
+
+The capture file holds one raw serial line per line. Without one, a
+synthetic capture with the firmware's usual mix of records is used.
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from line_parser import LineParser, SCHEMA, number
+
+SYNTHETIC = [
+    "{'timing':{'uptime':'1234','counter_frequency':'42000000','time_string':'12:00:00'}}\n",
+    "{'status':{'queue_size':'0','missed_events':'0','buffer_error':'0','temp_status':'1','baro_status':'1',"
+    "'accel_status':'1','mag_status':'1','gps_status':'1'}}\n",
+    "{'location':{'latitude':'46.2345','longitude':'6.0543','altitude':'430.1'}}\n",
+    "{'barometer':{'temperature':'21.5','pressure':'1013.25','altitude':'120.0'}}\n",
+    "{'temperature':{'temperature':'21.3','humidity':'45.0'}}\n",
+    "{'accelerometer':{'x':'0.01','y':'-0.02','z':'0.98'}}\n",
+    "{'magnetometer':{'x':'12.5','y':'-3.1','z':'40.2'}}\n",
+    "{'vibration':{'direction':'3','count':'12'}}\n",
+    "{'event':{'evt':'1','ticks':'31415926'}}\n",
+    "{'event':{'evt':'2','ticks':'27182818'}}\n",
+]
+
+
+def generic(line):
+    line = line.replace('\n', '')
+    line = line.replace('\'', '"')
+    try:
+        return json.loads(line)
+    except:
+        return
+
+
+def generic_typed(line):
+    sensor = generic(line)
+    if sensor:
+        for record_type, fields in sensor.items():
+            schema = SCHEMA.get(record_type, {})
+            for name, value in fields.items():
+                fields[name] = schema.get(name, number)(value)
+    return sensor
+
+
+def main(path, repeat):
+    if path:
+        with open(path) as f:
+            lines = f.readlines()
+    else:
+        lines = SYNTHETIC * 1000
+
+    parser = LineParser()
+    for name, parse in (('json.loads', generic), ('json.loads, typed', generic_typed), ('LineParser', parser.parse)):
+        start = time.time()
+        for _ in range(repeat):
+            for line in lines:
+                parse(line)
+        elapsed = time.time() - start
+        print("%-18s %.0f lines/s" % (name + ':', len(lines) * repeat / elapsed))
+
+    print("parser stats: %s" % parser.stats())
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None, int(sys.argv[2]) if len(sys.argv) > 2 else 10)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+"""Measure the cost of tracing the stages of each event: the detector
+processing serial lines without a tracer, as it runs by default, and with
+one, and the cost of recording a value in a rolling histogram.
+
+Usage: bench_profiling.py [number of lines]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from config import get_default_config
+from detector import Detector
+from profiling import RollingHistogram, Tracer, perf_counter_ns
+from timing import monotonic_ns
+
+LINES = [
+    "{'timing':{'uptime':'1234','counter_frequency':'42000000','time_string':'12:00:00'}}\n",
+    "{'barometer':{'temperature':'21.5','pressure':'1013.25','altitude':'120.0'}}\n",
+    "{'event':{'evt':'1','ticks':'31415926'}}\n",
+    "{'event':{'evt':'2','ticks':'27182818'}}\n",
+]
+
+
+class Sinks(object):
+    """Sinks that drop the events, to time the detector on its own."""
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def add_detector(self, detector_id, name):
+        pass
+
+    def handle(self, event, text, message):
+        pass
+
+
+def run(name, tracer, lines):
+    options = argparse.Namespace(**get_default_config())
+    detector = Detector(None, Sinks(tracer), options, detector_id='b8:27:eb:00:00:00')
+    start = time.time()
+    for line in lines:
+        detector.process_line(line, monotonic_ns())
+    elapsed = time.time() - start
+    print("%-26s %7.2f us/line" % (name + ':', elapsed / len(lines) * 1e6))
+    return elapsed
+
+
+def main(n):
+    lines = (LINES * (n // len(LINES) + 1))[:n]
+    run("warm up", None, lines)
+    base = run("without a tracer", None, lines)
+    traced = run("with a tracer", Tracer(path=None), lines)
+    print("Tracing costs %.2f us/line, %.0f%%" % ((traced - base) / n * 1e6, (traced - base) / base * 100))
+
+    histogram = RollingHistogram()
+    start = time.time()
+    for i in range(n):
+        histogram.record(i * 1000, perf_counter_ns())
+    print("%-26s %7.2f us/value" % ("Rolling histogram record:", (time.time() - start) / n * 1e6))
+    start = time.time()
+    snapshot = histogram.snapshot()
+    print("%-26s %7.2f ms, p99 %.1f us" % ("Snapshot:", (time.time() - start) * 1000,
+                                          snapshot.percentile(0.99) / 1000.0))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Compare per-event and batched publishing throughput against a fake channel.
+
+The fake channel writes each frame to a socket pair, so the unbatched
+publisher pays one write per event (as pika's BlockingConnection does), while
+the batching publisher's frames are written once per ioloop turn. The old
+acquisition loop also polled the connection for every serial line, which is
+reproduced with a zero-timeout select.
+
+Usage: bench_publisher.py [number of events] [batch size]
+"""
+
+import argparse
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from event_publisher import EventPublisher, BatchingEventPublisher
+
+EVENT = ('{"detector_id": "b8:27:eb:00:00:00", "sequence": {"number": 1}, '
+         '"barometer": {"temperature": "21.5", "pressure": "1013.2", "altitude": "120.0"}, '
+         '"timing": {"uptime": "1234", "counter_frequency": "42000000", "time_string": "12:00:00"}}')
+
+
+class FakeChannel(object):
+    def __init__(self, sock, buffered):
+        self.sock = sock
+        self.buffered = buffered
+        self.frames = []
+
+    def basic_publish(self, exchange, routing_key, body, properties):
+        frame = body.encode() if not isinstance(body, bytes) else body
+        if self.buffered:
+            self.frames.append(frame)
+        else:
+            self.sock.sendall(frame)
+
+    def write(self):
+        self.sock.sendall(b''.join(self.frames))
+        self.frames = []
+
+
+class FakeIOLoop(object):
+    def __init__(self, channel):
+        self.channel = channel
+
+    def add_callback_threadsafe(self, callback):
+        callback()
+        self.channel.write()
+
+
+class FakeConnection(object):
+    is_open = True
+
+    def __init__(self, sock, channel):
+        self.sock = sock
+        self.ioloop = FakeIOLoop(channel)
+
+    def process_data_events(self):
+        select.select([self.sock], [], [], 0)
+
+
+class Ack(object):
+    NAME = 'Basic.Ack'
+
+    def __init__(self, tag):
+        self.delivery_tag = tag
+        self.multiple = True
+
+
+class Frame(object):
+    def __init__(self, method):
+        self.method = method
+
+
+def options(batch_size):
+    return argparse.Namespace(
+        broker=dict(host='localhost', port=5672, username='guest', password='guest', raw_json=False, batch_size=batch_size,
+                    linger=0.05, max_in_flight=batch_size * 4, confirm_timeout=30, compression=None),
+        spool=dict(retry_interval=10))
+
+
+def sink(sock):
+    while sock.recv(1 << 16):
+        pass
+
+
+def bench_unbatched(n, sock):
+    class Publisher(EventPublisher):
+        def connect(self):
+            self.channel = FakeChannel(sock, buffered=False)
+            self.connection = FakeConnection(sock, self.channel)
+            return True
+
+    publisher = Publisher(options(1))
+    start = time.time()
+    for _ in range(n):
+        publisher.connection.process_data_events()
+        publisher.send_event_pkt(EVENT)
+    return time.time() - start
+
+
+def bench_batched(n, sock, batch_size):
+    class Publisher(BatchingEventPublisher):
+        def start(self):
+            self.channel = FakeChannel(sock, buffered=True)
+            self.connection = FakeConnection(sock, self.channel)
+            self.ioloop = self.connection.ioloop
+            self.ready = True
+
+    publisher = Publisher(options(batch_size))
+    start = time.time()
+    for _ in range(n):
+        publisher.send_event_pkt(EVENT)
+        if not publisher.pending:
+            publisher.on_delivery_confirmation(Frame(Ack(publisher.delivery_tag)))
+    publisher.ioloop.add_callback_threadsafe(publisher.flush)
+    assert publisher.published == n
+    return time.time() - start
+
+
+def main(n, batch_size):
+    a, b = socket.socketpair()
+    reader = threading.Thread(target=sink, args=(b,))
+    reader.daemon = True
+    reader.start()
+
+    unbatched = bench_unbatched(n, a)
+    print("unbatched: %d events in %.3fs (%.0f events/s)" % (n, unbatched, n / unbatched))
+    batched = bench_batched(n, a, batch_size)
+    print("batched (%d): %d events in %.3fs (%.0f events/s, %.1fx)" % (
+        batch_size, n, batched, n / batched, unbatched / batched))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000, int(sys.argv[2]) if len(sys.argv) > 2 else 100)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Measure the shared memory event ring: how fast events can be written to
+it, and the latency from writing an event to a reader in another process
+seeing it, spinning or polling every millisecond, against a Unix socket.
+
+Usage: bench_ring.py [number of events]
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from shared_ring import RingReader, RingWriter
+from timing import monotonic_ns
+
+EVENT = (b'{"detector_id":"b8:27:eb:00:00:00","sequence":{"number":1},'
+         b'"date":{"date":"Thu Jan  1 00:00:00 1970","timestamp":0.0,"source":"gps"},'
+         b'"barometer":{"temperature":21.5,"pressure":1013.2,"altitude":120.0},'
+         b'"temperature":{"temperature":21.3,"humidity":45.0},'
+         b'"timing":{"uptime":1234,"counter_frequency":42000000,"time_string":"12:00:00"},'
+         b'"event":{"evt":1,"ticks":21000000}}')
+
+STAMP = struct.Struct('<Q')
+PAUSE = 0.0005  # Between events in the latency runs
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    pick = lambda q: latencies[min(int(q * len(latencies)), len(latencies) - 1)] / 1000.0
+    return "p50:%8.1f us  p99:%8.1f us  max:%8.1f us" % (pick(0.5), pick(0.99), latencies[-1] / 1000.0)
+
+
+def in_child(read, n):
+    """Run read(n) in a child process, return the latencies it measured."""
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        os.write(wfd, json.dumps(read(n)).encode('utf-8'))
+        os._exit(0)
+    os.close(wfd)
+    return rfd, pid
+
+
+def collect(rfd, pid):
+    data = b''
+    while True:
+        chunk = os.read(rfd, 65536)
+        if not chunk:
+            break
+        data += chunk
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(data.decode('utf-8'))
+
+
+def ring_latency(path, n, interval):
+    def read(n):
+        reader = RingReader(path, oldest=True)
+        latencies = []
+        while len(latencies) < n:
+            for message in reader.wait(interval=interval):
+                now = monotonic_ns()
+                latencies.append(now - STAMP.unpack_from(message)[0])
+        return latencies
+
+    writer = RingWriter(path)
+    rfd, pid = in_child(read, n)
+    time.sleep(0.5)
+    for i in range(n):
+        writer.write(STAMP.pack(monotonic_ns()) + EVENT)
+        time.sleep(PAUSE)
+    latencies = collect(rfd, pid)
+    writer.close()
+    os.remove(path)
+    return latencies
+
+
+def socket_latency(n):
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    size = STAMP.size + len(EVENT)
+
+    def read(n):
+        ours.close()
+        latencies = []
+        data = b''
+        while len(latencies) < n:
+            data += theirs.recv(65536)
+            now = monotonic_ns()
+            while len(data) >= size:
+                latencies.append(now - STAMP.unpack_from(data)[0])
+                data = data[size:]
+        return latencies
+
+    rfd, pid = in_child(read, n)
+    theirs.close()
+    time.sleep(0.5)
+    for i in range(n):
+        ours.sendall(STAMP.pack(monotonic_ns()) + EVENT)
+        time.sleep(PAUSE)
+    latencies = collect(rfd, pid)
+    ours.close()
+    return latencies
+
+
+def main(n):
+    directory = tempfile.mkdtemp(prefix='cosmicpi-ring-')
+    path = os.path.join(directory, 'events')
+    try:
+        writer = RingWriter(path)
+        reader = RingReader(path)
+        reader.poll()
+        start = time.time()
+        for i in range(n):
+            writer.write(EVENT)
+            if i % 1000 == 0:
+                reader.poll()
+        reader.poll()
+        elapsed = time.time() - start
+        print("Ring write + read: %9.0f events/s, %d read, %d lost" % (n / elapsed, reader.received, reader.lost))
+        writer.close()
+        os.remove(path)
+
+        m = max(n // 100, 100)
+        print("Latency over %d events, one every %.1f ms:" % (m, PAUSE * 1000))
+        print("  ring, spinning reader:  %s" % percentiles(ring_latency(path, m, 0)))
+        print("  ring, polling every ms: %s" % percentiles(ring_latency(path, m, 0.001)))
+        print("  Unix socket:            %s" % percentiles(socket_latency(m)))
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""Measure the time the event rules take to decide whether to emit an event,
+for each kind of rule on its own and for a list of them.
+
+Usage: bench_rules.py [number of events]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from rules import Rules
+
+
+class Sensors(object):
+    def __init__(self):
+        self.temperature   = {"temperature": 21.3, "humidity": 45.0}
+        self.barometer     = {"temperature": 21.5, "pressure": 1013.2, "altitude": 120.0}
+        self.vibration     = {"direction": 3, "count": 12}
+        self.magnetometer  = {"x": 12.5, "y": -3.1, "z": 40.2}
+        self.accelerometer = {"x": 0.01, "y": -0.02, "z": 0.98}
+
+
+RULES = [
+    ("where", [dict(kinds=['vibration'], where='accelerometer.magnitude > 1.2')]),
+    ("rate_limit", [dict(kinds=['vibration'], rate_limit=2, burst=10)]),
+    ("sample", [dict(kinds=['vibration'], sample='1/10')]),
+    ("aggregate", [dict(kinds=['vibration'], aggregate=60)]),
+    ("aggregate, 2 fields", [dict(kinds=['vibration'], aggregate=60,
+                                  fields=['accelerometer.magnitude', 'vibration.count'])]),
+    ("where + rate_limit + sample", [dict(kinds=['vibration'], where='vibration.count > 1'),
+                                     dict(kinds=['vibration'], rate_limit=1000, burst=1000),
+                                     dict(kinds=['vibration'], sample='1/2')]),
+]
+
+
+def main(n):
+    sensors = Sensors()
+    for name, configs in [("no rule", [])] + RULES:
+        rules = Rules(configs, {'bench': name})
+        now = time.time()
+        start = time.time()
+        for i in range(n):
+            rules.accept('vibration', sensors, now + i * 0.001)
+        elapsed = time.time() - start
+        print("%-30s %7.2f us/event" % (name + ':', elapsed / n * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
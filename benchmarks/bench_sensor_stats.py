@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Measure the rolling sensor statistics: the time taken to add the readings
+of a barometer record, and to answer queries over windows of a minute to a
+month, against computing the same statistics from the raw readings.
+
+Usage: bench_sensor_stats.py [number of readings]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+import numpy
+
+from sensor_stats import SensorStats, parse_window
+
+
+def main(n):
+    stats = SensorStats()
+    start_time = 1467892200.0
+    times = start_time + numpy.arange(n, dtype=numpy.float64)
+    pressures = 1013.0 + 0.5 * numpy.sin(numpy.arange(n) / 300.0)
+    records = [{'barometer': {'temperature': 21.5, 'pressure': float(pressure), 'altitude': 120.0}}
+               for pressure in pressures]
+
+    start = time.time()
+    for timestamp, record in zip(times, records):
+        stats.update(record, timestamp)
+    elapsed = time.time() - start
+    print("Update: %7.1f us/record, %d records, one a second" % (elapsed / n * 1e6, n))
+
+    now = times[-1]
+    for text in ('1m', '1h', '1d', '30d'):
+        window = parse_window(text)
+        start = time.time()
+        result = stats.stats('barometer.pressure', window, now)
+        taken = time.time() - start
+        start = time.time()
+        recent = pressures[times > now - window]
+        raw = (recent.mean(), recent.std()) if len(recent) else (None, None)
+        scanned = time.time() - start
+        print("%4s: %6.3f ms (raw scan %6.3f ms)  count %7d  mean %s (%s)  stddev %s (%s)" % (
+            text, taken * 1000, scanned * 1000, result['count'], result['mean'],
+            raw[0] if raw[0] is None else round(raw[0], 6), result['stddev'],
+            raw[1] if raw[1] is None else round(raw[1], 6)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Measure spool append and replay throughput.
+
+Usage: bench_spool.py [number of events]
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from spool import Spool, SpoolDrainer
+
+EVENT = (b'{"detector_id": "b8:27:eb:00:00:00", "sequence": {"number": 1}, '
+         b'"barometer": {"temperature": "21.5", "pressure": "1013.2", "altitude": "120.0"}, '
+         b'"temperature": {"temperature": "21.3", "humidity": "45.0"}, '
+         b'"timing": {"uptime": "1234", "counter_frequency": "42000000", "time_string": "12:00:00"}}')
+
+
+class NullPublisher(object):
+    connected = True
+
+    def __init__(self):
+        self.sent = 0
+
+    def connect(self):
+        return True
+
+    def send_event_pkt(self, pkt):
+        self.sent += 1
+
+
+def main(n):
+    directory = tempfile.mkdtemp(prefix='cosmicpi-spool-')
+    try:
+        spool = Spool(directory, segment_size=4 * 1024 * 1024, max_segments=1024)
+
+        start = time.time()
+        for _ in range(n):
+            spool.append(EVENT)
+        elapsed = time.time() - start
+        print("append: %d events in %.3fs (%.0f events/s, %d segments)" % (
+            n, elapsed, n / elapsed, len(spool.segments)))
+
+        publisher = NullPublisher()
+        drainer = SpoolDrainer(spool, publisher, batch_size=500)
+        start = time.time()
+        while drainer.drain():
+            pass
+        elapsed = time.time() - start
+        print("replay: %d events in %.3fs (%.0f events/s)" % (publisher.sent, elapsed, publisher.sent / elapsed))
+
+        spool.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
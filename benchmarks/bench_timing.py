@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Measure the cost of stamping events: formatting the date of every event
+with time.asctime() against the cached per-second date, and the time taken
+by the clock to turn counter ticks into an event time.
+
+Usage: bench_timing.py [number of events]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from timing import Clock, asctime, monotonic_ns
+
+FREQUENCY = 42000000
+
+
+def timed(name, fn, n):
+    start = time.time()
+    fn(n)
+    elapsed = time.time() - start
+    print("%-28s %9.0f events/s" % (name + ':', n / elapsed))
+
+
+def format_each(n):
+    for i in range(n):
+        time.asctime(time.gmtime(time.time()))
+
+
+def format_cached(n):
+    for i in range(n):
+        asctime(time.time())
+
+
+def main(n):
+    clock = Clock()
+    received = monotonic_ns()
+    clock.update({'uptime': 1, 'counter_frequency': FREQUENCY, 'time_string': time.strftime('%H:%M:%S', time.gmtime())},
+                 received, True)
+
+    def stamp(n):
+        for i in range(n):
+            clock.timestamp(i * 7 % FREQUENCY, received)
+
+    timed("asctime for every event", format_each, n)
+    timed("cached per-second asctime", format_cached, n)
+    timed("clock timestamp from ticks", stamp, n)
+    print("Resolution: %.1f ns with a %d MHz counter" % (1e9 / FREQUENCY, FREQUENCY // 1000000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500000)
@@ -1,2 +1,4 @@
 from .cosmicpi import main
-from .cli import main as cli
\ No newline at end of file
+from .cli import main as cli
+from .replay import main as replay
+from .archive import main as archive
@@ -0,0 +1,213 @@
+"""
+Rate and coincidence analysis of events.
+
+All functions work on NumPy arrays of event times in seconds, such as the
+'time' column returned by archive.load(), or the contents of an EventBuffer
+filled live by the detector. Everything is vectorized: windows and
+coincidences are found with binary searches over sorted times (searchsorted),
+never by comparing every pair of events, so millions of events take seconds.
+
+Needs the "analysis" extra (pip install cosmicpi[analysis]).
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def require_numpy():
+    if numpy is None:
+        raise ImportError("The analysis module requires numpy, install cosmicpi[analysis]")
+
+
+def sliding_rates(times, window, step=None, start=None, end=None):
+    """Return the start of each window and the event rate in it, in events
+    per second. Windows are window seconds long and start every step seconds
+    (by default, step = window). times must be sorted.
+    """
+    require_numpy()
+    times = numpy.asarray(times, dtype=numpy.float64)
+    step = window if step is None else step
+    start = float(times[0] if len(times) else 0.0) if start is None else float(start)
+    end = float(times[-1] if len(times) else start) if end is None else float(end)
+
+    edges = numpy.arange(start, end - window + step, step) if end - start >= window else numpy.array([start])
+    counts = numpy.searchsorted(times, edges + window, 'left') - numpy.searchsorted(times, edges, 'left')
+    return edges, counts / float(window)
+
+
+def window_means(times, values, edges, window):
+    """Return the mean of values over each window, NaN for empty windows.
+    times must be sorted, values are the samples taken at those times.
+    """
+    require_numpy()
+    values = numpy.asarray(values, dtype=numpy.float64)
+    sums = numpy.concatenate(([0.0], numpy.cumsum(values)))
+    first = numpy.searchsorted(times, edges, 'left')
+    last = numpy.searchsorted(times, edges + window, 'left')
+    counts = last - first
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(counts > 0, (sums[last] - sums[first]) / counts, numpy.nan)
+
+
+def inter_arrival(times, bins=50, limit=None):
+    """Return the intervals between consecutive events, and their histogram
+    as (counts, bin edges). For a steady source the intervals are
+    exponentially distributed, with a mean of 1 / rate.
+    """
+    require_numpy()
+    intervals = numpy.diff(numpy.asarray(times, dtype=numpy.float64))
+    if limit is None:
+        limit = intervals.max() if len(intervals) else 1.0
+    counts, edges = numpy.histogram(intervals, bins=bins, range=(0.0, limit))
+    return intervals, counts, edges
+
+
+def barometric_coefficient(rates, pressures, reference=None):
+    """Fit the barometric coefficient beta of rate = R0 * exp(-beta * (P - P0)).
+
+    Returns beta in 1/(pressure unit), and the reference pressure P0 (by
+    default, the mean pressure). Windows without events or without a
+    pressure reading are ignored, and beta is None if that leaves none.
+    """
+    require_numpy()
+    rates = numpy.asarray(rates, dtype=numpy.float64)
+    pressures = numpy.asarray(pressures, dtype=numpy.float64)
+    valid = (rates > 0) & numpy.isfinite(pressures)
+    if not valid.any():
+        return None, reference
+    if reference is None:
+        reference = pressures[valid].mean()
+    if valid.sum() < 2:
+        return 0.0, reference
+
+    slope, _ = numpy.polyfit(pressures[valid] - reference, numpy.log(rates[valid]), 1)
+    return -slope, reference
+
+
+def pressure_corrected(rates, pressures, beta=None, reference=None):
+    """Return the rates corrected to the reference pressure, using beta (or
+    fitting it when it's not given), with the beta and reference used. The
+    rates are returned as they are when there is nothing to fit beta on.
+    """
+    require_numpy()
+    rates = numpy.asarray(rates, dtype=numpy.float64)
+    pressures = numpy.asarray(pressures, dtype=numpy.float64)
+    if beta is None:
+        beta, reference = barometric_coefficient(rates, pressures, reference)
+        if beta is None:
+            return rates, None, reference
+    elif reference is None:
+        reference = numpy.nanmean(pressures)
+    corrected = rates * numpy.exp(beta * (pressures - reference))
+    return corrected, beta, reference
+
+
+def coincidences(times_a, times_b, tolerance):
+    """Return the indices (ia, ib) of every pair of events of two detectors
+    whose times differ by at most tolerance. Both arrays must be sorted.
+    """
+    require_numpy()
+    times_a = numpy.asarray(times_a, dtype=numpy.float64)
+    times_b = numpy.asarray(times_b, dtype=numpy.float64)
+
+    first = numpy.searchsorted(times_b, times_a - tolerance, 'left')
+    last = numpy.searchsorted(times_b, times_a + tolerance, 'right')
+    counts = last - first
+
+    ia = numpy.repeat(numpy.arange(len(times_a)), counts)
+    # Offset of each pair within the matches of its event of a
+    offsets = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    ib = numpy.repeat(first, counts) + offsets
+    return ia, ib
+
+
+def coincidence_clusters(times, tolerance, min_detectors=2):
+    """Group the events of several detectors into coincidences.
+
+    times is a list with the sorted event times of each detector. Events
+    closer than tolerance to the previous event, of any detector, are
+    chained into a cluster. Returns the time of the first event, the number of
+    distinct detectors and the number of events of every cluster seen by at
+    least min_detectors detectors, and for each detector the cluster index of
+    its events (-1 where it isn't part of a kept cluster).
+    """
+    require_numpy()
+    sizes = [len(t) for t in times]
+    merged = numpy.concatenate([numpy.asarray(t, dtype=numpy.float64) for t in times])
+    detectors = numpy.repeat(numpy.arange(len(times)), sizes)
+    if not len(merged):
+        empty = numpy.empty(0)
+        return empty, empty.astype(int), empty.astype(int), [numpy.empty(0, dtype=int) for _ in times]
+
+    order = numpy.argsort(merged, kind='mergesort')
+    sorted_times = merged[order]
+    cluster = numpy.concatenate(([0], numpy.cumsum(numpy.diff(sorted_times) > tolerance)))
+    clusters = cluster[-1] + 1
+
+    events = numpy.bincount(cluster, minlength=clusters)
+    # Keys are nearly sorted already, a merge sort is much faster than unique()
+    pairs = numpy.sort(cluster * len(times) + detectors[order], kind='mergesort')
+    pairs = pairs[numpy.concatenate(([True], pairs[1:] != pairs[:-1]))]
+    distinct = numpy.bincount(pairs // len(times), minlength=clusters)
+
+    kept = distinct >= min_detectors
+    renumbered = numpy.where(kept, numpy.cumsum(kept) - 1, -1)
+    start = numpy.searchsorted(cluster, numpy.nonzero(kept)[0], 'left')
+
+    assigned = numpy.empty(len(merged), dtype=int)
+    assigned[order] = renumbered[cluster]
+    offsets = numpy.concatenate(([0], numpy.cumsum(sizes)))
+    members = [assigned[offsets[i]:offsets[i + 1]] for i in range(len(times))]
+    return sorted_times[start], distinct[kept], events[kept], members
+
+
+class EventBuffer(object):
+    """The times and barometric pressures of the latest events, kept in
+    NumPy arrays that the detector appends to as events arrive.
+
+    The buffer is a ring of fixed capacity. arrays() returns copies in time
+    order, which can be passed to the analysis functions.
+    """
+
+    def __init__(self, capacity=100000):
+        require_numpy()
+        self.capacity = capacity
+        self.times = numpy.zeros(capacity, dtype=numpy.float64)
+        self.pressures = numpy.zeros(capacity, dtype=numpy.float64)
+        self.count = 0
+
+    def append(self, timestamp, pressure):
+        i = self.count % self.capacity
+        self.times[i] = timestamp
+        try:
+            self.pressures[i] = pressure
+        except (TypeError, ValueError):
+            self.pressures[i] = numpy.nan
+        self.count += 1
+
+    def arrays(self):
+        if self.count <= self.capacity:
+            return self.times[:self.count].copy(), self.pressures[:self.count].copy()
+        i = self.count % self.capacity
+        return (numpy.concatenate((self.times[i:], self.times[:i])),
+                numpy.concatenate((self.pressures[i:], self.pressures[:i])))
+
+    def summary(self, window, beta=None, reference=None, now=None):
+        """Return the rate of the last window seconds, the pressure corrected
+        rate and the mean interval between events, as a dict.
+        """
+        times, pressures = self.arrays()
+        end = now if now is not None else (times[-1] if len(times) else 0.0)
+        recent = times >= end - window
+        rate = float(recent.sum()) / window
+        result = dict(window=window, events=int(recent.sum()), rate=rate,
+                      mean_interval=float(numpy.diff(times[recent]).mean()) if recent.sum() > 1 else None)
+
+        pressure = numpy.nanmean(pressures[recent]) if recent.any() else numpy.nan
+        if numpy.isfinite(pressure) and beta is not None:
+            if reference is None:
+                reference = float(numpy.nanmean(pressures))
+            result.update(pressure=float(pressure), corrected_rate=float(rate * numpy.exp(beta * (pressure - reference))))
+        return result
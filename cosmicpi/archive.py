@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+"""
+Columnar binary archive of events.
+
+An archive file holds the events of one UTC day. It starts with a header
+describing the columns, followed by chunks of events:
+
+    header: "CPARCH1\\n", uint32 length, JSON {"columns": [[name, dtype], ...], ...}
+    chunk:  "CHNK", uint32 count, float64 min time, float64 max time,
+            then each column as count fixed-width little-endian values
+
+Every part is padded to 8 bytes, so the columns can be used in place from a
+memory map. The per-chunk time range lets a reader skip chunks outside the
+time span it is asked for. Only the typed sensor fields (see
+line_parser.SCHEMA) are archived; the raw event record isn't.
+
+Writing only needs the standard library. Reading returns NumPy arrays, and
+needs the "archive" extra (pip install cosmicpi[archive]).
+"""
+
+from __future__ import print_function
+
+import argparse
+import calendar
+import glob
+import json
+import logging
+import os
+import struct
+import sys
+import time
+
+from event import Event, infer_kind
+from line_parser import SCHEMA
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'CPARCH1\n'
+LENGTH = struct.Struct('<I')
+CHUNK = struct.Struct('<4sIdd')
+CHUNK_MAGIC = b'CHNK'
+ALIGNMENT = 8
+
+# Values of the kind column
+KINDS = ('unknown', 'cosmic', 'vibration', 'weather')
+
+# Fields that need 64 bits, the other floats and integers are stored in 32
+WIDE_FIELDS = ('location.latitude', 'location.longitude', 'timing.uptime', 'timing.counter_frequency')
+
+STRUCT_CODES = {'<f4': 'f', '<f8': 'd', '<i4': 'i', '<i8': 'q', '<u1': 'B'}
+ITEM_SIZES = {'<f4': 4, '<f8': 8, '<i4': 4, '<i8': 8, '<u1': 1}
+
+
+def get_columns():
+    """Return the (name, dtype) of every archive column."""
+    columns = [('time', '<f8'), ('sequence', '<i8'), ('kind', '<u1')]
+    for sensor in Event.SENSORS:
+        for field, type in sorted(SCHEMA[sensor].items()):
+            name = "%s.%s" % (sensor, field)
+            if type is float:
+                columns.append((name, '<f8' if name in WIDE_FIELDS else '<f4'))
+            elif type is int:
+                columns.append((name, '<i8' if name in WIDE_FIELDS else '<i4'))
+    return columns
+
+
+COLUMNS = get_columns()
+
+
+def padding(size):
+    return b'\0' * (-size % ALIGNMENT)
+
+
+def converter(dtype):
+    """Return a function converting a sensor value for a column, with NaN or
+    0 for values that are missing or don't fit.
+    """
+    if dtype.startswith('<f'):
+        def convert(value):
+            try:
+                return float(value)
+            except (TypeError, ValueError):
+                return float('nan')
+    else:
+        bits = ITEM_SIZES[dtype] * 8 - 1
+
+        def convert(value):
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                return 0
+            return value if -2 ** bits <= value < 2 ** bits else 0
+    return convert
+
+
+def read_header(f):
+    """Read the file header. Returns the header dict and the offset of the
+    first chunk.
+    """
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError("%s is not an event archive" % f.name)
+    length, = LENGTH.unpack(f.read(LENGTH.size))
+    header = json.loads(f.read(length).decode('utf-8'))
+    header['columns'] = [tuple(column) for column in header['columns']]
+    size = len(MAGIC) + LENGTH.size + length
+    return header, size + len(padding(size))
+
+
+def chunk_size(columns, count):
+    return CHUNK.size + sum(count * ITEM_SIZES[dtype] + len(padding(count * ITEM_SIZES[dtype]))
+                            for _, dtype in columns)
+
+
+def scan_chunks(f, columns, offset):
+    """Return (offset, count, min time, max time) for every complete chunk."""
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+
+    chunks = []
+    while offset + CHUNK.size <= end:
+        f.seek(offset)
+        magic, count, min_time, max_time = CHUNK.unpack(f.read(CHUNK.size))
+        size = chunk_size(columns, count)
+        if magic != CHUNK_MAGIC or offset + size > end:
+            break  # Torn write at the end of the file
+        chunks.append((offset, count, min_time, max_time))
+        offset += size
+    return chunks, offset
+
+
+class ArchiveWriter(object):
+    """Append events to the daily archive files in a directory.
+
+    Events are buffered per column and written as a chunk when chunk_size
+    events are waiting, or by flush(). The file is changed when an event
+    belongs to a different UTC day than the previous one. An existing file for
+    the day is appended to, after dropping a chunk left incomplete by a crash.
+    """
+
+    def __init__(self, directory, detector_id=None, chunk_size=1024, flush_interval=60):
+        self.directory = directory
+        self.detector_id = detector_id
+        self.chunk_size = chunk_size
+        self.flush_interval = flush_interval
+        self.columns = COLUMNS
+        self.converters = [converter(dtype) for _, dtype in self.columns]
+        self.fields = [name.split('.') for name, _ in self.columns[3:]]
+
+        self.file = None
+        self.day = None
+        self.values = [[] for _ in self.columns]
+        self.first_buffered = None
+
+        self.events = 0
+        self.chunks = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, day):
+        return os.path.join(self.directory, "events-%s.cpa" % day)
+
+    def open(self, day):
+        path = self.path(day)
+        if os.path.exists(path):
+            self.file = open(path, 'r+b')
+            header, offset = read_header(self.file)
+            if header['columns'] != self.columns:
+                self.file.close()
+                os.rename(path, path + '.%d' % time.time())
+                log.warn("Archive %s has different columns, moved it aside" % path)
+                return self.open(day)
+            chunks, end = scan_chunks(self.file, self.columns, offset)
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            header = json.dumps(dict(columns=self.columns, detector_id=self.detector_id, date=day)).encode('utf-8')
+            size = len(MAGIC) + LENGTH.size + len(header)
+            self.file = open(path, 'wb')
+            self.file.write(MAGIC + LENGTH.pack(len(header)) + header + padding(size))
+            self.file.flush()
+        self.day = day
+        log.info("Archiving events to %s" % path)
+
+    def append(self, timestamp, kind, record):
+        """Buffer an event, given its time, kind and dict as in Event.to_dict()."""
+        day = time.strftime('%Y%m%d', time.gmtime(timestamp))
+        if day != self.day:
+            self.flush()
+            self.close_file()
+            self.open(day)
+
+        values = self.values
+        values[0].append(timestamp)
+        values[1].append(self.converters[1](record.get('sequence', {}).get('number')))
+        values[2].append(KINDS.index(kind) if kind in KINDS else 0)
+        for i, (sensor, field) in enumerate(self.fields, 3):
+            values[i].append(self.converters[i](record.get(sensor, {}).get(field)))
+        self.events += 1
+
+        if self.first_buffered is None:
+            self.first_buffered = time.time()
+        if len(values[0]) >= self.chunk_size:
+            self.flush()
+
+    def append_event(self, event):
+        self.append(event.timestamp, event.kind, event.to_dict())
+
+    def flush(self):
+        """Write the buffered events as a chunk."""
+        count = len(self.values[0])
+        if not count:
+            return
+
+        times = self.values[0]
+        parts = [CHUNK.pack(CHUNK_MAGIC, count, min(times), max(times))]
+        for (_, dtype), values in zip(self.columns, self.values):
+            data = struct.pack('<%d%s' % (count, STRUCT_CODES[dtype]), *values)
+            parts.append(data)
+            parts.append(padding(len(data)))
+        self.file.write(b''.join(parts))
+        self.file.flush()
+
+        self.values = [[] for _ in self.columns]
+        self.first_buffered = None
+        self.chunks += 1
+
+    def flush_due(self):
+        """Write a partial chunk once events have waited for the flush interval."""
+        if self.first_buffered is not None and time.time() - self.first_buffered >= self.flush_interval:
+            self.flush()
+
+    def stats(self):
+        return dict(events=self.events, chunks=self.chunks, buffered=len(self.values[0]))
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.day = None
+
+    def close(self):
+        self.flush()
+        self.close_file()
+
+
+class ArchiveReader(object):
+    """Read an archive file through a memory map.
+
+    Columns are returned as NumPy arrays. A chunk's columns are views of the
+    mapped file, so only the chunks and columns that are asked for are read
+    from disk.
+    """
+
+    def __init__(self, path):
+        if numpy is None:
+            raise ImportError("Reading archives requires numpy, install cosmicpi[archive]")
+
+        self.path = path
+        with open(path, 'rb') as f:
+            self.header, offset = read_header(f)
+            self.chunks, _ = scan_chunks(f, self.columns, offset)
+        self.map = numpy.memmap(path, dtype=numpy.uint8, mode='r') if self.chunks else None
+
+    @property
+    def columns(self):
+        return self.header['columns']
+
+    def __len__(self):
+        return sum(count for _, count, _, _ in self.chunks)
+
+    def chunk(self, index, names=None):
+        """Return {column: array} for one chunk."""
+        offset, count, _, _ = self.chunks[index]
+        offset += CHUNK.size
+        result = {}
+        for name, dtype in self.columns:
+            size = count * ITEM_SIZES[dtype]
+            if names is None or name in names:
+                result[name] = numpy.frombuffer(self.map, dtype=dtype, count=count, offset=offset)
+            offset += size + len(padding(size))
+        return result
+
+    def read(self, start=None, end=None, names=None):
+        """Return {column: array} for the events with start <= time < end."""
+        wanted = None if names is None else set(names) | set(['time'])
+        parts = [self.chunk(i, wanted) for i, (_, _, min_time, max_time) in enumerate(self.chunks)
+                 if (start is None or max_time >= start) and (end is None or min_time < end)]
+
+        if not parts:
+            return dict((name, numpy.empty(0, dtype=dtype)) for name, dtype in self.columns
+                        if wanted is None or name in wanted)
+
+        result = dict((name, numpy.concatenate([part[name] for part in parts])) for name in parts[0])
+        if start is not None or end is not None:
+            times = result['time']
+            mask = numpy.ones(len(times), dtype=bool)
+            if start is not None:
+                mask &= times >= start
+            if end is not None:
+                mask &= times < end
+            if not mask.all():
+                result = dict((name, values[mask]) for name, values in result.items())
+        return result
+
+    def close(self):
+        self.map = None
+
+
+def load(directory, start=None, end=None, names=None):
+    """Read the events with start <= time < end from the daily archive files
+    in a directory, sorted by time.
+    """
+    if numpy is None:
+        raise ImportError("Reading archives requires numpy, install cosmicpi[archive]")
+
+    first = time.strftime('%Y%m%d', time.gmtime(start)) if start is not None else None
+    last = time.strftime('%Y%m%d', time.gmtime(end)) if end is not None else None
+
+    parts = []
+    for path in sorted(glob.glob(os.path.join(directory, 'events-*.cpa'))):
+        day = os.path.basename(path)[7:15]
+        if (first is not None and day < first) or (last is not None and day > last):
+            continue
+        reader = ArchiveReader(path)
+        parts.append(reader.read(start, end, names))
+
+    parts = [part for part in parts if len(part['time'])]
+    if not parts:
+        return dict((name, numpy.empty(0, dtype=dtype)) for name, dtype in COLUMNS
+                    if names is None or name in names or name == 'time')
+
+    result = dict((name, numpy.concatenate([part[name] for part in parts])) for name in parts[0])
+    order = numpy.argsort(result['time'], kind='mergesort')
+    return dict((name, values[order]) for name, values in result.items())
+
+
+def event_time(record, line):
+    """Return the time of an event from a JSON log line, preferring the time
+    or UTC date in the event to the local time the line was logged at.
+    """
+    try:
+        if 'timestamp' in record['date']:
+            return float(record['date']['timestamp'])
+        return float(calendar.timegm(time.strptime(record['date']['date'])))
+    except (KeyError, TypeError, ValueError):
+        return time.mktime(time.strptime(line[:19], '%Y-%m-%d %H:%M:%S'))
+
+
+def log_records(paths):
+    """Yield (time, record) for the events of JSON log files, and None for
+    each line that isn't one.
+    """
+    for path in paths:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line[line.index('{'):])
+                    yield event_time(record, line), record
+                except ValueError:
+                    yield None
+
+
+def convert(paths, directory, chunk_size=1024):
+    """Append the events of JSON log files to the archive in a directory.
+    Returns the number of events converted and the number of lines skipped.
+
+    If the logs have the events of several detectors, as when a process runs
+    several, each detector's go to a subdirectory named after its ID.
+    """
+    detector_ids = set(entry[1].get('detector_id') for entry in log_records(paths) if entry is not None)
+    writers = {}  # detector_id: ArchiveWriter
+    previous = {}  # detector_id: last event record, see infer_kind
+    converted = skipped = 0
+    try:
+        for entry in log_records(paths):
+            if entry is None:
+                skipped += 1
+                continue
+            timestamp, record = entry
+            detector_id = record.get('detector_id')
+            writer = writers.get(detector_id)
+            if writer is None:
+                path = directory if len(detector_ids) == 1 else os.path.join(directory, str(detector_id))
+                writer = writers[detector_id] = ArchiveWriter(path, detector_id, chunk_size=chunk_size)
+            writer.append(timestamp, infer_kind(record, previous) or 'unknown', record)
+            converted += 1
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return converted, skipped
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog="cosmicpi-archive", description="Convert and inspect event archives")
+    subparsers = parser.add_subparsers(dest='command')
+
+    convert_parser = subparsers.add_parser('convert', help='convert JSON event logs to archive files')
+    convert_parser.add_argument('logs', nargs='+', help='event log files, oldest first')
+    convert_parser.add_argument('-o', '--output', required=True, help='archive directory')
+    convert_parser.add_argument('--chunk-size', type=int, default=1024, help='events per chunk')
+
+    info_parser = subparsers.add_parser('info', help='show the contents of archive files')
+    info_parser.add_argument('archives', nargs='+', help='archive files')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        converted, skipped = convert(args.logs, args.output, args.chunk_size)
+        print("Converted %d events, skipped %d lines" % (converted, skipped))
+
+    elif args.command == 'info':
+        for path in args.archives:
+            with open(path, 'rb') as f:
+                header, offset = read_header(f)
+                chunks, end = scan_chunks(f, header['columns'], offset)
+            count = sum(chunk[1] for chunk in chunks)
+            print("%s: detector %s, %d events in %d chunks, %d bytes" % (
+                path, header.get('detector_id'), count, len(chunks), end))
+            if chunks:
+                print("  from %s to %s UTC" % (time.asctime(time.gmtime(min(chunk[2] for chunk in chunks))),
+                                               time.asctime(time.gmtime(max(chunk[3] for chunk in chunks)))))
+            print("  columns: %s" % " ".join("%s:%s" % column for column in header['columns']))
+
+
+if __name__ == '__main__':
+    main()
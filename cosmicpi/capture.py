@@ -0,0 +1,60 @@
+import struct
+import time
+
+# time.monotonic only exists on Python 3
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+class CaptureWriter(object):
+    """Record raw serial lines with their arrival time.
+
+    The file starts with a magic string and the wall clock time of the first
+    line, followed by one (microseconds since the previous line, length, line)
+    record per line. The deltas are taken from the monotonic clock.
+    """
+
+    MAGIC = b'CPCAP1\n'
+    HEADER = struct.Struct('<d')
+    RECORD = struct.Struct('<IH')
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.last = None
+        self.lines = 0
+
+    def write(self, line):
+        now = monotonic()
+        if self.last is None:
+            self.file.write(self.MAGIC + self.HEADER.pack(time.time()))
+            self.last = now
+
+        delta = min(int((now - self.last) * 1e6), 0xffffffff)
+        self.file.write(self.RECORD.pack(delta, len(line)))
+        self.file.write(line)
+        self.last = now
+        self.lines += 1
+
+    def close(self):
+        self.file.close()
+
+
+class CaptureReader(object):
+    """Iterate over (seconds since the first line, line) in a capture file."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            if f.read(len(CaptureWriter.MAGIC)) != CaptureWriter.MAGIC:
+                raise ValueError("%s is not a serial capture file" % self.path)
+            self.started, = CaptureWriter.HEADER.unpack(f.read(CaptureWriter.HEADER.size))
+
+            offset = 0.0
+            while True:
+                record = f.read(CaptureWriter.RECORD.size)
+                if len(record) < CaptureWriter.RECORD.size:
+                    return
+                delta, length = CaptureWriter.RECORD.unpack(record)
+                offset += delta / 1e6
+                yield offset, f.read(length)
@@ -0,0 +1,137 @@
+"""
+Checkpoints of the detector state, restored when the process restarts.
+
+Without them, the sequence numbers start again from 1 on every launch, and
+the sensors read 0 until each sensor reports again, so the first events
+after a restart carry bogus data. With checkpoint.enabled, the state of
+each detector is saved every interval seconds if it changed, and when the
+process stops: its sequence number and run, the last value of each sensor
+record, and its event counters, along with the read position and backlog of
+the spool (the spool restores its position from its own offset file,
+which it updates on every commit). When the process starts, each detector
+gets its state back, the sensor values only if the checkpoint is less than
+max_age seconds old.
+
+Each start is a new run of the detector, numbered from 1, and published in
+the sequence of its events: {"number": 42, "run": 3}. (detector_id, run,
+number) identifies an event across restarts, so consumers can drop events
+replayed from the spool, and tell a restart (a new run) from lost events (a
+gap in the numbers). If the process crashes, the events since the last
+checkpoint are numbered again, but in a new run.
+
+A checkpoint is a small binary file: a header with a magic string, the
+CRC32 and length of the payload, then the payload, deflated JSON. It's
+written to a temporary file and renamed over the previous one, so a crash
+while saving leaves the previous checkpoint.
+"""
+
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'CPCKPT1\0'
+HEADER = struct.Struct('<8sII')  # Magic, CRC32 and length of the payload
+
+
+def dump(state):
+    payload = zlib.compress(json.dumps(state, separators=(',', ':'), sort_keys=True).encode('utf-8'))
+    return HEADER.pack(MAGIC, zlib.crc32(payload) & 0xffffffff, len(payload)) + payload
+
+
+def load(data):
+    """Return the state in a checkpoint, or raise ValueError."""
+    if len(data) < HEADER.size:
+        raise ValueError("truncated header")
+    magic, crc, length = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a checkpoint")
+    payload = data[HEADER.size:HEADER.size + length]
+    if len(payload) != length or zlib.crc32(payload) & 0xffffffff != crc:
+        raise ValueError("corrupt payload")
+    return json.loads(zlib.decompress(payload).decode('utf-8'))
+
+
+class Checkpoint(object):
+    """Save the state of the detectors of the process, and restore it."""
+
+    def __init__(self, path, detectors, spool=None, interval=10, max_age=3600):
+        self.path = path
+        self.detectors = detectors
+        self.spool = spool
+        self.interval = interval
+        self.max_age = max_age
+        self.next_save = 0
+        self.saves = 0
+        self.saved = None  # The detector states last saved
+
+    def read(self):
+        """Return the saved state, or None if there's none or it's unreadable."""
+        try:
+            with open(self.path, 'rb') as f:
+                return load(f.read())
+        except IOError:
+            return None
+        except ValueError as e:
+            log.warn("Ignoring the checkpoint at %s: %s" % (self.path, e))
+            return None
+
+    def restore(self):
+        """Restore the state of the detectors, start a new run of each, and
+        save it right away so that the run number isn't reused.
+        """
+        state = self.read()
+        saved = {} if state is None else state.get('detectors', {})
+        age = None if state is None else time.time() - state['time']
+        for detector in self.detectors:
+            detector_state = saved.get(detector.detector_id)
+            if detector_state is None:
+                detector.run_number = 1
+                continue
+            detector.restore(detector_state, age <= self.max_age)
+            log.info("Restored detector %s from a checkpoint %.0fs old: run %d, sequence %d" % (
+                detector.detector_id, age, detector.run_number, detector.sequence_number))
+        self.save()
+
+    def snapshot(self):
+        state = dict(time=time.time(), detectors=dict(
+            (detector.detector_id, detector.state()) for detector in self.detectors))
+        if self.spool is not None:
+            state['spool'] = dict(read_segment=self.spool.read_segment, read_offset=self.spool.read_offset,
+                                  pending=len(self.spool))
+        return state
+
+    def save(self, force=True):
+        """Write a checkpoint, replacing the previous one atomically. Unless
+        forced, it's skipped if the detectors haven't changed since the last.
+        """
+        state = self.snapshot()
+        self.next_save = time.time() + self.interval
+        if not force and state['detectors'] == self.saved:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(dump(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.path)
+        self.saved = state['detectors']
+        self.saves += 1
+
+    def tick(self, now=None):
+        """Save a checkpoint if one is due, called about once a second."""
+        now = time.time() if now is None else now
+        if now < self.next_save:
+            return
+        try:
+            self.save(False)
+        except (IOError, OSError) as e:
+            log.warn("Couldn't save a checkpoint to %s: %s" % (self.path, e))
+            self.next_save = now + self.interval
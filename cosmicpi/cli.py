@@ -1,30 +1,43 @@
 #!/usr/bin/env python
 
+import json
 import logging
 import socket
 import sys
 
-import time
 from cliff.app import App
 from cliff.command import Command
 from cliff.commandmanager import CommandManager
 from blessings import Terminal
 
+from config import get_default_config
+from log_index import KINDS, condition, parse_time, query
+from protocol import send_message, receive_message
+from status import format_status, unflatten
+
 
 class SocketCommand(object):
 
-    @staticmethod
-    def send_and_receive(command):
+    def connect(self):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
         try:
-            sock.connect("/tmp/cosmicpi.sock")
+            sock.connect(self.app.options.socket)
         except:
-            print ("Fatal: Couldn't connect, is the process running?")
+            print ("Fatal: Couldn't connect to %s, is the process running?" % self.app.options.socket)
             sys.exit(1)
 
-        sock.send(command)
-        response = sock.recv(1024)
+        return sock
+
+    def address(self, command):
+        """Prefix a command with the detector it's for, if one was given."""
+        device = self.app.options.device
+        return command if device is None else '@%s %s' % (device, command)
+
+    def send_and_receive(self, command):
+        sock = self.connect()
+        send_message(sock, self.address(command))
+        response = receive_message(sock)
         sock.close()
         return response
 
@@ -70,6 +83,58 @@ class Arduino(Command, SocketCommand):
         self.app.stdout.write(self.send_and_receive('arduino ' + command) + '\n')
 
 
+class Metrics(Command, SocketCommand):
+    """Show the metrics of the acquisition process as JSON."""
+    def take_action(self, args):
+        metrics = json.loads(self.send_and_receive('metrics'))
+        self.app.stdout.write(json.dumps(metrics, indent=2, sort_keys=True) + '\n')
+
+
+class Rates(Command, SocketCommand):
+    """Show the rate of cosmic events over the last window."""
+
+    def get_parser(self, prog_name):
+        parser = super(Rates, self).get_parser(prog_name)
+        parser.add_argument('window', type=float, nargs='?', default=60.0, help='window in seconds')
+        return parser
+
+    def take_action(self, args):
+        self.app.stdout.write(self.send_and_receive('rates %s' % args.window) + '\n')
+
+
+class Stats(Command, SocketCommand):
+    """Show the statistics of a sensor field over the last window."""
+
+    def get_parser(self, prog_name):
+        parser = super(Stats, self).get_parser(prog_name)
+        parser.add_argument('field', nargs='?', default='', help='sensor field, e.g. barometer.pressure')
+        parser.add_argument('window', nargs='?', default='1m', help='window, e.g. 30s, 10m, 1h or 7d')
+        return parser
+
+    def take_action(self, args):
+        self.app.stdout.write(self.send_and_receive('stats %s %s' % (args.field, args.window)) + '\n')
+
+
+class Devices(Command, SocketCommand):
+    """List the detectors of the acquisition process."""
+
+    def take_action(self, args):
+        self.app.stdout.write(self.send_and_receive('devices') + '\n')
+
+
+class Profile(Command, SocketCommand):
+    """Sample where the threads of the acquisition process spend their time."""
+
+    def get_parser(self, prog_name):
+        parser = super(Profile, self).get_parser(prog_name)
+        parser.add_argument('seconds', type=float, nargs='?', default=10.0, help='how long to sample for')
+        parser.add_argument('-i', '--interval', type=float, default=5.0, help='sampling interval in ms')
+        return parser
+
+    def take_action(self, args):
+        self.app.stdout.write(self.send_and_receive('profile %s %s' % (args.seconds, args.interval)) + '\n')
+
+
 class Status(Command, SocketCommand):
     """Show the current status of the detector."""
 
@@ -77,28 +142,77 @@ class Status(Command, SocketCommand):
         parser = super(Status, self).get_parser(prog_name)
         parser.add_argument('-m', '--monitor', action='store_true',
                             help='monitor the detector status continuously')
+        parser.add_argument('-i', '--interval', type=float, default=1.0,
+                            help='minimum number of seconds between monitor updates')
         return parser
 
     def take_action(self, args):
         if args.monitor:
-            term = Terminal()
+            self.monitor(args.interval)
+        else:
+            self.app.stdout.write(self.get_status() + '\n')
 
+    def monitor(self, interval):
+        """Render the status from a subscription, which only sends the
+        values that changed since the previous update.
+        """
+        term = Terminal()
+        sock = self.connect()
+        send_message(sock, self.address('subscribe %s' % interval))
+        state = {}
+
+        try:
             while True:
-                try:
-                    status = self.get_status()
-                    self.app.stdout.write(status)
-                    self.app.stdout.write(term.move_y(term.height - len(status.split('\n'))))
-                    time.sleep(1)
-                except KeyboardInterrupt:
-                    self.app.stdout.write(term.move_y(term.height) + '\n')
+                changes = receive_message(sock)
+                if changes is None:
+                    self.app.stdout.write(term.move_y(term.height) + '\nConnection closed\n')
                     return
-        else:
-            self.app.stdout.write(self.get_status() + '\n')
+                state.update(json.loads(changes))
+                status = format_status(unflatten(state))
+                self.app.stdout.write(status)
+                self.app.stdout.write(term.move_y(term.height - len(status.split('\n'))))
+        except KeyboardInterrupt:
+            self.app.stdout.write(term.move_y(term.height) + '\n')
+        finally:
+            sock.close()
 
     def get_status(self):
         return self.send_and_receive('s')
 
 
+class Query(Command):
+    """Query the event log. The log index is used to read only the parts of
+    the log files that can match."""
+
+    def get_parser(self, prog_name):
+        parser = super(Query, self).get_parser(prog_name)
+        parser.add_argument('--from', dest='start', help="start time, as 'YYYY-MM-DD[ HH:MM[:SS]]'")
+        parser.add_argument('--to', dest='end', help="end time (excluded), as 'YYYY-MM-DD[ HH:MM[:SS]]'")
+        parser.add_argument('--utc', action='store_true', help='times are UTC rather than local time')
+        parser.add_argument('-t', '--type', dest='kinds', action='append', choices=KINDS,
+                            help='kind of events to return, can be repeated')
+        parser.add_argument('-w', '--where', action='append', default=[],
+                            help="condition on an event field, e.g. 'barometer.pressure>1000', can be repeated")
+        parser.add_argument('-c', '--count', action='store_true', help='only print the number of matching events')
+        parser.add_argument('--log', default='/tmp/cosmicpi.log', help='path to the event log file')
+        return parser
+
+    def take_action(self, args):
+        start = parse_time(args.start, args.utc) if args.start else None
+        end = parse_time(args.end, args.utc) if args.end else None
+        conditions = [condition(text) for text in args.where]
+
+        count = 0
+        for kind, event in query(args.log, start, end, args.kinds):
+            if all(predicate(event) for predicate in conditions):
+                count += 1
+                if not args.count:
+                    self.app.stdout.write(json.dumps(event, sort_keys=True) + '\n')
+
+        if args.count:
+            self.app.stdout.write("%d\n" % count)
+
+
 class Cli(App):
     NAME = 'cosmicpi'
     log = logging.getLogger(__name__)
@@ -113,11 +227,25 @@ class Cli(App):
         commands = {
             'status': Status,
             'usb_toggle': UsbToggle,
+            'metrics': Metrics,
+            'query': Query,
+            'rates': Rates,
+            'stats': Stats,
+            'devices': Devices,
+            'profile': Profile,
             'arduino': Arduino
         }
         for k, v in commands.iteritems():
             command.add_command(k, v)
 
+    def build_option_parser(self, description, version, argparse_kwargs=None):
+        parser = super(Cli, self).build_option_parser(description, version, argparse_kwargs)
+        parser.add_argument('--socket', default=get_default_config()['commands']['socket'],
+                            help='path to the command socket of the acquisition process')
+        parser.add_argument('--device', default=None,
+                            help='name of the detector to send commands to, when there are several')
+        return parser
+
     def initialize_app(self, argv):
         self.log.debug('initialize_app')
 
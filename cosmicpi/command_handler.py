@@ -1,150 +1,362 @@
+import errno
+import json
 import logging
 import os
+import select
 import socket
 import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry
+from profiling import SamplingProfiler, format_spans
+from protocol import Connection
+from sensor_stats import parse_window
+from status import delta, flatten, format_status
 
 log = logging.getLogger(__name__)
 
 
 class CommandHandler(object):
+    """Serve commands on a local Unix socket.
+
+    Any number of clients can stay connected at the same time. Messages are
+    length-framed in both directions (see protocol.py), and requests on a
+    connection are answered in the order they arrive, so they can be
+    pipelined.
+
+    A client that sends 'subscribe [interval]' instead gets a stream of JSON
+    messages: a full, flattened status snapshot as the reply, then only the
+    keys that changed, at most once per interval.
+
+    With several detectors, a command prefixed with '@name ' goes to the
+    detector of that name, commands without one go to the first detector.
+
+    'profile [seconds] [interval in ms]' samples the threads of the process
+    (see profiling.py) and answers with the report once it's done. The
+    replies to the requests sent after it on the same connection wait for it.
+    """
+
+    MIN_INTERVAL = 0.05
+    MAX_PROFILE = 300
+    PROFILE_POLL = 0.1
 
-    def __init__(self, detector, usb, options):
-        self.detector = detector
-        self.usb = usb
+    def __init__(self, detectors, options):
+        self.detectors = OrderedDict((detector.name, detector) for detector in detectors)
         self.options = options
-        self.thread = threading.Thread(target=self.run, args=(), kwargs={})
+        self.socket_path = options.commands['socket']
+        self.connections = {}
+        self.subscribers = {}
+        self.profiles = []  # (connection, reply slot, SamplingProfiler)
+        self.thread = threading.Thread(target=self.run, name='commands', args=(), kwargs={})
         self.thread.daemon = True
+        self.stopping = False
 
     def start(self):
         self.thread.start()
 
-    def run(self):
+    def stop(self):
+        self.stopping = True
+        if self.thread.is_alive():
+            self.thread.join(2)
+
+    def open_socket(self):
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 
         try:
-            os.remove("/tmp/cosmicpi.sock")
+            os.remove(self.socket_path)
         except OSError:
             pass
 
-        sock.bind("/tmp/cosmicpi.sock")
-        sock.listen(1)
-        log.info("Listening for commands on local socket")
+        sock.bind(self.socket_path)
+        sock.listen(16)
+        sock.setblocking(0)
+        log.info("Listening for commands on %s" % self.socket_path)
+        return sock
 
-        while True:
+    def accept(self, sock):
+        """Accept a pending client connection, if there is one."""
+        try:
             conn, addr = sock.accept()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+        connection = Connection(conn, self.on_message)
+        self.connections[connection.fileno()] = connection
+        return connection
 
-            cmd = conn.recv(1024)
-            if not cmd:
-                break
+    def disconnect(self, connection):
+        self.connections.pop(connection.fileno(), None)
+        self.subscribers.pop(connection.fileno(), None)
+        self.profiles = [profile for profile in self.profiles if profile[0] is not connection]
+        connection.close()
 
-            log.info("Received command: %s" % cmd)
+    def on_message(self, connection, cmd):
+        detector, cmd = self.address(cmd)
+        if detector is None:
+            return "Unknown detector: %s" % cmd
+        if cmd.startswith('subscribe'):
+            return self.subscribe(connection, cmd, detector)
+        if cmd.startswith('profile'):
+            return self.profile(connection, cmd)
+        return self.execute(cmd, detector)
 
-            try:
-                if cmd == 'd':
-                    if self.options.debug:
-                        self.options.debug = False
-                    else:
-                        self.options.debug = True
-                    response = "Debug:%s\n" % self.options.debug
+    def address(self, cmd):
+        """Return the detector a command is for, and the command without its
+        address. The detector is None if there is none of that name.
+        """
+        if not cmd.startswith('@'):
+            return list(self.detectors.values())[0], cmd
+        name, _, cmd = cmd[1:].partition(' ')
+        if name not in self.detectors:
+            return None, name
+        return self.detectors[name], cmd.strip()
 
-                elif cmd == 'v':
-                    if self.options.monitoring['vibration']:
-                        self.options.monitoring['vibration'] = False
-                    else:
-                        self.options.monitoring['vibration'] = True
-                    response = "Vibration:%s\n" % self.options.monitoring['vibration']
+    def subscribe(self, connection, cmd, detector):
+        try:
+            interval = max(float(cmd.split()[1]), self.MIN_INTERVAL) if ' ' in cmd else 1.0
+        except ValueError:
+            return "Invalid subscription interval: %s" % cmd
+        log.info("Status subscription every %.2fs" % interval)
+        snapshot = flatten(self.status(detector))
+        self.subscribers[connection.fileno()] = [connection, interval, snapshot, time.time() + interval, detector]
+        return json.dumps(snapshot)
 
-                elif cmd == 'w':
-                    if self.options.monitoring['weather']:
-                        self.options.monitoring['weather'] = False
-                    else:
-                        self.options.monitoring['weather'] = True
-                    response = "WeatherStation:%s\n" % self.options.monitoring['weather']
-
-                # elif cmd.find("r") != -1:
-                #     if len(patok) > 0:
-                #         if pushflg:
-                #             pushflg = False
-                #             print ("Unregister server notifications")
-                #         else:
-                #             pushflg = True
-                #             print ("Register for server notifications")
-                #
-                #         if udpflg:
-                #             evt.set_pat(patok, pushflg)
-                #             pbuf = evt.get_notification()
-                #             sio.send_event_pkt(pbuf)
-                #             sbuf = evt.get_status()
-                #             sio.send_event_pkt(sbuf)
-                #             print ("Sent notification request:%s" % pbuf)
-                #         else:
-                #             print ("UDP sending is OFF, can not register with server")
-                #             pbuf = ""
-                #     else:
-                #         print ("Token option is not set")
-
-                elif cmd == 's':
-                    tim = self.detector.sensors.timing
-                    sts = self.detector.sensors.status
-                    loc = self.detector.sensors.location
-                    acl = self.detector.sensors.accelerometer
-                    mag = self.detector.sensors.magnetometer
-                    bmp = self.detector.sensors.barometer
-                    htu = self.detector.sensors.temperature
-                    vib = self.detector.sensors.vibration
-
-                    response = "ARDUINO STATUS\n"
-                    response += "Status........: uptime:%s counter_frequency:%s queue_size:%s missed_events:%s\n" % (
-                        tim["uptime"], tim["counter_frequency"], sts["queue_size"], sts["missed_events"])
-                    response += ("HardwareStatus: temp_status:%s baro_status:%s accel_status:%s mag_status:%s gps_status:%s\n" % (
-                        sts["temp_status"], sts["baro_status"], sts["accel_status"], sts["mag_status"], sts["gps_status"]))
-                    response += ("Location......: latitude:%s longitude:%s altitude:%s\n" % (loc["latitude"], loc["longitude"], loc["altitude"]))
-                    response += ("Accelerometer.: x:%s y:%s z:%s\n" % (acl["x"], acl["y"], acl["z"]))
-                    response += ("Magnetometer..: x:%s y:%s z:%s\n" % (mag["x"], mag["y"], mag["z"]))
-                    response += ("Barometer.....: temperature:%s pressure:%s altitude:%s\n" % (bmp["temperature"], bmp["pressure"], bmp["altitude"]))
-                    response += ("Humidity......: temperature:%s humidity:%s\n" % (htu["temperature"], htu["humidity"]))
-                    response += ("Vibration.....: direction:%s count:%s\n" % (vib["direction"], vib["count"]))
-
-                    response += ("MONITOR STATUS\n")
-                    response += ("USB device....: %s\n" % (self.options.usb['device']))
-                    response += ("Remote........: Ip:%s Port:%s UdpFlag:%s\n" % (self.options.broker['host'], self.options.broker['port'], self.options.broker['enabled']))
-                    # print ("Notifications.: Flag:%s Token:%s" % (pushflg, patok))
-                    response += ("Vibration.....: Sent:%d Flag:%s\n" % (self.detector.vbrts, self.options.monitoring['vibration']))
-                    response += ("WeatherStation: Flag:%s\n" % (self.options.monitoring['weather']))
-                    response += ("Events........: Sent:%d LogFlag:%s\n" % (self.detector.events, self.options.logging['enabled']))
-
-                elif cmd == 'u':
-                    if self.usb.enabled:
-                        self.usb.disable()
-                    else:
-                        self.usb.enable()
-                    response = ("USB: %s" % ('enabled' if self.usb.enabled else 'disabled'))
+    def profile(self, connection, cmd):
+        try:
+            args = cmd.split()[1:]
+            seconds = min(float(args[0]), self.MAX_PROFILE) if args else 10.0
+            interval = max(float(args[1]) / 1000, 0.001) if len(args) > 1 else 0.005
+        except ValueError:
+            return "Invalid profile duration: %s" % cmd
+        log.info("Profiling for %.1fs" % seconds)
+        profiler = SamplingProfiler(seconds, interval)
+        profiler.start()
+        self.profiles.append((connection, connection.defer(), profiler))
+        return None
 
-                elif cmd == 'n':
-                    if self.options.broker['enabled']:
-                        self.options.broker['enabled'] = False
-                    else:
-                        self.options.broker['enabled'] = True
-                    response = ("Send:%s\n" % self.options.broker['enabled'])
+    def send_profiles(self):
+        """Send the reports of the profiles that are done. Returns True if
+        some are still running.
+        """
+        running = []
+        for connection, slot, profiler in self.profiles:
+            if not profiler.done():
+                running.append((connection, slot, profiler))
+                continue
+            report = profiler.report()
+            tracer = list(self.detectors.values())[0].tracer
+            if tracer is not None:
+                report = format_spans(tracer.stats()) + "\n\n" + report
+            connection.reply(slot, report)
+        self.profiles = running
+        return bool(running)
+
+    def push_updates(self):
+        """Send status changes to the subscribers that are due, and profile
+        reports. Returns the number of seconds until the next one is, or None
+        without subscribers or profiles.
+        """
+        profiling = self.send_profiles()
+        if not self.subscribers:
+            return self.PROFILE_POLL if profiling else None
+
+        now = time.time()
+        current = {}
+        next_due = None
+        for subscriber in self.subscribers.values():
+            connection, interval, previous, due, detector = subscriber
+            if due <= now and not connection.busy():  # Let slow clients catch up
+                if detector not in current:
+                    current[detector] = flatten(self.status(detector))
+                changes = delta(previous, current[detector])
+                if changes:
+                    connection.send(json.dumps(changes))
+                subscriber[2] = current[detector]
+                subscriber[3] = due = now + interval
+            next_due = due if next_due is None else min(next_due, due)
+        if profiling:
+            next_due = min(next_due, now + self.PROFILE_POLL)
+        return max(next_due - now, 0)
+
+    def run(self):
+        sock = self.open_socket()
+
+        timeout = 1
+        while not self.stopping:
+            connections = list(self.connections.values())
+            writers = [connection for connection in connections if connection.wants_write()]
+            readable, writable, _ = select.select([sock] + connections, writers, [], timeout)
+
+            for connection in writable:
+                if not connection.on_writable():
+                    self.disconnect(connection)
+
+            for connection in readable:
+                if connection is sock:
+                    self.accept(sock)
+                elif connection.fileno() in self.connections and not connection.on_readable():
+                    self.disconnect(connection)
+
+            next_due = self.push_updates()
+            timeout = 1 if next_due is None else min(next_due, 1)
 
-                elif cmd == 'l':
-                    if self.options.logging['enabled']:
-                        self.options.logging['enabled'] = False
+    def status(self, detector):
+        """Return the detector and monitor status as a nested dict."""
+        sensors = detector.sensors
+        sinks = detector.sinks
+        serial = detector.usb.stats()
+        serial['since_last_line'] = round(serial['since_last_line'], 1)
+
+        monitor = dict(
+            usb_device=detector.usb.usbdev,
+            serial=serial,
+            broker=dict(host=self.options.broker['host'], port=self.options.broker['port'],
+                        enabled=self.options.broker['enabled']),
+            vibration=dict(sent=detector.vbrts, enabled=detector.monitoring['vibration']),
+            weather=dict(sent=detector.weathers, enabled=detector.monitoring['weather']),
+            events=dict(sent=detector.events, logging=self.options.logging['enabled']),
+            parser=sensors.parser.stats(),
+            publisher=sinks.sio.stats(),
+            clock=detector.clock.stats())
+        if detector.name is not None:
+            monitor['detector'] = dict(name=detector.name, detector_id=detector.detector_id)
+        if sinks.spool is not None:
+            monitor['spool'] = sinks.spool.stats()
+            monitor['spool']['connected'] = sinks.sio.connected
+        if detector.delta is not None:
+            monitor['delta'] = detector.delta.stats()
+
+        return dict(
+            arduino=dict(timing=sensors.timing, status=sensors.status, location=sensors.location,
+                         accelerometer=sensors.accelerometer, magnetometer=sensors.magnetometer,
+                         barometer=sensors.barometer, temperature=sensors.temperature,
+                         vibration=sensors.vibration),
+            monitor=monitor,
+            pipeline=dict(detector.pipeline_stats()),
+            sinks=sinks.stats())
+
+    def devices(self):
+        """Return the name, serial port, detector id, state and events of
+        each detector, one per line.
+        """
+        return "\n".join("%s %s %s %s %s events:%d" % (
+            detector.name or '-', detector.usb.usbdev, detector.detector_id,
+            'open' if detector.usb.is_open else 'closed', 'enabled' if detector.usb.enabled else 'disabled',
+            detector.events) for detector in self.detectors.values())
+
+    def execute(self, cmd, detector=None):
+        """Run a command and return the response to send back."""
+        log.info("Received command: %s" % cmd)
+        detector = detector or list(self.detectors.values())[0]
+
+        try:
+            if cmd == 'd':
+                if self.options.debug:
+                    self.options.debug = False
+                else:
+                    self.options.debug = True
+                response = "Debug:%s\n" % self.options.debug
+
+            elif cmd == 'v':
+                if detector.monitoring['vibration']:
+                    detector.monitoring['vibration'] = False
+                else:
+                    detector.monitoring['vibration'] = True
+                response = "Vibration:%s\n" % detector.monitoring['vibration']
+
+            elif cmd == 'w':
+                if detector.monitoring['weather']:
+                    detector.monitoring['weather'] = False
+                else:
+                    detector.monitoring['weather'] = True
+                response = "WeatherStation:%s\n" % detector.monitoring['weather']
+
+            # elif cmd.find("r") != -1:
+            #     if len(patok) > 0:
+            #         if pushflg:
+            #             pushflg = False
+            #             print ("Unregister server notifications")
+            #         else:
+            #             pushflg = True
+            #             print ("Register for server notifications")
+            #
+            #         if udpflg:
+            #             evt.set_pat(patok, pushflg)
+            #             pbuf = evt.get_notification()
+            #             sio.send_event_pkt(pbuf)
+            #             sbuf = evt.get_status()
+            #             sio.send_event_pkt(sbuf)
+            #             print ("Sent notification request:%s" % pbuf)
+            #         else:
+            #             print ("UDP sending is OFF, can not register with server")
+            #             pbuf = ""
+            #     else:
+            #         print ("Token option is not set")
+
+            elif cmd == 's':
+                response = format_status(self.status(detector))
+
+            elif cmd == 'devices':
+                response = self.devices()
+
+            elif cmd == 'metrics':
+                response = json.dumps(registry.to_dict())
+
+            elif cmd.startswith('rates'):
+                if detector.analysis is None:
+                    response = "Rate analysis is disabled"
+                else:
+                    window = float(cmd.split()[1]) if ' ' in cmd else 60.0
+                    response = json.dumps(detector.analysis.summary(
+                        window, self.options.analysis['beta'], self.options.analysis['reference_pressure'],
+                        time.time()))
+
+            elif cmd.startswith('stats'):
+                if detector.sensor_stats is None:
+                    response = "Sensor statistics are disabled"
+                else:
+                    args = cmd.split()[1:]
+                    fields = detector.sensor_stats.fields
+                    if not args or args[0] not in fields:
+                        response = "Fields: %s" % " ".join(fields)
                     else:
-                        self.options.logging['enabled'] = True
-                    response = ("Log:%s\n" % self.options.logging['enabled'])
+                        window = parse_window(args[1]) if len(args) > 1 else 60.0
+                        response = json.dumps(detector.sensor_stats.stats(args[0], window, time.time()))
+
+            elif cmd == 'u':
+                if detector.usb.enabled:
+                    detector.usb.disable()
+                else:
+                    detector.usb.enable()
+                response = ("USB: %s" % ('enabled' if detector.usb.enabled else 'disabled'))
 
-                elif cmd.startswith('arduino'):
-                    response = ("%s" % cmd)
-                    self.usb.write(cmd.upper())
+            elif cmd == 'n':
+                if self.options.broker['enabled']:
+                    self.options.broker['enabled'] = False
+                else:
+                    self.options.broker['enabled'] = True
+                response = ("Send:%s\n" % self.options.broker['enabled'])
 
+            elif cmd == 'l':
+                if self.options.logging['enabled']:
+                    self.options.logging['enabled'] = False
                 else:
-                    response = ''
+                    self.options.logging['enabled'] = True
+                response = ("Log:%s\n" % self.options.logging['enabled'])
+
+            elif cmd.startswith('arduino'):
+                response = ("%s" % cmd)
+                detector.usb.write(cmd.upper())
+
+            else:
+                response = ''
 
-                conn.send(response)
+            return response
 
-            except Exception as e:
-                msg = "Error processing client command: %s" % e
-                log.warn(msg)
-                conn.send(msg)
+        except Exception as e:
+            msg = "Error processing client command: %s" % e
+            log.warn(msg)
+            return msg
 
@@ -19,6 +19,18 @@ def get_default_config():
             port=5162,
             username="guest",
             password="guest",
+            raw_json=False,
+            batching=False,
+            batch_size=100,
+            linger=0.05,
+            max_in_flight=10000,
+            confirm_timeout=30,
+            compression=None,
+            compression_level=6,
+            dictionary=True,
+            delta=False,
+            keyframe_interval=60,
+            deadbands=None,
             enabled=True
         ),
         monitoring=dict(
@@ -28,18 +40,135 @@ def get_default_config():
         ),
         logging=dict(
             config=os.path.dirname(os.path.realpath(__file__)) + "/logging.conf",
+            index=True,
+            index_bucket=60,
+            asynchronous=False,
+            queue_size=10000,
             enabled=True
         ),
         usb=dict(
-            device='/dev/ttyACM0'
+            device='/dev/ttyACM0',
+            capture=None,
+            devices=None
         ),
         commands=dict(
             socket="/var/run/cosmicpi.sock"
         ),
+        pipeline=dict(
+            read_queue=4096,
+            publish_queue=1024,
+            log_queue=1024,
+            archive_queue=1024,
+            sink_queue=1024,
+            overflow="drop_oldest",
+            spill_dir="/tmp/cosmicpi-spill"
+        ),
+        spool=dict(
+            directory="/var/spool/cosmicpi",
+            segment_size=4 * 1024 * 1024,
+            max_segments=64,
+            batch_size=100,
+            retry_interval=10,
+            enabled=True
+        ),
+        archive=dict(
+            directory="/var/lib/cosmicpi/archive",
+            chunk_size=1024,
+            flush_interval=60,
+            enabled=False
+        ),
+        ring=dict(
+            path="/dev/shm/cosmicpi-events",
+            capacity=4 * 1024 * 1024,
+            enabled=False
+        ),
+        timing=dict(
+            gps=True,
+            smoothing=0.05,
+            step=1.0
+        ),
+        analysis=dict(
+            buffer_size=100000,
+            beta=None,
+            reference_pressure=None,
+            enabled=False
+        ),
+        checkpoint=dict(
+            path="/var/lib/cosmicpi/checkpoint",
+            interval=10,  # Seconds
+            max_age=3600,  # Seconds after which the sensor values aren't restored
+            enabled=False
+        ),
+        sensor_stats=dict(
+            fields=['temperature.temperature', 'temperature.humidity',
+                    'barometer.temperature', 'barometer.pressure', 'barometer.altitude'],
+            resolutions=[[1, 3600], [60, 1440], [3600, 720]],  # [seconds per slot, slots]
+            enabled=False
+        ),
+        metrics=dict(
+            address="127.0.0.1",
+            port=None
+        ),
+        event_loop=dict(
+            status_interval=60,
+            enabled=False
+        ),
+        profiling=dict(
+            slow_threshold=0.1,  # Seconds
+            trace_file="/tmp/cosmicpi-trace.log",
+            window=60,
+            enabled=False
+        ),
+        sinks=None,  # A list of sinks, see sinks.py
+        rules=None,  # A list of event rules, see rules.py
         debug=False
     )
 
 
+def get_devices(options):
+    """Return the name, serial device, detector ID, monitoring flags and
+    capture file of each detector the process runs.
+
+    Several detectors are listed in usb.devices, e.g.
+
+        usb:
+          devices:
+            - name: north
+              device: /dev/ttyACM0
+            - name: south
+              device: /dev/ttyACM1
+              detector_id: station1-south
+              monitoring: {vibration: false}
+
+    A device's monitoring flags override the monitoring section, and its name
+    defaults to the name of the serial device. Names and detector IDs must be
+    unique. Without usb.devices, there is a single detector on usb.device,
+    which has no name.
+    """
+    devices = options.usb['devices']
+    if not devices:
+        return [dict(name=None, device=options.usb['device'], detector_id=None, monitoring=None,
+                     capture=options.usb['capture'])]
+
+    result = []
+    for device in devices:
+        monitoring = dict(options.monitoring)
+        monitoring.update(device.get('monitoring') or {})
+        result.append(dict(name=str(device.get('name') or os.path.basename(device['device'])),
+                           device=device['device'], detector_id=device.get('detector_id'),
+                           monitoring=monitoring, capture=device.get('capture')))
+
+    names = [device['name'] for device in result]
+    for name in names:
+        if names.count(name) > 1:
+            raise ValueError("More than one device is named %s" % name)
+    detector_ids = [device['detector_id'] for device in result if device['detector_id']]
+    for detector_id in detector_ids:
+        if detector_ids.count(detector_id) > 1:
+            raise ValueError("More than one device has the detector ID %s" % detector_id)
+    return result
+
+
 def load_config(path):
     """Return a configuration dictionary containing the result of the merge of
      the default, built-in configuration and a YAML configuration file.
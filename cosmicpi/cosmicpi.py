@@ -25,20 +25,29 @@ julian.lewis lewis.julian@gmail.com 7/Apr/2016
 
 """
 
+import signal
 import sys
 import time
 import traceback
 import argparse
 import logging.config
 
-from config import load_config, print_config, arg
-from event_publisher import EventPublisher
+from config import load_config, print_config, arg, get_devices
+from event_publisher import EventPublisher, BatchingEventPublisher
 from usb_handler import UsbHandler
 from detector import Detector
+from sinks import Sinks
 from command_handler import CommandHandler
+from event_loop import EventLoop
+from metrics import registry, MetricsServer
+from log_index import index_handlers
+from log_queue import LogQueue, queue_handlers
+from profiling import Tracer
+from checkpoint import Checkpoint
 
 
 def main():
+    started = time.time()
     main_parser = argparse.ArgumentParser(prog="cosmicpi", description="CosmicPi acquisition process", add_help=False)
     main_parser.add_argument("--config", help="Path to configuration file", default="/etc/cosmicpi.yaml")
     args, remaining_argv = main_parser.parse_known_args()
@@ -55,14 +64,41 @@ def main():
     parser.add_argument("-a", "--username",   **arg("broker.username",      "Message broker username"))
     parser.add_argument("-b", "--password",   **arg("broker.password",      "Message broker password"))
     parser.add_argument("-n", "--no-publish", **arg("broker.enabled",       "Disable event publication"))
+    parser.add_argument("--raw-json",         **arg("broker.raw_json",      "Enable publishing events as JSON objects instead of JSON strings"))
+    parser.add_argument("--batch",            **arg("broker.batching",      "Enable batched publishing with publisher confirms"))
+    parser.add_argument("--batch-size",       **arg("broker.batch_size",    "Maximum number of events per batch", type=int))
+    parser.add_argument("--linger",           **arg("broker.linger",        "Maximum time in seconds an event waits for its batch", type=float))
+    parser.add_argument("--compression",      **arg("broker.compression",   "Compress batches of events with deflate or lz4, with --batch"))
+    parser.add_argument("--compression-level", **arg("broker.compression_level", "Compression level", type=int))
+    parser.add_argument("--delta",            **arg("broker.delta",         "Enable publishing only the sensors that changed between keyframes"))
+    parser.add_argument("--keyframe-interval", **arg("broker.keyframe_interval", "Seconds between full events with --delta", type=float))
     parser.add_argument("-u", "--usb",        **arg("usb.device",           "USB device name"))
+    parser.add_argument("--capture",          **arg("usb.capture",          "Record the raw serial input to a capture file"))
     parser.add_argument("-d", "--debug",      **arg("debug",                "Enable debug mode"))
     parser.add_argument("-o", "--log-config", **arg("logging.config",       "Path to logging configuration"))
     parser.add_argument("-l", "--no-log",     **arg("logging.enabled",      "Disable file logging"))
+    parser.add_argument("--async-log",        **arg("logging.asynchronous", "Enable logging from a background thread, dropping records if it falls behind"))
+    parser.add_argument("--no-log-index",     **arg("logging.index",        "Disable indexing of the event log"))
     parser.add_argument("-v", "--no-vib",     **arg("monitoring.vibration", "Disable vibration monitoring"))
     parser.add_argument("-w", "--no-weather", **arg("monitoring.weather",   "Disable weather monitoring"))
     parser.add_argument("-c", "--no-cosmics", **arg("monitoring.cosmics",   "Disable cosmic ray monitoring"))
     parser.add_argument("-k", "--patk",       **arg("patok",                "Server push notification token"))
+    parser.add_argument("-s", "--spool",      **arg("spool.directory",      "Directory for events spooled while the broker is unreachable"))
+    parser.add_argument("--no-spool",         **arg("spool.enabled",        "Disable event spooling"))
+    parser.add_argument("--archive",          **arg("archive.enabled",      "Enable the columnar event archive"))
+    parser.add_argument("--archive-dir",      **arg("archive.directory",    "Directory for the daily event archive files"))
+    parser.add_argument("--ring",             **arg("ring.enabled",         "Enable the shared memory event ring for local readers"))
+    parser.add_argument("--no-gps",           **arg("timing.gps",           "Disable GPS time for events, use the host clock"))
+    parser.add_argument("--analysis",         **arg("analysis.enabled",     "Enable live rate analysis of cosmic events (needs numpy)"))
+    parser.add_argument("--sensor-stats",     **arg("sensor_stats.enabled", "Enable rolling statistics of the sensor readings (needs numpy)"))
+    parser.add_argument("--checkpoint",       **arg("checkpoint.enabled",   "Enable saving the detector state to restore it on restart"))
+    parser.add_argument("--checkpoint-path",  **arg("checkpoint.path",      "Path to the checkpoint file"))
+    parser.add_argument("--socket",           **arg("commands.socket",      "Path to the command socket"))
+    parser.add_argument("-e", "--event-loop", **arg("event_loop.enabled",   "Enable single-threaded event loop mode"))
+    parser.add_argument("--overflow",         **arg("pipeline.overflow",    "Queue overflow policy (drop_oldest, block, spill)"))
+    parser.add_argument("--metrics-port",     **arg("metrics.port",         "Serve Prometheus metrics over HTTP on this port", type=int))
+    parser.add_argument("--trace",            **arg("profiling.enabled",    "Enable timing the stages of each event and tracing slow events"))
+    parser.add_argument("--trace-threshold",  **arg("profiling.slow_threshold", "Seconds above which an event is traced, with --trace", type=float))
 
     options = parser.parse_args()
 
@@ -71,42 +107,121 @@ def main():
     logging.config.fileConfig(log_config, disable_existing_loggers=False)
     console = logging.getLogger(__name__)
 
+    if options.logging['index']:
+        index_handlers(logging.getLogger('file'), options.logging['index_bucket'])
+
+    log_queue = None
+    if options.logging['asynchronous']:
+        # The event log ('file') is already written by its own sink thread
+        log_queue = LogQueue(options.logging['queue_size'])
+        for logger in (logging.getLogger(), logging.getLogger('pika')):
+            queue_handlers(logger, log_queue)
+        log_queue.start()
+
     if options.debug:
         print_config(options)
 
     try:
-        publisher = EventPublisher(options)
-    except:
-        console.error("Exception: Can't connect to broker")
-        sys.exit(1)
-
-    try:
-        usb = UsbHandler(options.usb['device'], 9600, 60)
-        usb.open()
-    except Exception as e:
-        console.error("Exception: Can't open USB device: %s" % e)
+        devices = get_devices(options)
+    except ValueError as e:
+        console.error("Exception: Invalid device configuration: %s" % e)
+        if log_queue is not None:
+            log_queue.stop()
         sys.exit(1)
 
-    detector = Detector(usb, publisher, options)
-
+    if options.event_loop['enabled']:
+        publisher = BatchingEventPublisher(options, threaded=False)
+    elif options.broker['batching']:
+        publisher = BatchingEventPublisher(options)
+    else:
+        if options.broker['compression']:
+            console.warn("Compression needs batched publishing (--batch), events are published uncompressed")
+        # With a spool, events are spooled until the publish thread connects
+        publisher = EventPublisher(options, connect=not options.spool['enabled'])
+
+    tracer = None
+    if options.profiling['enabled']:
+        tracer = Tracer(options.profiling['slow_threshold'], options.profiling['trace_file'],
+                        options.profiling['window'])
+
+    sinks = Sinks(publisher, options, tracer)
+    detectors = []
+    for device in devices:
+        try:
+            usb = UsbHandler(device['device'], 9600, 60, device['capture'],
+                             None if device['name'] is None else {'device': device['name']})
+            usb.open()
+        except Exception as e:
+            console.error("Exception: Can't open USB device %s: %s" % (device['device'], e))
+            if log_queue is not None:
+                log_queue.stop()
+            sys.exit(1)
+        detectors.append(Detector(usb, sinks, options, device['name'], device['detector_id'], device['monitoring'],
+                                  started))
+
+    checkpoint = None
+    if options.checkpoint['enabled']:
+        checkpoint = Checkpoint(options.checkpoint['path'], detectors,
+                                sinks.amqp.spool if sinks.amqp is not None else None,
+                                options.checkpoint['interval'], options.checkpoint['max_age'])
+        try:
+            checkpoint.restore()
+        except (IOError, OSError) as e:
+            console.error("Exception: Can't restore the checkpoint at %s: %s" % (options.checkpoint['path'], e))
+            checkpoint = None
+
+    metrics_server = None
+    if options.metrics['port']:
+        metrics_server = MetricsServer(registry, options.metrics['address'], options.metrics['port'])
+        metrics_server.start()
+
+    command_handler = None
     try:
-        detector.start()
-        command_handler = CommandHandler(detector, usb, options)
-        command_handler.start()
-
-        while True:
-            time.sleep(1)
+        command_handler = CommandHandler(detectors, options)
+
+        if options.event_loop['enabled']:
+            EventLoop(detectors, sinks, publisher, command_handler, options, checkpoint).run()
+        else:
+            sinks.start()
+            for detector in detectors:
+                detector.start()
+            command_handler.start()
+
+            # Stop through the finally clause below, which saves the checkpoint
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+            console.info("Started in %.3fs" % (time.time() - started))
+            while True:
+                time.sleep(1)
+                if checkpoint is not None:
+                    checkpoint.tick()
 
     except Exception as e:
         console.info("Exception: main: %s" % e)
         traceback.print_exc()
 
     finally:
-        detector.stop()
+        if command_handler is not None:
+            command_handler.stop()
+        for detector in detectors:
+            detector.stop()
+        sinks.stop()
         console.info("Quitting ...")
         time.sleep(1)
-        usb.close()
-        publisher.close()
+        for detector in detectors:
+            detector.usb.close()
+        if checkpoint is not None:
+            try:
+                checkpoint.save()
+            except (IOError, OSError) as e:
+                console.error("Exception: Can't save a checkpoint to %s: %s" % (options.checkpoint['path'], e))
+        if not options.event_loop['enabled']:
+            publisher.close()  # The event loop closes it when it stops
+        if tracer is not None:
+            tracer.close()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if log_queue is not None:
+            log_queue.stop()
         sys.exit(0)
 
 if __name__ == '__main__':
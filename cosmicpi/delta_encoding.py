@@ -0,0 +1,174 @@
+"""
+Delta encoding of published events.
+
+Every event carries a snapshot of all the sensor groups, although most of
+them rarely change between two events. With delta encoding, a full event (a
+keyframe) is published every keyframe_interval seconds, and in between only
+the sensor groups that changed since the previous event published:
+
+    {"detector_id": ..., "sequence": ..., "date": ..., "delta": 41,
+     "barometer": {...}, "event": {...}}
+
+delta is the sequence number of the previous event published, on which the
+delta builds. A group changes when one of its fields moves by more than its
+deadband from the value last published. The event group is only in the
+deltas of cosmic events. Weather events in which nothing changed aren't
+published at all.
+
+Keyframes are ordinary events, so consumers that only want full events can
+drop the records with a "delta" key. DeltaDecoder rebuilds every event.
+"""
+
+import json
+import time
+
+from event import Event
+from metrics import registry
+
+# Changes of a field up to its deadband are ignored. None means that changes of
+# the field alone don't count, the others are compared exactly.
+DEADBANDS = {
+    "temperature.temperature": 0.1,
+    "temperature.humidity": 0.5,
+    "barometer.temperature": 0.1,
+    "barometer.pressure": 0.1,
+    "barometer.altitude": 1.0,
+    "location.latitude": 0.0001,
+    "location.longitude": 0.0001,
+    "location.altitude": 5.0,
+    "timing.uptime": None,
+    "timing.time_string": None,
+    "timing.counter_frequency": 100,
+}
+
+
+class DeltaEncoder(object):
+    """Turn events into keyframes and deltas, and count the bytes saved."""
+
+    def __init__(self, keyframe_interval=60, deadbands=None, labels=None):
+        self.keyframe_interval = keyframe_interval
+        self.deadbands = dict(DEADBANDS)
+        self.deadbands.update(deadbands or {})
+
+        self.reference = None  # The sensor groups as last published
+        self.previous = None
+        self.next_keyframe = 0
+
+        self.keyframes = 0
+        self.deltas = 0
+        self.deduplicated = 0
+        self.full_bytes = 0
+        self.sent_bytes = 0
+
+        labels = labels or {}
+        for name, attr, help in (
+                ('cosmicpi_delta_keyframes_total', 'keyframes', 'Full events published as keyframes'),
+                ('cosmicpi_delta_deltas_total', 'deltas', 'Events published as deltas'),
+                ('cosmicpi_delta_deduplicated_total', 'deduplicated', 'Weather events not published, nothing changed'),
+                ('cosmicpi_delta_full_bytes_total', 'full_bytes', 'Bytes the events would take published in full'),
+                ('cosmicpi_delta_sent_bytes_total', 'sent_bytes', 'Bytes of the keyframes and deltas published')):
+            registry.counter(name, help, fn=lambda attr=attr: getattr(self, attr), **labels)
+        registry.gauge('cosmicpi_delta_savings_ratio', 'Fraction of the event bytes saved by delta encoding',
+                       fn=self.savings, **labels)
+
+    def encode(self, event, now=None):
+        """Return the message to publish for an event, or None to skip it."""
+        now = time.time() if now is None else now
+        full = event.to_json()
+
+        if self.reference is None or now >= self.next_keyframe:
+            self.reference = dict((group, getattr(event, group)) for group in Event.SENSORS)
+            self.next_keyframe = now + self.keyframe_interval
+            self.keyframes += 1
+            message = full
+        else:
+            changed = dict((group, getattr(event, group)) for group in Event.SENSORS
+                           if self.changed(group, getattr(event, group)))
+            if not changed and event.kind == 'weather' and event.summary is None:
+                self.deduplicated += 1
+                self.full_bytes += len(full)
+                return None
+
+            self.reference.update(changed)
+            record = {"detector_id": event.detector_id, "sequence": event.sequence, "date": event.date,
+                      "delta": self.previous}
+            record.update(changed)
+            if event.kind == 'cosmic' and event.event is not None:
+                record["event"] = event.event  # Only the cosmic events have their own
+            if event.summary is not None:
+                record["summary"] = event.summary
+            self.deltas += 1
+            message = json.dumps(record, separators=(',', ':'))
+
+        self.previous = event.sequence["number"]
+        self.full_bytes += len(full)
+        self.sent_bytes += len(message)
+        return message
+
+    def changed(self, group, values):
+        reference = self.reference.get(group)
+        if reference is values:
+            return False  # Sensors replaces a group wholesale when it changes
+        if reference is None or len(reference) != len(values):
+            return True
+
+        for field, value in values.items():
+            if field not in reference:
+                return True
+            last = reference[field]
+            if value == last:
+                continue
+            deadband = self.deadbands.get(group + "." + field, 0)
+            if deadband is None:
+                continue
+            try:
+                if abs(value - last) > deadband:
+                    return True
+            except TypeError:
+                return True  # Not a number
+        return False
+
+    def savings(self):
+        return 1.0 - float(self.sent_bytes) / self.full_bytes if self.full_bytes else 0.0
+
+    def stats(self):
+        return dict(keyframes=self.keyframes, deltas=self.deltas, deduplicated=self.deduplicated,
+                    full_bytes=self.full_bytes, sent_bytes=self.sent_bytes, savings=round(self.savings(), 3))
+
+
+class DeltaDecoder(object):
+    """Rebuild full events from keyframes and deltas, for consumers.
+
+    decode() takes a message body, JSON-encoded once or twice, or the decoded
+    record. It returns the full event, or None for a delta that can't be
+    applied because the record it builds on was missed. Decoding resumes
+    with the next keyframe.
+    """
+
+    def __init__(self):
+        self.state = {}  # detector_id: last event rebuilt
+        self.missed = 0
+
+    def decode(self, message):
+        record = message
+        while not isinstance(record, dict):
+            if isinstance(record, bytes):
+                record = record.decode('utf-8')
+            record = json.loads(record)
+
+        detector_id = record.get("detector_id")
+        if "delta" not in record:
+            self.state[detector_id] = record
+            return record
+
+        last = self.state.get(detector_id)
+        if last is None or last["sequence"]["number"] != record["delta"]:
+            self.missed += 1
+            self.state.pop(detector_id, None)
+            return None
+
+        # The event and summary groups are only those of the record they're in
+        event = dict((key, value) for key, value in last.items() if key not in ("event", "summary"))
+        event.update((key, value) for key, value in record.items() if key != "delta")
+        self.state[detector_id] = event
+        return event
@@ -1,33 +1,39 @@
-import json
 import logging
 import netifaces
+import os
 import threading
+import time
 
+from analysis import EventBuffer
+from delta_encoding import DeltaEncoder
 from event import Event
+from line_parser import LineParser
+from metrics import registry
+from pipeline import BoundedQueue
+from profiling import perf_counter_ns
+from rules import Rules
+from sensor_stats import SensorStats
+from timing import GPS, TICKS, Clock, monotonic_ns
 
-logfile = logging.getLogger('file')
 log = logging.getLogger(__name__)
 
 
 class Sensors(object):
-    def __init__(self):
-        self.temperature   = {"temperature": "0.0", "humidity": "0.0"}
-        self.barometer     = {"temperature": "0.0", "pressure": "0.0", "altitude": "0.0"}
-        self.vibration     = {"direction": "0", "count": "0"}
-        self.magnetometer  = {"x": "0.0", "y": "0.0", "z": "0.0"}
-        self.accelerometer = {"x": "0.0", "y": "0.0", "z": "0.0"}
-        self.location      = {"latitude": "0.0", "longitude": "0.0", "altitude": "0.0"}
-        self.timing        = {"uptime": "0", "counter_frequency": "0", "time_string": "0"}
-        self.status        = {"queue_size": "0", "missed_events": "0", "buffer_error": "0", "temp_status": "0",
-                              "baro_status": "0", "accel_status": "0", "mag_status": "0", "gps_status": "0"}
+    def __init__(self, labels=None):
+        self.temperature   = {"temperature": 0.0, "humidity": 0.0}
+        self.barometer     = {"temperature": 0.0, "pressure": 0.0, "altitude": 0.0}
+        self.vibration     = {"direction": 0, "count": 0}
+        self.magnetometer  = {"x": 0.0, "y": 0.0, "z": 0.0}
+        self.accelerometer = {"x": 0.0, "y": 0.0, "z": 0.0}
+        self.location      = {"latitude": 0.0, "longitude": 0.0, "altitude": 0.0}
+        self.timing        = {"uptime": 0, "counter_frequency": 0, "time_string": "0"}
+        self.status        = {"queue_size": 0, "missed_events": 0, "buffer_error": 0, "temp_status": 0,
+                              "baro_status": 0, "accel_status": 0, "mag_status": 0, "gps_status": 0}
+        self.parser = LineParser(labels)
 
     def update(self, line):
-        line = line.replace('\n', '')
-        line = line.replace('\'', '"')
-
-        try:
-            sensor = json.loads(line)
-        except:
+        sensor = self.parser.parse(line)
+        if not sensor:
             return  # Didn't understand, throw it away
 
         self.__dict__.update(sensor)
@@ -35,25 +41,113 @@ class Sensors(object):
 
 
 class Detector(object):
+    """One Arduino: its serial port, sensors, clock and event counters.
+
+    A process can run several detectors, which share the same Sinks. Each
+    one then has a name, used to address commands to it and as the device
+    label of its metrics, and its detector ID defaults to the MAC address
+    followed by the name. A detector on its own has no name.
+    """
+
+    # The sensor records restored from a checkpoint. The timing record is
+    # the Arduino's, which may have been reset since
+    RESTORED = ('temperature', 'barometer', 'vibration', 'magnetometer', 'accelerometer', 'location', 'status')
 
-    def __init__(self, usb, sio, options):
+    def __init__(self, usb, sinks, options, name=None, detector_id=None, monitoring=None, started=None):
         self.usb = usb
-        self.sio = sio
+        self.sinks = sinks
         self.options = options
+        self.name = name
+        self.labels = {} if name is None else {'device': name}
+        self.monitoring = options.monitoring if monitoring is None else monitoring
 
-        self.sensors = Sensors()
+        self.sensors = Sensors(self.labels)
+        self.clock = Clock(options.timing['gps'], options.timing['smoothing'], options.timing['step'])
 
-        self.detector_id = self.get_detector_id()
+        self.detector_id = detector_id or self.get_detector_id() + ('' if name is None else '-' + name)
 
-        self.thread = threading.Thread(target=self.run, args=(), kwargs={})
+        pipeline = options.pipeline
+        spill_dir = pipeline['spill_dir'] if name is None else os.path.join(pipeline['spill_dir'], name)
+        self.read_queue = BoundedQueue('read', pipeline['read_queue'], pipeline['overflow'], spill_dir)
+
+        suffix = '' if name is None else '-' + name
+        self.reader = threading.Thread(target=self.read, name='reader' + suffix, args=(), kwargs={})
+        self.reader.daemon = True
+        self.thread = threading.Thread(target=self.run, name='parser' + suffix, args=(), kwargs={})
         self.thread.daemon = True
         self.stopping = False
 
+        self.delta = None
+        if options.broker['delta']:
+            self.delta = DeltaEncoder(options.broker['keyframe_interval'], options.broker['deadbands'], self.labels)
+
+        self.rules = None
+        if options.rules:
+            self.rules = Rules(options.rules, self.labels)
+
+        self.sensor_stats = None
+        if options.sensor_stats['enabled']:
+            self.sensor_stats = SensorStats(options.sensor_stats['fields'], options.sensor_stats['resolutions'])
+
+        self.analysis = None
+        self.barometer_read = False  # Until then, the barometer reads 0
+        if options.analysis['enabled']:
+            self.analysis = EventBuffer(options.analysis['buffer_size'])
+
+        sinks.add_detector(self.detector_id, name)
+
+        # The stage timings of the line being processed, when tracing
+        self.tracer = sinks.tracer
+        self.spans = []
+
         self.events = 0
         self.vbrts = 0
         self.weathers = 0
 
         self.sequence_number = 0
+        self.run_number = None  # Numbered when restoring a checkpoint, see checkpoint.py
+
+        # Time from the process starting to the first event
+        self.started = time.time() if started is None else started
+        self.first_event = None
+
+        self.event_latency = registry.histogram('cosmicpi_event_latency_seconds',
+                                                'Time from reading a serial line to queueing its event', **self.labels)
+        self.register_metrics()
+
+    def register_metrics(self):
+        labels = self.labels
+        for name, attr in (('cosmic', 'events'), ('vibration', 'vbrts'), ('weather', 'weathers')):
+            registry.counter('cosmicpi_events_total', 'Events detected, by type',
+                             fn=lambda attr=attr: getattr(self, attr), type=name, **labels)
+
+        queue = self.read_queue
+        registry.gauge('cosmicpi_queue_depth', 'Items waiting in a pipeline queue',
+                       fn=lambda: len(queue), queue=queue.name, **labels)
+        registry.counter('cosmicpi_queue_drops_total', 'Items dropped by a full pipeline queue',
+                         fn=lambda: queue.drops, queue=queue.name, **labels)
+        registry.gauge('cosmicpi_first_event_seconds', 'Time from the process starting to the first event',
+                       fn=lambda: self.first_event or 0.0, **labels)
+
+        status = lambda field: lambda: self.sensors.status[field]
+        registry.gauge('cosmicpi_arduino_missed_events', 'Events missed by the Arduino, as last reported',
+                       fn=status('missed_events'), **labels)
+        registry.gauge('cosmicpi_arduino_queue_size', 'Events queued on the Arduino, as last reported',
+                       fn=status('queue_size'), **labels)
+
+        clock = self.clock
+        registry.gauge('cosmicpi_clock_offset_seconds', 'Offset of the host clock from GPS time',
+                       fn=lambda: clock.offset or 0.0, **labels)
+        registry.gauge('cosmicpi_clock_drift_ppm', 'Drift of the host clock from GPS time',
+                       fn=lambda: clock.drift, **labels)
+        registry.gauge('cosmicpi_counter_frequency_hz', 'Counter ticks in the last second, from the Arduino',
+                       fn=lambda: clock.frequency or 0, **labels)
+        registry.gauge('cosmicpi_counter_frequency_error_ppm', 'Deviation of the counter frequency from its average',
+                       fn=lambda: clock.frequency_error, **labels)
+        registry.gauge('cosmicpi_clock_gps', 'Whether event times come from GPS time',
+                       fn=lambda: int(clock.source == GPS), **labels)
+        registry.counter('cosmicpi_clock_steps_total', 'Jumps of the host clock from GPS time',
+                         fn=lambda: clock.steps, **labels)
 
     def get_next_sequence(self):
         self.sequence_number += 1
@@ -61,59 +155,187 @@ class Detector(object):
 
     def start(self):
         self.thread.start()
+        self.reader.start()
 
-    def run(self):
+    def read(self):
+        """Drain the serial port into the read queue as fast as lines arrive."""
         while not self.stopping:
             line = self.usb.readline()
-            self.sio.connection.process_data_events()
+            if line:
+                self.read_queue.put((monotonic_ns(), line))
 
-            sensor = self.sensors.update(line)
-            if not sensor:
-                continue
+    def run(self):
+        while not self.stopping:
+            item = self.read_queue.get(1)
+            if item is not None:
+                received, line = item
+                self.process_line(line, received)
+            if self.rules is not None:
+                self.emit_summaries()
 
-            if self.options.monitoring['vibration'] and 'vibration' in sensor:
-                evt = Event(self.detector_id, self.get_next_sequence(), self.sensors)
-                self.vbrts += 1
-                log.info("Vibration event: %s" % evt)
-                self.handle_event(evt)
-                continue
+    def process_line(self, line, received=None):
+        """Parse a serial line, received at the given host monotonic time in
+        ns, and emit an event if it triggers one.
+        """
+        received = monotonic_ns() if received is None else received
+        if self.tracer is None:
+            self.parse_line(line, received)
+            return
 
-            if self.options.monitoring['weather'] and 'temperature' in sensor:
-                evt = Event(self.detector_id, self.get_next_sequence(), self.sensors)
-                self.weathers += 1
-                log.info("Weather event: %s" % evt)
-                self.handle_event(evt)
-                continue
+        self.spans = [('read', monotonic_ns() - received)]
+        evt = self.parse_line(line, received)
+        self.tracer.event(evt, self.spans)
+
+    def parse_line(self, line, received):
+        """Parse a serial line, return the event it triggered, if any."""
+        tracer = self.tracer
+        start = perf_counter_ns() if tracer is not None else 0
+        sensor = self.sensors.update(line)
+        if tracer is not None:
+            self.spans.append(('parse', perf_counter_ns() - start))
+        if not sensor:
+            return None
+
+        if self.sensor_stats is not None:
+            self.sensor_stats.update(sensor, time.time())
+        if 'barometer' in sensor:
+            self.barometer_read = True
+
+        if 'timing' in sensor:
+            self.clock.update(sensor['timing'], received, self.sensors.status.get('gps_status'))
+
+        rules = self.rules
+        if self.monitoring['vibration'] and 'vibration' in sensor:
+            if rules is not None and not rules.accept('vibration', self.sensors):
+                return None
+            evt = self.new_event('vibration', received)
+            self.vbrts += 1
+            self.log_event("Vibration event: %s", evt)
+            self.handle_event(evt)
+            return evt
+
+        if self.monitoring['weather'] and 'temperature' in sensor:
+            if rules is not None and not rules.accept('weather', self.sensors):
+                return None
+            evt = self.new_event('weather', received)
+            self.weathers += 1
+            self.log_event("Weather event: %s", evt)
+            self.handle_event(evt)
+            return evt
+
+        if self.monitoring['cosmics'] and 'event' in sensor:
+            if rules is not None and not rules.accept('cosmic', self.sensors):
+                return None
+            record = sensor['event']
+            evt = self.new_event('cosmic', received, record.get(TICKS) if isinstance(record, dict) else None)
+            self.events += 1
+            self.log_event("Cosmic event: %s", evt)
+            self.handle_event(evt)
+            return evt
+
+        if self.options.debug:
+            log.debug(sensor)
+        return None
+
+        # else:
+        #     ts = time.strftime("%d/%b/%Y %H:%M:%S", time.gmtime(time.time()))
+        #     tim = evt.timing
+        #     sts = evt.status
+        #     s = "cosmic_pi:uptime:%s :queue_size:%s time_string:[%s] %s    \r" % (
+        #     tim["uptime"], sts["queue_size"], ts, tim["time_string"])
+        #     sys.stdout.write(s)
+        #     sys.stdout.flush()
 
-            if self.options.monitoring['cosmics'] and 'event' in sensor:
-                evt = Event(self.detector_id, self.get_next_sequence(), self.sensors)
+    def new_event(self, kind, received, ticks=None):
+        start = perf_counter_ns() if self.tracer is not None else 0
+        timestamp, source = self.clock.timestamp(ticks, received)
+        event = Event(self.detector_id, self.get_next_sequence(), self.sensors, kind, timestamp, source, received,
+                      self.run_number)
+        if self.tracer is not None:
+            self.spans.append(('build', perf_counter_ns() - start))
+        return event
+
+    def emit_summaries(self):
+        """Emit an event for each aggregate rule window that ended."""
+        for kind, summary in self.rules.due():
+            evt = self.new_event(kind, monotonic_ns())
+            evt.summary = summary
+            if kind == 'cosmic':
                 self.events += 1
-                log.info("Cosmic event: %s" % evt)
-                self.handle_event(evt)
-                continue
-
-            if self.options.debug:
-                log.debug(sensor)
-
-            # else:
-            #     ts = time.strftime("%d/%b/%Y %H:%M:%S", time.gmtime(time.time()))
-            #     tim = evt.timing
-            #     sts = evt.status
-            #     s = "cosmic_pi:uptime:%s :queue_size:%s time_string:[%s] %s    \r" % (
-            #     tim["uptime"], sts["queue_size"], ts, tim["time_string"])
-            #     sys.stdout.write(s)
-            #     sys.stdout.flush()
+            elif kind == 'vibration':
+                self.vbrts += 1
+            else:
+                self.weathers += 1
+            self.log_event("Summary of %s events: %s", kind, evt)
+            self.handle_event(evt)
+
+    def log_event(self, message, *args):
+        if self.tracer is None:
+            log.info(message, *args)
+            return
+        start = perf_counter_ns()
+        log.info(message, *args)
+        self.spans.append(('log', perf_counter_ns() - start))
 
     def stop(self):
-        log.info("Stopping detector thread")
+        log.info("Stopping detector threads")
         self.stopping = True
-        self.thread.join()
+        for thread in (self.reader, self.thread):
+            if thread.is_alive():
+                thread.join(2)
+        self.read_queue.close()
 
     def handle_event(self, event):
+        tracer = self.tracer
+        start = perf_counter_ns() if tracer is not None else 0
+        text = event.to_json()
+        message = None
         if self.options.broker['enabled']:
-            self.sio.send_event_pkt(event.to_json())
-        if self.options.logging['enabled']:
-            logfile.info(event.to_json())
+            message = text if self.delta is None else self.delta.encode(event)
+        if tracer is not None:
+            serialized = perf_counter_ns()
+            self.spans.append(('serialize', serialized - start))
+        self.sinks.handle(event, text, message)
+        if tracer is not None:
+            self.spans.append(('dispatch', perf_counter_ns() - serialized))
+        if self.analysis is not None and event.kind == 'cosmic':
+            self.analysis.append(event.timestamp, self.pressure(event))
+        if event.received is not None:
+            self.event_latency.observe((monotonic_ns() - event.received) / 1e9)
+        if self.first_event is None:
+            self.first_event = time.time() - self.started
+            log.info("First event %.3fs after the process started" % self.first_event)
+
+    def pressure(self, event):
+        """Return the pressure of an event for the analysis, NaN until the
+        barometer has reported or while the Arduino reports it not working,
+        rather than the 0 the sensors start with.
+        """
+        if not self.barometer_read or not self.sensors.status.get('baro_status'):
+            return float('nan')
+        return event.barometer.get('pressure')
+
+    def state(self):
+        """Return what a checkpoint saves of the detector."""
+        return dict(sequence=self.sequence_number, run=self.run_number, events=self.events, vbrts=self.vbrts,
+                    weathers=self.weathers, sensors=dict((record, getattr(self.sensors, record))
+                                                         for record in self.RESTORED))
+
+    def restore(self, state, sensors=True):
+        """Continue from a checkpoint in a new run, with the last sensor
+        values if they're recent enough.
+        """
+        self.sequence_number = state['sequence']
+        self.run_number = (state.get('run') or 0) + 1
+        self.events, self.vbrts, self.weathers = state['events'], state['vbrts'], state['weathers']
+        if sensors:
+            for record, values in state['sensors'].items():
+                if record in self.RESTORED:
+                    setattr(self.sensors, str(record), dict((str(field), value) for field, value in values.items()))
+
+    def pipeline_stats(self):
+        """Return the depth and drop counters of each pipeline queue."""
+        return [(self.read_queue.name, self.read_queue.stats())] + self.sinks.pipeline_stats()
 
     def get_detector_id(self):
         """Retrieve the unique identifier of this detector.
@@ -0,0 +1,166 @@
+"""
+Compressed batch envelopes for the event stream.
+
+With broker.compression, the batching publisher packs the events waiting to
+be published into one message: up to broker.batch_size events, or those that
+arrived within the linger time. The envelope holds the event messages, as
+they would have been published one by one, one per line, compressed with
+zlib ("deflate") or LZ4 ("lz4"). The message properties describe it:
+
+    content_type:     application/x-ndjson
+    content_encoding: deflate or lz4
+    headers:          {"events": 100, "dictionary": "cosmicpi-1"}
+
+Both compressors are primed with a dictionary of the text every event
+contains, which matters most for small batches. The dictionary is named in
+the headers, so that it can be changed without breaking consumers. zlib
+only supports dictionaries from Python 3.3 on, older Pythons compress
+without one and leave the header out.
+
+Consumers unpack an envelope with decode().
+"""
+
+import json
+import time
+import zlib
+
+from metrics import registry
+
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
+DEFLATE = 'deflate'
+LZ4 = 'lz4'
+ENCODINGS = (DEFLATE, LZ4)
+
+CONTENT_TYPE = 'application/x-ndjson'
+
+# A typical event. Never change it, add a new dictionary instead.
+SAMPLE = ('{"detector_id":"b8:27:eb:00:00:00","sequence":{"number":1},'
+          '"date":{"date":"Thu Jan  1 00:00:00 1970","timestamp":0.0,"source":"gps"},'
+          '"temperature":{"temperature":21.3,"humidity":45.0},'
+          '"barometer":{"temperature":21.5,"pressure":1013.25,"altitude":120.0},'
+          '"vibration":{"direction":0,"count":0},'
+          '"magnetometer":{"x":0.0,"y":0.0,"z":0.0},'
+          '"accelerometer":{"x":0.0,"y":0.0,"z":1.0},'
+          '"location":{"latitude":46.2,"longitude":6.1,"altitude":430.0},'
+          '"timing":{"uptime":1,"counter_frequency":42000000,"time_string":"00:00:00"},'
+          '"status":{"queue_size":0,"missed_events":0,"buffer_error":0,"temp_status":1,'
+          '"baro_status":1,"accel_status":1,"mag_status":1,"gps_status":1},'
+          '"event":{"evt":1,"ticks":0},"delta":0}')
+
+# Events are JSON-encoded again unless broker.raw_json is set, so the escaped
+# form, the default, goes last where zlib finds it fastest.
+DICTIONARY_NAME = 'cosmicpi-1'
+DICTIONARIES = {DICTIONARY_NAME: (SAMPLE + json.dumps(SAMPLE)).encode('utf-8')}
+
+try:
+    zlib.compressobj(zdict=b'x')
+    ZDICT = True
+except TypeError:
+    ZDICT = False
+
+
+def require_lz4():
+    if lz4 is None:
+        raise ImportError("LZ4 compression requires the lz4 package, install cosmicpi[lz4]")
+
+
+def to_bytes(message):
+    return message if isinstance(message, bytes) else message.encode('utf-8')
+
+
+class Compressor(object):
+    """Pack event messages into compressed envelopes.
+
+    level is the zlib level (1-9). For LZ4, levels up to 3 use the default
+    mode, higher ones the high compression mode at that level.
+    """
+
+    def __init__(self, encoding=DEFLATE, level=6, dictionary=True):
+        if encoding not in ENCODINGS:
+            raise ValueError("Unknown compression: %s, use one of %s" % (encoding, ", ".join(ENCODINGS)))
+        if encoding == LZ4:
+            require_lz4()
+        self.encoding = encoding
+        self.level = level
+        self.dictionary = DICTIONARIES[DICTIONARY_NAME] if dictionary and (encoding == LZ4 or ZDICT) else None
+
+        self.batches = 0
+        self.events = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+        for name, attr, help in (
+                ('cosmicpi_compressed_batches_total', 'batches', 'Compressed batches of events published'),
+                ('cosmicpi_compression_input_bytes_total', 'input_bytes', 'Bytes of the events before compression'),
+                ('cosmicpi_compression_output_bytes_total', 'output_bytes', 'Bytes of the compressed batches')):
+            registry.counter(name, help, fn=lambda attr=attr: getattr(self, attr))
+        registry.gauge('cosmicpi_compression_ratio', 'Bytes of the events per compressed byte', fn=self.ratio)
+        self.compress_time = registry.histogram('cosmicpi_compress_seconds', 'Time taken to compress a batch')
+
+    def compress(self, messages):
+        """Return the envelope of a list of event messages, and its headers."""
+        start = time.time()
+        data = b'\n'.join(to_bytes(message) for message in messages)
+
+        if self.encoding == LZ4:
+            options = dict(mode='high_compression', compression=self.level) if self.level > 3 else {}
+            if self.dictionary is not None:
+                options['dict'] = self.dictionary
+            body = lz4.block.compress(data, **options)
+        else:
+            if self.dictionary is not None:
+                compressor = zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS, zdict=self.dictionary)
+            else:
+                compressor = zlib.compressobj(self.level)
+            body = compressor.compress(data) + compressor.flush()
+
+        self.compress_time.observe(time.time() - start)
+        self.batches += 1
+        self.events += len(messages)
+        self.input_bytes += len(data)
+        self.output_bytes += len(body)
+
+        headers = {'events': len(messages)}
+        if self.dictionary is not None:
+            headers['dictionary'] = DICTIONARY_NAME
+        return body, headers
+
+    def ratio(self):
+        return float(self.input_bytes) / self.output_bytes if self.output_bytes else 0.0
+
+    def stats(self):
+        return dict(batches=self.batches, input_bytes=self.input_bytes, output_bytes=self.output_bytes,
+                    ratio=round(self.ratio(), 2))
+
+
+def decode(body, content_encoding=None, headers=None):
+    """Return the event messages of a message body, given its content
+    encoding and headers. Bodies that aren't compressed are returned as is,
+    as a single message.
+    """
+    headers = headers or {}
+    name = headers.get('dictionary')
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    if name is not None and name not in DICTIONARIES:
+        raise ValueError("Unknown compression dictionary: %s" % name)
+    dictionary = DICTIONARIES.get(name)
+
+    if content_encoding == DEFLATE:
+        if dictionary is not None and not ZDICT:
+            raise ValueError("This version of Python can't decompress with a dictionary")
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary is not None else zlib.decompressobj()
+        data = decompressor.decompress(body) + decompressor.flush()
+    elif content_encoding == LZ4:
+        require_lz4()
+        data = lz4.block.decompress(body, dict=dictionary) if dictionary is not None else lz4.block.decompress(body)
+    elif content_encoding in (None, 'identity'):
+        return [body.decode('utf-8') if isinstance(body, bytes) else body]
+    else:
+        raise ValueError("Unknown content encoding: %s" % content_encoding)
+
+    return [line.decode('utf-8') for line in data.split(b'\n')] if data else []
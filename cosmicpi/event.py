@@ -2,14 +2,58 @@ import json
 
 import time
 
+from timing import HOST, asctime
+
 
 class Event(object):
+    """A snapshot of the detector's sensors at the time of an event.
+
+    The sensor dicts are shared with the Sensors object rather than copied,
+    which is safe because Sensors replaces a dict wholesale when a new record
+    arrives. The event is serialized once, on the first call to to_json(), and
+    the same string is handed to every sink. The kind of event and the host
+    monotonic time its line was received at (in ns) are kept for the sinks,
+    but aren't part of the record.
+
+    The time of the event, and the source of that time (see timing.py), are
+    given by the detector's clock. They're published in the date, along with
+    the UTC date as formatted by time.asctime().
+
+    Only cosmic events have the event record: the last one the Arduino sent
+    stays in the sensors, and would otherwise be repeated in every later
+    weather and vibration event.
+
+    Events emitted by an aggregate rule (see rules.py) carry the statistics of
+    the events they replace in their summary. With checkpoints, the sequence
+    also has the run of the detector (see checkpoint.py).
+    """
+
+    __slots__ = ('detector_id', 'sequence', 'kind', 'timestamp', 'received', 'date', 'temperature', 'barometer', 'vibration', 'magnetometer',
+                 'accelerometer', 'location', 'timing', 'status', 'event', 'summary', 'serialized')
 
-    def __init__(self, detector_id, sequence_number, sensors):
+    SENSORS = ('temperature', 'barometer', 'vibration', 'magnetometer', 'accelerometer', 'location', 'timing',
+               'status')
+
+    def __init__(self, detector_id, sequence_number, sensors, kind=None, timestamp=None, source=HOST, received=None,
+                 run_number=None):
         self.detector_id = detector_id
-        self.sequence = {"number": sequence_number}
-        self.date = {"date": time.asctime(time.gmtime(time.time()))}
-        self.__dict__.update(sensors.__dict__)
+        self.sequence = ({"number": sequence_number} if run_number is None else
+                         {"number": sequence_number, "run": run_number})
+        self.kind = kind
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.received = received
+        self.date = {"date": asctime(self.timestamp), "timestamp": self.timestamp, "source": source}
+        self.temperature = sensors.temperature
+        self.barometer = sensors.barometer
+        self.vibration = sensors.vibration
+        self.magnetometer = sensors.magnetometer
+        self.accelerometer = sensors.accelerometer
+        self.location = sensors.location
+        self.timing = sensors.timing
+        self.status = sensors.status
+        self.event = getattr(sensors, 'event', None) if kind == 'cosmic' else None
+        self.summary = None
+        self.serialized = None
 
     def __str__(self):
         return """
@@ -26,11 +70,39 @@ class Event(object):
         Status........: %s
         Event.........: %s
         """ % (self.detector_id, self.sequence, self.barometer, self.temperature, self.location,
-               self.vibration, self.accelerometer, self.magnetometer, self.timing, self.status,
-               self.event if 'event' in self.__dict__ else None)
+               self.vibration, self.accelerometer, self.magnetometer, self.timing, self.status, self.event)
+
+    def to_dict(self):
+        result = {"detector_id": self.detector_id, "sequence": self.sequence, "date": self.date}
+        for name in self.SENSORS:
+            result[name] = getattr(self, name)
+        if self.event is not None:
+            result["event"] = self.event
+        if self.summary is not None:
+            result["summary"] = self.summary
+        return result
 
     def to_json(self, pretty=False):
         if pretty:
-            return json.dumps(self.__dict__, sort_keys=True, indent=4, separators=(',', ': '))
-        else:
-            return json.dumps(self.__dict__)
+            return json.dumps(self.to_dict(), sort_keys=True, indent=4, separators=(',', ': '))
+        if self.serialized is None:
+            self.serialized = json.dumps(self.to_dict(), separators=(',', ':'))
+        return self.serialized
+
+
+def infer_kind(record, previous):
+    """Return the kind of a logged event that doesn't say it, or None.
+
+    Only cosmic events have an event record, but logs written before that
+    repeat the last one in every later event, so an event record is only
+    taken for a cosmic event if it differs from the previous one of the same
+    detector. previous maps each detector ID to the event record of its last
+    line, and is updated. Weather and vibration events can't be told apart.
+    """
+    detector_id = record.get('detector_id')
+    event = record.get('event')
+    last = previous.get(detector_id)
+    previous[detector_id] = event
+    if event is None or 'summary' in record or event == last:
+        return None
+    return 'cosmic'
@@ -0,0 +1,153 @@
+import logging
+import signal
+
+from pika.adapters.select_connection import READ, WRITE
+
+from timing import monotonic_ns
+
+log = logging.getLogger(__name__)
+
+
+class EventLoop(object):
+    """Run acquisition, publishing and commands on a single thread.
+
+    The serial port and the command socket are registered as handlers on the
+    batching publisher's pika ioloop, so serial input, broker I/O (including
+    heartbeats) and commands are multiplexed by one select loop instead of
+    separate threads. Periodic work such as replaying the spool and logging a
+    status line runs off ioloop timers. If the publisher falls behind, events
+    go to the spool rather than stalling the serial read. The serial ports of
+    all the detectors are watched by the same loop.
+    """
+
+    def __init__(self, detectors, sinks, publisher, command_handler, options, checkpoint=None):
+        self.detectors = detectors
+        self.sinks = sinks
+        self.publisher = publisher
+        self.command_handler = command_handler
+        self.checkpoint = checkpoint
+        self.ioloop = publisher.ioloop
+        self.status_interval = options.event_loop['status_interval']
+
+        self.serial_fds = {}  # Detector: file descriptor of its open serial port
+        self.command_socket = None
+        self.stopping = False
+
+    def run(self):
+        """Run the loop until SIGINT or SIGTERM is received, which closes the
+        publisher. The caller is responsible for stopping the detector and
+        closing the port afterwards.
+        """
+        signal.signal(signal.SIGINT, self.on_signal)
+        signal.signal(signal.SIGTERM, self.on_signal)
+
+        self.sinks.start_inline()
+
+        self.command_socket = self.command_handler.open_socket()
+        self.ioloop.add_handler(self.command_socket.fileno(), self.on_command_connection, READ)
+
+        for detector in self.detectors:
+            self.watch_serial(detector)
+        self.ioloop.add_timeout(1, self.on_tick)
+        self.ioloop.add_timeout(1, self.on_push)
+        if self.status_interval:
+            self.ioloop.add_timeout(self.status_interval, self.on_status)
+
+        log.info("Running in event loop mode")
+        self.publisher.run()
+
+    def on_signal(self, signum, frame):
+        self.ioloop.add_callback_threadsafe(self.stop)
+
+    def stop(self):
+        if self.stopping:
+            return
+        log.info("Stopping event loop")
+        self.stopping = True
+        for detector in self.detectors:
+            self.unwatch_serial(detector)
+        self.ioloop.remove_handler(self.command_socket.fileno())
+        self.command_socket.close()
+        self.publisher.close()
+
+    def watch_serial(self, detector):
+        if detector.usb.is_open and detector not in self.serial_fds:
+            self.serial_fds[detector] = detector.usb.fileno()
+            self.ioloop.add_handler(self.serial_fds[detector],
+                                    lambda fd, events: self.on_serial(detector), READ)
+
+    def unwatch_serial(self, detector):
+        if detector in self.serial_fds:
+            self.ioloop.remove_handler(self.serial_fds.pop(detector))
+
+    def on_serial(self, detector):
+        received = monotonic_ns()
+        for line in detector.usb.read_lines():
+            detector.process_line(line, received)
+
+        if not detector.usb.is_open:
+            self.unwatch_serial(detector)
+
+    def on_tick(self):
+        """Once a second: reopen the serial ports if needed, emit the ended
+        aggregate rule windows, replay the spool and save a checkpoint.
+        """
+        if self.stopping:
+            return
+
+        for detector in self.detectors:
+            if detector.rules is not None:
+                detector.emit_summaries()
+            usb = detector.usb
+            if usb.is_open:
+                usb.check_timeout()
+            if not usb.is_open:
+                self.unwatch_serial(detector)
+                if usb.enabled and usb.reopen():
+                    self.watch_serial(detector)
+
+        self.sinks.publish_idle()
+        if self.checkpoint is not None:
+            self.checkpoint.tick()
+        self.ioloop.add_timeout(1, self.on_tick)
+
+    def on_status(self):
+        if self.stopping:
+            return
+        log.info("Events:%d Vibration:%d Weather:%d Publisher: %s" % (
+            sum(detector.events for detector in self.detectors), sum(detector.vbrts for detector in self.detectors),
+            sum(detector.weathers for detector in self.detectors), self.publisher.stats()))
+        self.ioloop.add_timeout(self.status_interval, self.on_status)
+
+    def on_push(self):
+        """Send status changes to subscribed command connections."""
+        if self.stopping:
+            return
+        next_due = self.command_handler.push_updates()
+        for connection in list(self.command_handler.connections.values()):
+            if connection.wants_write():
+                self.ioloop.update_handler(connection.fileno(), READ | WRITE)
+        self.ioloop.add_timeout(1 if next_due is None else min(next_due, 1), self.on_push)
+
+    def on_command_connection(self, fd, events):
+        connection = self.command_handler.accept(self.command_socket)
+        if connection is not None:
+            self.ioloop.add_handler(connection.fileno(),
+                                    lambda fd, events: self.on_command(connection, events), READ)
+
+    def on_command(self, connection, events):
+        alive = True
+        if events & READ:
+            alive = connection.on_readable()
+        if alive and events & WRITE:
+            alive = connection.on_writable()
+
+        if not alive:
+            self.ioloop.remove_handler(connection.fileno())
+            self.command_handler.disconnect(connection)
+        else:
+            self.ioloop.update_handler(connection.fileno(), READ | (WRITE if connection.wants_write() else 0))
+
+        for detector in self.detectors:
+            if not detector.usb.is_open:
+                self.unwatch_serial(detector)  # The port was disabled by a command
@@ -1,34 +1,380 @@
+import collections
 import json
 import logging
+import socket
+import threading
+import time
 
 import pika
-from pika.exceptions import ConnectionClosed, ProbableAuthenticationError
+from pika.adapters.select_connection import IOLoop
+from pika.exceptions import AMQPError, ProbableAuthenticationError
+
+from envelope import CONTENT_TYPE, Compressor
+from metrics import registry
 
 log = logging.getLogger(__name__)
 
 
 class EventPublisher(object):
-    """Publish events"""
+    """Publish events
+
+    Events are handed over already serialized. For compatibility with existing
+    consumers they are JSON-encoded again, so the message body is a JSON
+    string; with broker.raw_json the serialized event is published as is.
+
+    Without connect, the first connection is left to the spool drainer, so
+    that the process doesn't wait for the broker before reading events.
+    """
+
+    def __init__(self, options, connect=True):
+        self.host = options.broker["host"]
+        self.port = options.broker["port"]
+        self.username = options.broker["username"]
+        self.password = options.broker["password"]
+        self.raw_json = options.broker["raw_json"]
+        self.properties = pika.BasicProperties(content_type='application/json')
 
-    def __init__(self, options):
-        host = options.broker["host"]
-        port = options.broker["port"]
-        username = options.broker["username"]
-        password = options.broker["password"]
+        self.connection = None
+        self.channel = None
+        self.published = 0
+        self.connects = 0
 
+        registry.counter('cosmicpi_published_total', 'Events published to the broker', fn=lambda: self.published)
+        registry.counter('cosmicpi_broker_connects_total', 'Connections established to the broker',
+                         fn=lambda: self.connects)
+
+        if connect and not self.connect():
+            if options.spool["enabled"]:
+                log.warn("Events will be spooled until the broker becomes reachable")
+            else:
+                log.warn("Events will be dropped until the broker becomes reachable")
+
+    @property
+    def connected(self):
+        return self.connection is not None and self.connection.is_open
+
+    def connect(self):
+        """(Re)connect to the broker. Returns True if the connection succeeded."""
         try:
             self.connection = pika.BlockingConnection(
-                pika.ConnectionParameters(host=host, port=port, credentials=pika.PlainCredentials(username, password)))
+                pika.ConnectionParameters(host=self.host, port=self.port,
+                                          credentials=pika.PlainCredentials(self.username, self.password)))
             self.channel = self.connection.channel()
-            self.channel.exchange_declare(exchange='events', type='fanout')
-        except (ConnectionClosed, ProbableAuthenticationError) as e:
-            log.error("Fatal: Couldn't establish a connection to the broker. Please check the connection parameters.")
-            log.error("Fatal: Connection parameters were: %s:%s@%s:%s" % (username, password, host, port))
-            raise e
+            self.channel.exchange_declare(exchange='events', exchange_type='fanout')
+            self.connects += 1
+            log.info("Connected to broker at %s:%s" % (self.host, self.port))
+            return True
+        except ProbableAuthenticationError:
+            log.error("Couldn't authenticate with the broker. Please check the connection parameters.")
+            log.error("Connection parameters were: %s:%s@%s:%s" % (self.username, self.password, self.host, self.port))
+        except (AMQPError, socket.error) as e:
+            log.error("Couldn't establish a connection to the broker at %s:%s: %s" % (self.host, self.port, e))
+        self.connection = None
+        return False
+
+    def send_event_pkt(self, pkt):
+        if not self.connected:
+            raise IOError("Not connected to the broker")
+
+        try:
+            self.channel.basic_publish(exchange='events', routing_key='', body=pkt if self.raw_json else json.dumps(pkt),
+                                       properties=self.properties)
+            self.published += 1
+        except (AMQPError, socket.error):
+            self.connection = None
+            raise
+
+    def process_data_events(self):
+        if not self.connected:
+            return
+        try:
+            self.connection.process_data_events()
+        except (AMQPError, socket.error) as e:
+            log.warn("Lost connection to the broker: %s" % e)
+            self.connection = None
+
+    def wait_settled(self, timeout):
+        """Events are handed to the broker as they're sent."""
+        return True
+
+    def stats(self):
+        return dict(published=self.published)
+
+    def close(self):
+        if self.connected:
+            self.connection.close()
+
+
+class BatchingEventPublisher(object):
+    """Publish events in batches over an asynchronous connection, using
+    publisher confirms to track delivery.
+
+    Events are queued by send_event_pkt() and published from the pika
+    ioloop, either when max_batch events are waiting or
+    after the linger time, whichever comes first. Published events are kept
+    until the broker confirms them. Nacked events, and events that haven't
+    been confirmed within the confirm timeout, are published again, as is
+    everything unconfirmed when the connection is re-established.
+
+    send_event_pkt() raises IOError when the broker is unreachable or more
+    than max_in_flight events are outstanding, so that the caller can spool
+    them instead.
+
+    With broker.compression, the events waiting are published together as
+    one compressed message of up to max_batch events (see envelope.py), and
+    confirmed, or published again, as a whole.
+
+    By default the ioloop runs on its own I/O thread. When threaded is False,
+    the caller is expected to run it with run(), which is how the event loop
+    mode multiplexes its other file descriptors on the same loop.
+    """
+
+    def __init__(self, options, threaded=True):
+        self.host = options.broker["host"]
+        self.port = options.broker["port"]
+        self.username = options.broker["username"]
+        self.password = options.broker["password"]
+        self.raw_json = options.broker["raw_json"]
+        self.max_batch = options.broker["batch_size"]
+        self.linger = options.broker["linger"]
+        self.max_in_flight = options.broker["max_in_flight"]
+        self.confirm_timeout = options.broker["confirm_timeout"]
+        self.retry_interval = options.spool["retry_interval"]
+
+        self.properties = pika.BasicProperties(content_type='application/json')
+        self.compressor = None
+        if options.broker["compression"]:
+            self.compressor = Compressor(options.broker["compression"], options.broker["compression_level"],
+                                         options.broker["dictionary"])
+
+        self.lock = threading.Lock()
+        self.settled = threading.Condition(self.lock)  # Notified when every event is confirmed
+        self.pending = collections.deque()
+        self.unconfirmed = collections.OrderedDict()  # Delivery tag: (events, time published)
+        self.unconfirmed_events = 0
+        self.delivery_tag = 0
+        self.flush_scheduled = False
+
+        self.published = 0
+        self.confirmed = 0
+        self.nacked = 0
+        self.retried = 0
+        self.connects = 0
+        self.register_metrics()
+
+        self.ioloop = IOLoop()
+        self.io_thread = None
+        self.connection = None
+        self.channel = None
+        self.ready = False
+        self.reconnect_scheduled = False
+        self.stopping = False
+
+        self.thread = None
+        if threaded:
+            self.start()
+
+    def register_metrics(self):
+        for name, attr, help in (
+                ('cosmicpi_published_total', 'published', 'Events published to the broker'),
+                ('cosmicpi_confirmed_total', 'confirmed', 'Events confirmed by the broker'),
+                ('cosmicpi_nacked_total', 'nacked', 'Events rejected by the broker'),
+                ('cosmicpi_retried_total', 'retried', 'Events published again after a nack, timeout or reconnection'),
+                ('cosmicpi_broker_connects_total', 'connects', 'Connections established to the broker')):
+            registry.counter(name, help, fn=lambda attr=attr: getattr(self, attr))
+        registry.gauge('cosmicpi_publisher_pending', 'Events waiting to be published', fn=lambda: len(self.pending))
+        registry.gauge('cosmicpi_publisher_unconfirmed', 'Events waiting for a confirmation',
+                       fn=lambda: self.unconfirmed_events)
+        self.confirm_latency = registry.histogram('cosmicpi_confirm_latency_seconds',
+                                                  'Time from publishing an event to its confirmation')
+
+    @property
+    def connected(self):
+        return self.ready
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='amqp', args=(), kwargs={})
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connect(self):
+        """Reconnection is handled by the I/O thread, just report the state."""
+        return self.ready
+
+    def run(self):
+        """Connect and run the ioloop until close() is called."""
+        self.io_thread = threading.current_thread()
+        self.open_connection()
+        self.ioloop.start()
+
+    def open_connection(self):
+        self.reconnect_scheduled = False
+        if self.stopping:
+            return
+        parameters = pika.ConnectionParameters(host=self.host, port=self.port,
+                                               credentials=pika.PlainCredentials(self.username, self.password))
+        self.connection = pika.SelectConnection(parameters, on_open_callback=self.on_connection_open,
+                                                on_open_error_callback=self.on_connection_error,
+                                                on_close_callback=self.on_connection_closed,
+                                                stop_ioloop_on_close=False, custom_ioloop=self.ioloop)
+
+    def on_connection_open(self, connection):
+        connection.channel(on_open_callback=self.on_channel_open)
+
+    def on_connection_error(self, connection, error):
+        log.error("Couldn't establish a connection to the broker at %s:%s: %s" % (self.host, self.port, error))
+        self.schedule_reconnect()
+
+    def on_connection_closed(self, connection, reply_code, reply_text):
+        if self.ready:
+            log.warn("Lost connection to the broker: (%s) %s" % (reply_code, reply_text))
+        self.ready = False
+        self.channel = None
+        if self.stopping:
+            self.ioloop.stop()
+        else:
+            self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if not self.reconnect_scheduled:
+            self.reconnect_scheduled = True
+            self.ioloop.add_timeout(self.retry_interval, self.open_connection)
+
+    def on_channel_open(self, channel):
+        self.channel = channel
+        channel.exchange_declare(self.on_exchange_declared, exchange='events', exchange_type='fanout')
+
+    def on_exchange_declared(self, frame):
+        self.channel.confirm_delivery(self.on_delivery_confirmation)
+
+        with self.lock:
+            # Delivery tags restart on a new channel, so anything still
+            # unconfirmed from the previous one has to be published again.
+            self.pending.extendleft(reversed([body for bodies, _ in self.unconfirmed.values() for body in bodies]))
+            self.retried += self.unconfirmed_events
+            self.unconfirmed.clear()
+            self.unconfirmed_events = 0
+            self.delivery_tag = 0
+
+        log.info("Connected to broker at %s:%s, publishing in batches of %d" % (self.host, self.port, self.max_batch))
+        self.connects += 1
+        self.ready = True
+        self.ioloop.add_timeout(self.linger, self.on_linger)
+
+    def on_linger(self):
+        if not self.ready:
+            return
+
+        now = time.time()
+        with self.lock:
+            expired = [tag for tag, (_, sent) in self.unconfirmed.items() if now - sent > self.confirm_timeout]
+            for tag in expired:
+                bodies = self.unconfirmed.pop(tag)[0]
+                self.pending.extend(bodies)
+                self.unconfirmed_events -= len(bodies)
+                self.retried += len(bodies)
+
+        self.flush()
+        self.ioloop.add_timeout(self.linger, self.on_linger)
+
+    def on_delivery_confirmation(self, frame):
+        method = frame.method
+        ack = method.NAME == 'Basic.Ack'
+
+        with self.lock:
+            if method.multiple:
+                tags = [tag for tag in self.unconfirmed if tag <= method.delivery_tag]
+            else:
+                tags = [method.delivery_tag] if method.delivery_tag in self.unconfirmed else []
+
+            now = time.time()
+            events = 0
+            for tag in tags:
+                bodies, sent = self.unconfirmed.pop(tag)
+                events += len(bodies)
+                if ack:
+                    self.confirm_latency.observe(now - sent)
+                else:
+                    self.pending.extend(bodies)
+            self.unconfirmed_events -= events
+
+            if ack:
+                self.confirmed += events
+            else:
+                self.nacked += events
+            if not self.pending and not self.unconfirmed_events:
+                self.settled.notify_all()
+
+    def flush(self):
+        """Publish everything that is waiting. Runs on the I/O thread."""
+        with self.lock:
+            self.flush_scheduled = False
+            if not self.ready or not self.pending:
+                return
+
+            now = time.time()
+            while self.pending:
+                if self.compressor is None:
+                    bodies = [self.pending.popleft()]
+                    body, properties = bodies[0], self.properties
+                else:
+                    bodies = [self.pending.popleft() for _ in range(min(self.max_batch, len(self.pending)))]
+                    body, headers = self.compressor.compress(bodies)
+                    properties = pika.BasicProperties(content_type=CONTENT_TYPE,
+                                                      content_encoding=self.compressor.encoding, headers=headers)
+                self.channel.basic_publish(exchange='events', routing_key='', body=body, properties=properties)
+                self.delivery_tag += 1
+                self.unconfirmed[self.delivery_tag] = (bodies, now)
+                self.unconfirmed_events += len(bodies)
+                self.published += len(bodies)
 
     def send_event_pkt(self, pkt):
-        properties = pika.BasicProperties(content_type='application/json')
-        self.channel.basic_publish(exchange='events', routing_key='', body=json.dumps(pkt), properties=properties)
+        if not self.ready:
+            raise IOError("Not connected to the broker")
+
+        with self.lock:
+            if len(self.pending) + self.unconfirmed_events >= self.max_in_flight:
+                raise IOError("Too many unconfirmed events, the broker is falling behind")
+
+            self.pending.append(pkt if self.raw_json else json.dumps(pkt))
+            schedule = len(self.pending) >= self.max_batch and not self.flush_scheduled
+            if schedule:
+                self.flush_scheduled = True
+
+        if schedule:
+            if threading.current_thread() is self.io_thread:
+                self.ioloop.add_timeout(0, self.flush)
+            else:
+                self.ioloop.add_callback_threadsafe(self.flush)
+
+    def wait_settled(self, timeout):
+        """Wait up to timeout seconds for the broker to confirm every event
+        sent, unless called from the I/O thread, which receives the confirms.
+        Returns True if none is left unconfirmed.
+        """
+        with self.settled:
+            if threading.current_thread() is not self.io_thread:
+                deadline = time.time() + timeout
+                while (self.pending or self.unconfirmed_events) and time.time() < deadline:
+                    self.settled.wait(deadline - time.time())
+            return not self.pending and not self.unconfirmed_events
+
+    def process_data_events(self):
+        """The I/O thread services the connection, nothing to do here."""
+
+    def stats(self):
+        stats = dict(pending=len(self.pending), unconfirmed=self.unconfirmed_events, published=self.published,
+                     confirmed=self.confirmed, nacked=self.nacked, retried=self.retried)
+        if self.compressor is not None:
+            stats.update(compressed_batches=self.compressor.batches, compression_ratio=round(self.compressor.ratio(), 2))
+        return stats
 
     def close(self):
-        self.connection.close()
+        self.stopping = True
+        if self.ready:
+            self.ioloop.add_callback_threadsafe(self.flush)
+            self.ioloop.add_callback_threadsafe(self.connection.close)
+        else:
+            self.ioloop.add_callback_threadsafe(self.ioloop.stop)
+        if self.thread is not None:
+            self.thread.join(5)
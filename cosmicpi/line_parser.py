@@ -0,0 +1,109 @@
+import json
+import logging
+import re
+
+from metrics import registry
+
+log = logging.getLogger(__name__)
+
+
+def number(value):
+    """Convert a value of a record that has no fixed schema."""
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+XYZ = {"x": float, "y": float, "z": float}
+
+# Field types of the records sent by the Arduino firmware. This has to be kept
+# in sync with the firmware, fields that aren't listed are converted by number().
+SCHEMA = {
+    "temperature":   {"temperature": float, "humidity": float},
+    "barometer":     {"temperature": float, "pressure": float, "altitude": float},
+    "vibration":     {"direction": int, "count": int},
+    "magnetometer":  XYZ,
+    "accelerometer": XYZ,
+    "location":      {"latitude": float, "longitude": float, "altitude": float},
+    "timing":        {"uptime": int, "counter_frequency": int, "time_string": str},
+    "status":        {"queue_size": int, "missed_events": int, "buffer_error": int, "temp_status": int,
+                      "baro_status": int, "accel_status": int, "mag_status": int, "gps_status": int},
+    "event":         {},
+}
+
+# {'record': {'field': 'value', 'field': value, ...}}
+RECORD = re.compile(r"""\s*\{\s*['"](\w+)['"]\s*:\s*\{\s*""")
+FIELD = re.compile(r"""['"](\w+)['"]\s*:\s*(?:['"]([^'"]*)['"]|([-+.\w]+))\s*(?:,\s*|\}\s*\}\s*$)""")
+
+
+class LineParser(object):
+    """Parse the records sent by the Arduino firmware into typed dicts.
+
+    Lines for the record types in SCHEMA are matched field by field with
+    precompiled expressions and converted to numbers. Anything else, or a
+    known record that doesn't have the expected flat layout, goes through the
+    generic path which rewrites the quotes and uses json.loads. Lines that
+    can't be parsed are counted per record type.
+    """
+
+    def __init__(self, labels=None):
+        self.labels = labels or {}
+        self.lines = 0
+        self.generic = 0
+        self.malformed = {}
+
+    def parse(self, line):
+        """Return {record_type: {field: value}}, or None if the line is malformed."""
+        self.lines += 1
+
+        match = RECORD.match(line)
+        if match is None:
+            return self.parse_generic(line, "unknown")
+
+        record_type = match.group(1)
+        schema = SCHEMA.get(record_type)
+        if schema is None:
+            return self.parse_generic(line, record_type)
+
+        fields = {}
+        pos = match.end()
+        end = len(line)
+        field_match = FIELD.match
+        try:
+            while pos < end:
+                field = field_match(line, pos)
+                if field is None:
+                    return self.parse_generic(line, record_type)
+                name, quoted, bare = field.groups()
+                fields[name] = schema.get(name, number)(quoted if bare is None else bare)
+                pos = field.end()
+        except ValueError:
+            return self.malformed_line(record_type, line)
+
+        return {record_type: fields}
+
+    def parse_generic(self, line, record_type):
+        try:
+            sensor = json.loads(line.strip().replace('\'', '"'))
+        except ValueError:
+            return self.malformed_line(record_type, line)
+
+        if not isinstance(sensor, dict):
+            return self.malformed_line(record_type, line)
+
+        self.generic += 1
+        return sensor
+
+    def malformed_line(self, record_type, line):
+        self.malformed[record_type] = self.malformed.get(record_type, 0) + 1
+        registry.counter('cosmicpi_parse_failures_total', 'Serial lines that could not be parsed, by record type',
+                         type=record_type, **self.labels).inc()
+        log.debug("Malformed %s record: %r" % (record_type, line))
+        return None
+
+    def stats(self):
+        return dict(lines=self.lines, generic=self.generic, malformed=dict(self.malformed))
@@ -0,0 +1,299 @@
+import calendar
+import glob
+import json
+import logging
+import operator
+import os
+import re
+import struct
+import time
+from logging.handlers import TimedRotatingFileHandler
+
+from event import infer_kind
+from line_parser import number
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'CPIDX1\n'
+HEADER = struct.Struct('<I')
+
+# Time bucket, offset of the first and after the last line, line count, kind
+RECORD = struct.Struct('<IQQIB')
+
+KINDS = ('cosmic', 'vibration', 'weather')
+
+# Bytes read before the tail of a log to infer the kinds of its events
+SEED_SIZE = 64 * 1024
+
+
+def index_path(path):
+    return path + '.idx'
+
+
+class IndexedTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """A TimedRotatingFileHandler that keeps an index of the events it logs.
+
+    Records logged with extra={'event_kind': ..., 'event_time': ...} are
+    indexed in a file next to the log (cosmicpi.log.idx). Each index record
+    covers a run of consecutive lines of one kind within one time bucket, as
+    a byte range of the log file. The record of the current run is rewritten
+    in place as the run grows, so the index is always up to date and costs
+    one small write per event. The index is renamed along with the log file
+    when it is rotated, and removed when the log file is.
+
+    Existing handlers can be upgraded with index_handlers(), so the logging
+    configuration doesn't need to change.
+    """
+
+    bucket_size = 60
+    index = None
+
+    def open_index(self):
+        path = index_path(self.baseFilename)
+        self.index = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+
+        header = self.index.read(len(MAGIC) + HEADER.size)
+        if header[:len(MAGIC)] == MAGIC:
+            self.bucket_size, = HEADER.unpack(header[len(MAGIC):])
+            size = os.fstat(self.index.fileno()).st_size - len(header)
+            self.index.truncate(len(header) + size - size % RECORD.size)  # Drop a torn record
+        else:
+            self.index.seek(0)
+            self.index.truncate()
+            self.index.write(MAGIC + HEADER.pack(self.bucket_size))
+            self.index.flush()
+
+        self.index.seek(0, os.SEEK_END)
+        self.run = None
+        self.run_offset = None
+        self.position = None
+
+    def close_index(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    def emit(self, record):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            if self.index is None:
+                self.open_index()
+
+            start = self.position
+            if start is None:
+                self.stream.flush()
+                start = os.fstat(self.stream.fileno()).st_size
+            logging.FileHandler.emit(self, record)
+            self.position = end = self.stream.tell()
+
+            kind = getattr(record, 'event_kind', None)
+            if kind in KINDS:
+                self.add(getattr(record, 'event_time', record.created), kind, start, end)
+            else:
+                self.run = None  # Only extend runs of consecutive event lines
+        except Exception:
+            self.handleError(record)
+
+    def add(self, timestamp, kind, start, end):
+        bucket = int(timestamp // self.bucket_size * self.bucket_size)
+        kind = KINDS.index(kind)
+
+        run = self.run
+        if run is not None and run[0] == bucket and run[4] == kind and run[2] == start:
+            run[2] = end
+            run[3] += 1
+            self.index.seek(self.run_offset)
+        else:
+            self.run = run = [bucket, start, end, 1, kind]
+            self.index.seek(0, os.SEEK_END)
+            self.run_offset = self.index.tell()
+
+        self.index.write(RECORD.pack(*run))
+        self.index.flush()
+
+    def doRollover(self):
+        """Rotate the log, then give its index the log's new name."""
+        inode = os.stat(self.baseFilename).st_ino if os.path.exists(self.baseFilename) else None
+        self.close_index()
+        TimedRotatingFileHandler.doRollover(self)
+
+        for path in glob.glob(self.baseFilename + '.*'):
+            if path.endswith('.idx'):
+                if not os.path.exists(path[:-4]) and path != index_path(self.baseFilename):
+                    os.remove(path)  # The log file was deleted by the rotation
+            elif inode is not None and os.stat(path).st_ino == inode and \
+                    os.path.exists(index_path(self.baseFilename)):
+                os.rename(index_path(self.baseFilename), index_path(path))
+
+    def close(self):
+        self.acquire()
+        try:
+            self.close_index()
+        finally:
+            self.release()
+        TimedRotatingFileHandler.close(self)
+
+
+def index_handlers(logger, bucket_size=60):
+    """Upgrade the TimedRotatingFileHandlers of a logger to index events."""
+    for handler in logger.handlers:
+        if isinstance(handler, TimedRotatingFileHandler):
+            handler.acquire()
+            try:
+                handler.__class__ = IndexedTimedRotatingFileHandler
+                handler.bucket_size = bucket_size
+            finally:
+                handler.release()
+            log.info("Indexing events logged to %s" % handler.baseFilename)
+
+
+def read_index(path):
+    """Return the bucket size and the records of an index file."""
+    with open(path, 'rb') as f:
+        header = f.read(len(MAGIC) + HEADER.size)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError("%s is not a log index" % path)
+        bucket_size, = HEADER.unpack(header[len(MAGIC):])
+        data = f.read()
+
+    records = [RECORD.unpack_from(data, offset)
+               for offset in range(0, len(data) - len(data) % RECORD.size, RECORD.size)]
+    return bucket_size, records
+
+
+def log_files(path):
+    """Return the rotated log files and the current one, oldest first."""
+    rotated = sorted(name for name in glob.glob(path + '.*') if not name.endswith('.idx'))
+    return rotated + ([path] if os.path.exists(path) else [])
+
+
+def parse_line(line):
+    """Return the event of a log line, and its time from the event."""
+    record = json.loads(line[line.index(b'{'):].decode('utf-8'))
+    date = record['date']
+    if 'timestamp' in date:
+        return record, date['timestamp']
+    return record, calendar.timegm(time.strptime(date['date']))
+
+
+def ranges(path, start, end, kinds):
+    """Return the (first, last, kind) byte ranges of the log file with events
+    that may match, and the offset from which the file isn't indexed.
+    """
+    if not os.path.exists(index_path(path)):
+        return [], 0
+
+    bucket_size, records = read_index(index_path(path))
+    selected = []
+    indexed = 0
+    for bucket, first, last, count, kind in records:
+        indexed = max(indexed, last)
+        if start is not None and bucket + bucket_size <= start:
+            continue
+        if end is not None and bucket >= end:
+            continue
+        if kinds is not None and KINDS[kind] not in kinds:
+            continue
+        selected.append((first, last, KINDS[kind]))
+
+    selected.sort()
+    return selected, indexed
+
+
+def query(path, start=None, end=None, kinds=None):
+    """Yield (kind, event) for the events with start <= time < end and one of
+    the given kinds, from a log file and its rotated predecessors.
+
+    Only the byte ranges the index selects are read. Files, or the tail of
+    a file, without an index are read in full, and the kind of their events
+    is inferred from the records (see event.infer_kind): it's None for the
+    events that aren't cosmic.
+    """
+    previous = {}  # detector_id: last event record, for infer_kind
+    for name in log_files(path):
+        selected, indexed = ranges(name, start, end, kinds)
+
+        with open(name, 'rb') as f:
+            for first, last, kind in selected:
+                f.seek(first)
+                for line in f.read(last - first).splitlines():
+                    event = matching(line, start, end)
+                    if event is not None:
+                        yield kind, event
+
+            if indexed:
+                # The event records of the lines just before the tail
+                seed = max(indexed - SEED_SIZE, 0)
+                f.seek(seed)
+                for line in f.read(indexed - seed).splitlines()[1 if seed else 0:]:
+                    try:
+                        infer_kind(parse_line(line)[0], previous)
+                    except (ValueError, KeyError, TypeError):
+                        pass
+
+            f.seek(indexed)
+            for line in f:
+                try:
+                    event, timestamp = parse_line(line)
+                except (ValueError, KeyError, TypeError):
+                    continue
+                kind = infer_kind(event, previous)
+                if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+                    continue
+                if kinds is None or kind in kinds:
+                    yield kind, event
+
+
+def matching(line, start, end):
+    try:
+        event, timestamp = parse_line(line)
+    except (ValueError, KeyError, TypeError):
+        return None
+    if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+        return None
+    return event
+
+
+OPERATORS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge,
+             '==': operator.eq, '!=': operator.ne}
+CONDITION = re.compile(r'^\s*([\w.]+)\s*(<=|>=|==|!=|<|>)\s*(.+?)\s*$')
+
+
+def condition(text):
+    """Return a predicate on events for a condition such as
+    'barometer.pressure>1000'. Events without the field don't match.
+    """
+    match = CONDITION.match(text)
+    if match is None:
+        raise ValueError("Invalid condition: %s" % text)
+    path, op, value = match.group(1).split('.'), OPERATORS[match.group(2)], number(match.group(3))
+
+    def predicate(event):
+        for key in path:
+            if not isinstance(event, dict) or key not in event:
+                return False
+            event = event[key]
+        try:
+            return op(number(event) if isinstance(event, basestring) else event, value)
+        except TypeError:
+            return False  # Text compared with a number in Python 3
+    return predicate
+
+
+def parse_time(text, utc=False):
+    """Parse 'YYYY-MM-DD[ HH:MM[:SS]]' as local time, or UTC."""
+    for format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            parsed = time.strptime(text, format)
+        except ValueError:
+            continue
+        return calendar.timegm(parsed) if utc else time.mktime(parsed)
+    raise ValueError("Invalid time: %s" % text)
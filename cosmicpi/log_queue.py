@@ -0,0 +1,104 @@
+"""
+Logging from a background thread.
+
+The handlers configured in logging.conf write synchronously: a log call on
+the acquisition thread waits for the console and the SD card. With
+logging.asynchronous, queue_handlers() replaces the handlers of a logger
+with a QueueHandler, which only puts each record on a bounded queue. A
+single LogQueue thread takes the records off the queue, and formats and
+emits them with the original handlers.
+
+Messages should be logged with arguments, log.info("Event: %s", event), so
+that they're only formatted on that thread, and not at all when the level
+is filtered. When the queue is full, the oldest records are dropped; the
+drops are counted in the cosmicpi_queue_drops_total{queue="logging"} metric
+and reported in the log once the thread catches up.
+
+This does for Python 2 what QueueHandler and QueueListener do in Python 3.
+"""
+
+import logging
+
+from metrics import registry
+from pipeline import BoundedQueue, Stage, DROP_OLDEST
+
+log = logging.getLogger(__name__)
+
+
+class QueueHandler(logging.Handler):
+    """Hand records to a LogQueue, to be emitted by the handlers it replaced."""
+
+    def __init__(self, log_queue, handlers):
+        logging.Handler.__init__(self, min(handler.level for handler in handlers))
+        self.log_queue = log_queue
+        self.handlers = handlers
+
+    def handle(self, record):
+        # No lock needed, the queue has its own
+        if self.filter(record):
+            self.log_queue.put(self.handlers, record)
+            return True
+        return False
+
+    def emit(self, record):
+        self.log_queue.put(self.handlers, record)
+
+    def close(self):
+        for handler in self.handlers:
+            handler.close()
+        logging.Handler.close(self)
+
+
+class LogQueue(object):
+    """A bounded queue of log records, emitted by a background thread."""
+
+    def __init__(self, maxsize=10000):
+        self.queue = BoundedQueue('logging', maxsize, DROP_OLDEST)
+        self.stage = Stage('logging', self.queue, self.emit, idle_interval=0.5)
+        self.reported = 0
+
+        registry.gauge('cosmicpi_queue_depth', 'Items waiting in a pipeline queue',
+                       fn=lambda: len(self.queue), queue=self.queue.name)
+        registry.counter('cosmicpi_queue_drops_total', 'Items dropped by a full pipeline queue',
+                         fn=lambda: self.queue.drops, queue=self.queue.name)
+
+    def put(self, handlers, record):
+        self.queue.put((handlers, record))
+
+    def emit(self, item):
+        handlers, record = item
+        for handler in handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
+
+        if self.queue.drops > self.reported and not len(self.queue):
+            dropped = self.queue.drops - self.reported
+            self.reported = self.queue.drops
+            log.warn("Dropped %d log records, logging couldn't keep up", dropped)
+
+    def start(self):
+        self.stage.start()
+
+    def stop(self):
+        """Stop the thread, then emit the records still queued."""
+        self.stage.stop()
+        while True:
+            item = self.queue.get(0)
+            if item is None:
+                break
+            self.emit(item)
+
+    def stats(self):
+        return self.queue.stats()
+
+
+def queue_handlers(logger, log_queue):
+    """Replace the handlers of a logger with one that queues its records."""
+    if not logger.handlers:
+        return
+    handler = QueueHandler(log_queue, list(logger.handlers))
+    for original in handler.handlers:
+        logger.removeHandler(original)
+    logger.addHandler(handler)
+    log.info("Logging to %s from a background thread" % ", ".join(
+        original.__class__.__name__ for original in handler.handlers))
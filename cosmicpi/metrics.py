@@ -0,0 +1,229 @@
+import bisect
+import collections
+import logging
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+log = logging.getLogger(__name__)
+
+# Upper bounds in seconds, suitable for publish and confirm latencies
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metric(object):
+    """Base class of a single, possibly labelled, metric.
+
+    Metrics don't take a lock when they are updated. Each one is expected to
+    be updated from a single thread (the one that owns the value it counts),
+    and readers only need a consistent enough view for monitoring. Values
+    that the application already keeps, such as the detector's event
+    counters, are exported through a callback instead, which costs nothing on
+    the hot path.
+    """
+
+    kind = None
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self.current = 0
+
+    def value(self):
+        return self.fn() if self.fn is not None else self.current
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1):
+        self.current += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.current = value
+
+    def inc(self, amount=1):
+        self.current += amount
+
+    def dec(self, amount=1):
+        self.current -= amount
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__()
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def value(self):
+        """Return count, sum and the cumulative count for each upper bound."""
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (float('inf'),), list(self.counts)):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return dict(count=self.count, sum=self.sum, buckets=buckets)
+
+
+class Registry(object):
+    """A collection of metrics, exported as JSON or Prometheus text.
+
+    Metrics are created or looked up by name and labels, e.g.
+    registry.counter('cosmicpi_events_total', 'Events', type='cosmic'). Asking
+    for the same name and labels again returns the existing metric, except
+    that a new callback replaces the previous one.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = collections.OrderedDict()
+
+    def get(self, cls, name, help, labels, factory):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            family = self.families.get(name)
+            if family is None:
+                family = self.families[name] = (cls.kind, help, collections.OrderedDict())
+            elif family[0] != cls.kind:
+                raise ValueError("Metric %s is already registered as a %s" % (name, family[0]))
+            metric = family[2].get(key)
+            if metric is None:
+                metric = family[2][key] = factory()
+            return metric
+
+    def counter(self, name, help, fn=None, **labels):
+        metric = self.get(Counter, name, help, labels, Counter)
+        if fn is not None:
+            metric.fn = fn
+        return metric
+
+    def gauge(self, name, help, fn=None, **labels):
+        metric = self.get(Gauge, name, help, labels, Gauge)
+        if fn is not None:
+            metric.fn = fn
+        return metric
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.get(Histogram, name, help, labels, lambda: Histogram(buckets))
+
+    def collect(self):
+        """Return (name, kind, help, [(labels, value)]) for every family."""
+        with self.lock:
+            families = [(name, kind, help, list(metrics.items()))
+                        for name, (kind, help, metrics) in self.families.items()]
+
+        result = []
+        for name, kind, help, metrics in families:
+            samples = []
+            for labels, metric in metrics:
+                try:
+                    samples.append((labels, metric.value()))
+                except Exception as e:
+                    log.debug("Couldn't collect %s: %s" % (name, e))
+            result.append((name, kind, help, samples))
+        return result
+
+    def to_dict(self):
+        """Return {name: value}, or {name: {'label=value,...': value}} for
+        labelled metrics. Histograms are dicts of count, sum and buckets.
+        """
+        result = collections.OrderedDict()
+        for name, kind, help, samples in self.collect():
+            values = collections.OrderedDict()
+            for labels, value in samples:
+                if kind == 'histogram':
+                    value = dict(count=value['count'], sum=value['sum'],
+                                 buckets=collections.OrderedDict(
+                                     (format_value(bound), count) for bound, count in value['buckets']))
+                values[",".join("%s=%s" % label for label in labels)] = value
+            result[name] = values[''] if list(values) == [''] else values
+        return result
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, help, samples in self.collect():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                if kind == 'histogram':
+                    for bound, count in value['buckets']:
+                        lines.append("%s_bucket%s %d" % (name, format_labels(labels + (('le', format_value(bound)),)),
+                                                         count))
+                    lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(value['sum'])))
+                    lines.append("%s_count%s %d" % (name, format_labels(labels), value['count']))
+                else:
+                    lines.append("%s%s %s" % (name, format_labels(labels), format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ",".join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# The registry the acquisition process exports
+registry = Registry()
+
+
+class MetricsServer(object):
+    """Serve the registry as Prometheus text on /metrics over HTTP.
+
+    The server runs on its own daemon thread and only reads metrics, so it can
+    be enabled in either run mode.
+    """
+
+    def __init__(self, registry, address, port):
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                if handler.path.split('?')[0] != '/metrics':
+                    handler.send_error(404)
+                    return
+                body = self.registry.to_prometheus().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                log.debug("Metrics request from %s: %s" % (handler.client_address[0], format % args))
+
+        self.server = HTTPServer((address, port), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', args=(), kwargs={})
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        log.info("Serving metrics on http://%s:%d/metrics" % self.server.server_address[:2])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,209 @@
+import collections
+import logging
+import marshal
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+BLOCK = 'block'
+SPILL = 'spill'
+
+OVERFLOW_POLICIES = (DROP_OLDEST, BLOCK, SPILL)
+
+
+class SpillFile(object):
+    """Append-only overflow file for a queue.
+
+    Items are marshalled, so they can be strings or tuples of plain values,
+    and stored length-prefixed. They are read back in the order they were
+    written. The file is truncated once everything has been read.
+    """
+
+    HEADER = struct.Struct('<I')
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self.read_offset = 0
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.file = open(path, 'w+b')
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        data = marshal.dumps(item)
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(self.HEADER.pack(len(data)))
+        self.file.write(data)
+        self.count += 1
+
+    def pop(self, n):
+        """Read back up to n items, oldest first."""
+        items = []
+        self.file.seek(self.read_offset)
+        while self.count and len(items) < n:
+            size, = self.HEADER.unpack(self.file.read(self.HEADER.size))
+            items.append(marshal.loads(self.file.read(size)))
+            self.count -= 1
+
+        self.read_offset = self.file.tell()
+        if not self.count:
+            self.file.seek(0)
+            self.file.truncate()
+            self.read_offset = 0
+        return items
+
+    def close(self):
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class BoundedQueue(object):
+    """A bounded FIFO connecting two pipeline stages.
+
+    When the queue is full, the overflow policy decides what happens to a new
+    item: "drop_oldest" evicts the oldest queued item, "block" makes the
+    producer wait for room, and "spill" appends the item to a file on disk
+    from which it is read back as the consumer catches up.
+    """
+
+    def __init__(self, name, maxsize, overflow=DROP_OLDEST, spill_dir=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: %s" % overflow)
+
+        self.name = name
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+
+        self.spill = None
+        if overflow == SPILL:
+            self.spill = SpillFile(os.path.join(spill_dir, "%s.spill" % name))
+
+        self.puts = 0
+        self.drops = 0
+        self.spilled = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.items) + (len(self.spill) if self.spill else 0)
+
+    def put(self, item, timeout=None):
+        """Queue an item, applying the overflow policy if the queue is full.
+
+        Returns False if the item was discarded.
+        """
+        with self.cond:
+            self.puts += 1
+
+            if self.spill is not None and (len(self.spill) or len(self.items) >= self.maxsize):
+                self.spill.append(item)
+                self.spilled += 1
+                return True
+
+            if len(self.items) >= self.maxsize:
+                if self.overflow == BLOCK:
+                    deadline = time.time() + timeout if timeout is not None else None
+                    while len(self.items) >= self.maxsize:
+                        remaining = deadline - time.time() if deadline is not None else None
+                        if remaining is not None and remaining <= 0:
+                            self.drops += 1
+                            return False
+                        self.cond.wait(remaining)
+                else:
+                    self.items.popleft()
+                    self.drops += 1
+
+            self.items.append(item)
+            self.high_water = max(self.high_water, len(self.items))
+            self.cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """Return the oldest item, or None if nothing arrived within timeout."""
+        with self.cond:
+            if not self.items:
+                self.cond.wait(timeout)
+                if not self.items:
+                    return None
+
+            item = self.items.popleft()
+
+            if self.spill is not None and len(self.spill):
+                self.items.extend(self.spill.pop(self.maxsize - len(self.items)))
+
+            self.cond.notify_all()
+            return item
+
+    def peek(self):
+        """Return the oldest item without removing it, or None."""
+        with self.cond:
+            return self.items[0] if self.items else None
+
+    def stats(self):
+        return dict(depth=len(self), capacity=self.maxsize, drops=self.drops, spilled=self.spilled,
+                    high_water=self.high_water)
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.close()
+
+
+class Stage(object):
+    """A worker thread consuming items from a queue.
+
+    The handler is called with each item. If nothing arrives within the idle
+    interval, on_idle is called instead, which gives stages a chance to do
+    housekeeping such as servicing the broker connection.
+    """
+
+    def __init__(self, name, queue, handler, on_idle=None, idle_interval=1):
+        self.name = name
+        self.queue = queue
+        self.handler = handler
+        self.on_idle = on_idle
+        self.idle_interval = idle_interval
+        self.processed = 0
+        self.errors = 0
+
+        self.thread = threading.Thread(target=self.run, name=name, args=(), kwargs={})
+        self.thread.daemon = True
+        self.stopping = False
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping:
+            item = self.queue.get(self.idle_interval)
+
+            try:
+                if item is None:
+                    if self.on_idle:
+                        self.on_idle()
+                    continue
+
+                self.handler(item)
+                self.processed += 1
+            except Exception as e:
+                self.errors += 1
+                log.warn("Error in %s stage: %s" % (self.name, e))
+
+    def stop(self):
+        self.stopping = True
+        if self.thread.is_alive():
+            self.thread.join(self.idle_interval * 2)
+        self.queue.close()
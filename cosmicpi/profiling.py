@@ -0,0 +1,316 @@
+"""
+Profiling of the acquisition: stage timings, slow event traces and sampling.
+
+With profiling.enabled (--trace), the detector times each stage an event
+goes through with perf_counter_ns():
+
+    read       from the line being read off the serial port to its parsing,
+               waiting in the read queue
+    parse      Sensors.update()
+    build      the event time and the Event
+    log        the console log call
+    serialize  the JSON, and the delta encoding
+    dispatch   handing the event to the sinks
+
+and each sink times its writes ("publish sink", "log sink", ...). The times
+feed rolling log-linear histograms in the style of HdrHistogram, which keep
+the percentiles of the last window seconds to within 3%, and are exported
+as the cosmicpi_span_seconds metric. Events slower than slow_threshold, and
+sink writes slower than it, are written to the trace file as JSON lines.
+
+Without profiling.enabled the tracer is None, and the hot path only checks
+for that.
+
+The 'profile' command samples the stacks of every thread of the running
+process for a number of seconds, and reports where they spent their time.
+cProfile only sees the thread it's started on, and the threads of the
+process are already running, so sampling is used instead.
+"""
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+from metrics import registry
+from timing import monotonic_ns
+
+# Only Python 3.7 has time.perf_counter_ns, and only Python 3 time.perf_counter.
+# time.time would step with the host clock, so Python 2 uses the monotonic clock
+try:
+    perf_counter_ns = time.perf_counter_ns
+except AttributeError:
+    if hasattr(time, 'perf_counter'):
+        def perf_counter_ns():
+            return int(time.perf_counter() * 1000000000)
+    else:
+        perf_counter_ns = monotonic_ns
+
+SPANS = ('read', 'parse', 'build', 'log', 'serialize', 'dispatch')
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class HdrHistogram(object):
+    """A histogram of integer values (ns) with log-linear buckets.
+
+    Values below 2 ** bits are counted exactly. Above, each power of two is
+    split into 2 ** (bits - 1) buckets, so a value is known to within
+    1 / 2 ** (bits - 1) of itself. Values above 2 ** highest are counted in
+    the last bucket, and negative values as 0.
+    """
+
+    def __init__(self, bits=6, highest=40):
+        self.bits = bits
+        self.half = 1 << (bits - 1)
+        self.highest = (1 << highest) - 1
+        self.counts = [0] * (self.index(self.highest) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def index(self, value):
+        shift = value.bit_length() - self.bits
+        if shift <= 0:
+            return value
+        return (shift << (self.bits - 1)) + (value >> shift)
+
+    def value_at(self, index):
+        """Return the highest value counted in a bucket."""
+        if index < 2 * self.half:
+            return index
+        shift = (index >> (self.bits - 1)) - 1
+        return ((index - (shift << (self.bits - 1)) + 1) << shift) - 1
+
+    def record(self, value):
+        if value > self.highest:
+            value = self.highest
+        elif value < 0:
+            value = 0  # A clock stepped back
+        shift = value.bit_length() - self.bits
+        self.counts[value if shift <= 0 else (shift << (self.bits - 1)) + (value >> shift)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, quantile):
+        if not self.count:
+            return 0
+        rank = max(int(quantile * self.count + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self.value_at(index), self.max)
+        return self.max
+
+    def mean(self):
+        return float(self.total) / self.count if self.count else 0.0
+
+
+class RollingHistogram(object):
+    """An HdrHistogram of the values recorded in the last window seconds,
+    kept as slices that are reset as they fall out of the window.
+    """
+
+    def __init__(self, window=60, slices=6):
+        self.slices = slices
+        self.slice_ns = int(window * 1000000000 // slices)
+        self.histograms = [HdrHistogram() for _ in range(slices)]
+        self.epochs = [None] * slices
+        self.current = self.histograms[0]
+        self.end = 0  # Of the current slice
+
+    def record(self, value, now):
+        if now >= self.end:
+            epoch = now // self.slice_ns
+            slot = epoch % self.slices
+            if self.epochs[slot] != epoch:
+                self.histograms[slot].reset()
+                self.epochs[slot] = epoch
+            self.current = self.histograms[slot]
+            self.end = (epoch + 1) * self.slice_ns
+        self.current.record(value)
+
+    def snapshot(self, now=None):
+        epoch = (perf_counter_ns() if now is None else now) // self.slice_ns
+        merged = HdrHistogram()
+        for histogram, start in zip(self.histograms, self.epochs):
+            if start is not None and epoch - self.slices < start <= epoch:
+                merged.add(histogram)
+        return merged
+
+
+class Tracer(object):
+    """Collect stage timings, and trace slow events to a file."""
+
+    def __init__(self, slow_threshold=0.1, path=None, window=60):
+        self.threshold = int(slow_threshold * 1000000000)
+        self.path = path
+        self.window = window
+        self.histograms = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.file = None
+        self.slow = 0
+        for span in SPANS:
+            self.histogram(span)
+
+        registry.counter('cosmicpi_slow_events_total', 'Events and sink writes slower than the trace threshold',
+                         fn=lambda: self.slow)
+
+    def histogram(self, span):
+        histogram = self.histograms.get(span)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.get(span)
+                if histogram is None:
+                    histogram = self.histograms[span] = RollingHistogram(self.window)
+                    for quantile in QUANTILES + (1.0,):
+                        registry.gauge('cosmicpi_span_seconds', 'Time spent in a stage of the acquisition',
+                                       fn=lambda quantile=quantile: self.percentile(span, quantile) / 1e9,
+                                       span=span, quantile=str(quantile))
+        return histogram
+
+    def percentile(self, span, quantile):
+        histogram = self.histograms[span].snapshot()
+        return histogram.max if quantile >= 1 else histogram.percentile(quantile)
+
+    def event(self, event, spans):
+        """Record the stage timings of a serial line, a list of (span, ns),
+        and of the event it triggered, or None.
+        """
+        now = perf_counter_ns()
+        total = 0
+        for span, elapsed in spans:
+            self.histograms[span].record(elapsed, now)
+            total += elapsed
+        if total > self.threshold:
+            record = dict(time=time.time(), total_us=total // 1000,
+                          spans_us=dict((span, elapsed // 1000) for span, elapsed in spans))
+            if event is not None:
+                record.update(time=event.timestamp, detector_id=event.detector_id,
+                              sequence=event.sequence['number'], kind=event.kind)
+            self.trace(record)
+
+    def span(self, span, elapsed):
+        """Record the time of one stage, outside of an event's spans."""
+        self.histogram(span).record(elapsed, perf_counter_ns())
+        if elapsed > self.threshold:
+            self.trace(dict(time=time.time(), span=span, total_us=elapsed // 1000))
+
+    def trace(self, record):
+        self.slow += 1
+        if self.path is None:
+            return
+        with self.lock:
+            if self.file is None:
+                directory = os.path.dirname(self.path)
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps(record, sort_keys=True) + '\n')
+            self.file.flush()
+
+    def stats(self):
+        """Return the count, mean and percentiles of each span in us."""
+        result = collections.OrderedDict()
+        for span, rolling in list(self.histograms.items()):
+            histogram = rolling.snapshot()
+            stats = dict(count=histogram.count, mean=round(histogram.mean() / 1000, 1),
+                         max=round(histogram.max / 1000.0, 1))
+            for quantile in QUANTILES:
+                stats['p%g' % (quantile * 100)] = round(histogram.percentile(quantile) / 1000.0, 1)
+            result[span] = stats
+        return result
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def format_spans(stats):
+    lines = ["%-16s %8s %10s %10s %10s %10s %10s %10s" % (
+        "Stage (us)", "count", "mean", "p50", "p90", "p99", "p99.9", "max")]
+    for span, span_stats in stats.items():
+        lines.append("%-16s %8d %10.1f %10.1f %10.1f %10.1f %10.1f %10.1f" % (
+            span, span_stats['count'], span_stats['mean'], span_stats['p50'], span_stats['p90'],
+            span_stats['p99'], span_stats['p99.9'], span_stats['max']))
+    return "\n".join(lines)
+
+
+class SamplingProfiler(object):
+    """Sample the stacks of all the other threads every interval seconds,
+    for duration seconds, on a thread of its own.
+    """
+
+    def __init__(self, duration, interval=0.005):
+        self.duration = duration
+        self.interval = interval
+        self.samples = 0
+        self.threads = collections.Counter()
+        self.own = collections.defaultdict(collections.Counter)  # Thread: time at the top of the stack
+        self.cumulative = collections.Counter()
+        self.finished = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='profiler', args=(), kwargs={})
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        ident = threading.current_thread().ident
+        deadline = time.time() + self.duration
+        try:
+            while time.time() < deadline:
+                names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+                for thread, frame in sys._current_frames().items():
+                    if thread != ident:
+                        self.sample(names.get(thread, str(thread)), frame)
+                self.samples += 1
+                time.sleep(self.interval)
+        finally:
+            self.finished.set()
+
+    def sample(self, thread, frame):
+        functions = []
+        while frame is not None:
+            code = frame.f_code
+            functions.append("%s:%d(%s)" % (os.path.basename(code.co_filename), code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        self.threads[thread] += 1
+        self.own[thread][functions[0]] += 1
+        for function in set(functions):
+            self.cumulative[function] += 1
+
+    def done(self):
+        return self.finished.is_set()
+
+    def report(self, limit=20):
+        total = float(sum(self.threads.values())) or 1.0
+        lines = ["Sampled %d times over %.1fs, every %.1f ms" % (self.samples, self.duration, self.interval * 1000)]
+        for thread, count in sorted(self.threads.items()):
+            lines.append("")
+            lines.append("Thread %s, %d samples, where it was:" % (thread, count))
+            for function, samples in self.own[thread].most_common(5):
+                lines.append("  %5.1f%%  %s" % (100.0 * samples / count, function))
+        lines.append("")
+        lines.append("Time spent in a function or its callees, all threads:")
+        for function, samples in self.cumulative.most_common(limit):
+            lines.append("  %5.1f%%  %s" % (100.0 * samples / total, function))
+        return "\n".join(lines)
@@ -0,0 +1,128 @@
+import errno
+import socket
+import struct
+from collections import deque
+
+# Every message on the command socket is preceded by its length
+HEADER = struct.Struct('!I')
+
+# Requests are short commands, a longer frame means the peer is broken
+MAX_MESSAGE = 1024 * 1024
+
+
+def encode(message):
+    return HEADER.pack(len(message)) + message
+
+
+def send_message(sock, message):
+    sock.sendall(encode(message))
+
+
+def receive_message(sock):
+    """Read one message from a blocking socket. Returns None if the peer closed it."""
+    header = receive_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    length, = HEADER.unpack(header)
+    return receive_exactly(sock, length)
+
+
+def receive_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class Connection(object):
+    """A non-blocking command socket connection.
+
+    Incoming bytes are buffered until complete messages are available, and
+    each message is passed to the handler. Responses are sent in the order of
+    the requests, so a client can pipeline several requests without waiting
+    for the answers. A handler that can't answer straight away calls defer()
+    to keep the place of its reply, and the messages after it wait until the
+    reply is given with reply().
+    """
+
+    def __init__(self, sock, handler):
+        self.sock = sock
+        self.handler = handler
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.pending = deque()  # [message] slots waiting for a deferred reply
+        sock.setblocking(0)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, message):
+        if self.pending:
+            self.pending.append([encode(message)])
+        else:
+            self.outbuf.extend(encode(message))
+
+    def defer(self):
+        """Keep the place of a reply that will be given later with reply()."""
+        slot = [None]
+        self.pending.append(slot)
+        return slot
+
+    def reply(self, slot, message):
+        slot[0] = encode(message)
+        while self.pending and self.pending[0][0] is not None:
+            self.outbuf.extend(self.pending.popleft()[0])
+
+    def wants_write(self):
+        return len(self.outbuf) > 0
+
+    def busy(self):
+        """True while messages are waiting to be sent."""
+        return bool(self.outbuf or self.pending)
+
+    def on_readable(self):
+        """Handle incoming data. Returns False once the connection is closed, or
+        should be because the peer sent a message longer than MAX_MESSAGE.
+        """
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            return False
+        if not data:
+            return False
+
+        self.inbuf.extend(data)
+        start = 0
+        while len(self.inbuf) - start >= HEADER.size:
+            length, = HEADER.unpack_from(self.inbuf, start)
+            if length > MAX_MESSAGE:
+                return False
+            end = start + HEADER.size + length
+            if len(self.inbuf) < end:
+                break
+            response = self.handler(self, bytes(self.inbuf[start + HEADER.size:end]))
+            if response is not None:
+                self.send(response)
+            start = end
+        del self.inbuf[:start]
+        return True
+
+    def on_writable(self):
+        """Send as much of the queued output as the socket accepts."""
+        try:
+            sent = self.sock.send(self.outbuf)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return True
+            return False
+        del self.outbuf[:sent]
+        return True
+
+    def close(self):
+        self.sock.close()
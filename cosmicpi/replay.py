@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Replay a serial capture into a pseudo-terminal, standing in for the Arduino.
+
+Run cosmicpi with --usb pointing at the pty printed on startup. To measure the
+daemon end to end, pass the event log file it writes to with --log: every
+line the daemon logs is matched, in order, with the event-producing line that
+was sent, which gives the event rate, the latency percentiles and the number
+of events that never came out. This assumes all monitoring is enabled.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import pty
+import select
+import sys
+import time
+import tty
+
+from capture import CaptureReader, monotonic
+from line_parser import RECORD
+
+# The records for which the detector publishes an event
+EVENT_RECORDS = ('vibration', 'temperature', 'event')
+
+
+class LogFollower(object):
+    """Count the lines appended to a file since it was opened."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.file.seek(0, os.SEEK_END)
+        self.partial = b''
+
+    def poll(self):
+        data = self.partial + self.file.read()
+        lines = data.split(b'\n')
+        self.partial = lines.pop()
+        return len(lines)
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(prog="cosmicpi-replay", description="Replay a serial capture into a pty")
+    parser.add_argument("capture", help="Path to the capture file")
+    parser.add_argument("-s", "--speed", type=float, default=1.0,
+                        help="Replay speed multiplier, 0 replays as fast as possible")
+    parser.add_argument("-l", "--log", help="Event log file written by cosmicpi, to measure latency")
+    parser.add_argument("-w", "--wait", type=float, default=5.0,
+                        help="Seconds to wait for the daemon to open the pty, and to catch up at the end")
+    args = parser.parse_args(argv)
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    print("Replaying %s on %s" % (args.capture, os.ttyname(slave)))
+    time.sleep(args.wait)
+
+    follower = LogFollower(args.log) if args.log else None
+    in_flight = collections.deque()
+    latencies = []
+    lines = events = 0
+
+    def collect():
+        for _ in range(follower.poll()):
+            if in_flight:
+                latencies.append(monotonic() - in_flight.popleft())
+
+    started = monotonic()
+    for offset, line in CaptureReader(args.capture):
+        if args.speed:
+            delay = started + offset / args.speed - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+        # Discard anything the daemon sends to the "Arduino"
+        while select.select([master], [], [], 0)[0]:
+            os.read(master, 4096)
+
+        os.write(master, line)
+        lines += 1
+
+        match = RECORD.match(line.decode('ascii', 'replace') if not isinstance(line, str) else line)
+        if match and match.group(1) in EVENT_RECORDS:
+            events += 1
+            in_flight.append(monotonic())
+
+        if follower:
+            collect()
+
+    elapsed = monotonic() - started
+    if follower:
+        deadline = monotonic() + args.wait
+        while in_flight and monotonic() < deadline:
+            collect()
+            time.sleep(0.001)
+
+    print("Sent %d lines (%d events) in %.2fs: %.0f lines/s" % (lines, events, elapsed, lines / elapsed))
+    if follower:
+        received = len(latencies)
+        print("Received %d events: %.0f events/s, %d dropped" % (received, received / elapsed, events - received))
+        if latencies:
+            latencies.sort()
+            print("Latency (ms): p50 %.2f p90 %.2f p99 %.2f max %.2f" % tuple(
+                1000 * x for x in (percentile(latencies, 50), percentile(latencies, 90),
+                                   percentile(latencies, 99), latencies[-1])))
+
+    os.close(master)
+    os.close(slave)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,324 @@
+"""
+Event rules: filtering and downsampling of the events a detector emits.
+
+Near machinery, vibration events can flood the broker. The rules, a list in
+the YAML configuration file, decide which events are emitted:
+
+    rules:
+      - kinds: [vibration]
+        where: accelerometer.magnitude > 1.2  # Only strong vibrations
+      - kinds: [vibration]
+        rate_limit: 2                         # At most 2 events per second,
+        burst: 10                             # and 10 in a row
+      - kinds: [cosmic]
+        sample: 1/10                          # 1 event of every 10
+      - kinds: [weather]
+        aggregate: 60                         # One summary a minute
+        fields: [temperature.temperature, barometer.pressure]
+
+Each rule has one of where, rate_limit, sample or aggregate. It applies to
+the kinds of events given (all by default), and may have a name (by
+default its type and position in the list). The rules of an event's kind
+are applied in order, on the detector's sensors before the event is built,
+and the first rule that rejects it drops it. The events dropped by each
+rule are counted in the cosmicpi_rule_dropped_total metric, and the
+summaries of aggregate rules in cosmicpi_rule_summaries_total.
+
+A where condition compares a field of a record with a number, as in
+'cosmicpi-cli query --where'. The magnitude field of records with x, y and z
+fields (accelerometer, magnetometer) is derived from them.
+
+An aggregate rule swallows the events of its kinds, and keeps the minimum,
+mean and maximum of their fields over windows of the given number of
+seconds, aligned on the clock. When a window ends, the detector emits one
+event of that kind with the current sensor values, and the statistics of
+the window in its summary:
+
+    "summary": {"start": 1467892200.0, "end": 1467892260.0, "count": 58,
+                "fields": {"barometer.pressure": {"min": 1013.1, "mean": 1013.2, "max": 1013.4}, ...}}
+
+The fields default to all the numeric fields of the records of that kind
+of event (see RECORDS).
+
+The rules are compiled once, when the detector starts.
+"""
+
+import math
+import time
+
+from line_parser import number
+from log_index import CONDITION, KINDS, OPERATORS
+from metrics import registry
+
+# The records aggregated by default for each kind of event
+RECORDS = {
+    'cosmic':    ('barometer', 'temperature'),
+    'vibration': ('vibration', 'accelerometer', 'magnetometer'),
+    'weather':   ('temperature', 'barometer'),
+}
+
+try:
+    basestring
+except NameError:
+    basestring = str
+
+
+def getter(path):
+    """Return a function of the sensors that returns the value of a field,
+    given as 'record.field', or None if there's none.
+    """
+    record, _, field = path.partition('.')
+    if not field:
+        raise ValueError("Invalid field: %s" % path)
+
+    def get(sensors):
+        values = getattr(sensors, record, None)
+        if not isinstance(values, dict):
+            return None
+        value = values.get(field)
+        if value is None and field == 'magnitude':
+            try:
+                return math.sqrt(sum(float(values[axis]) ** 2 for axis in 'xyz'))
+            except (KeyError, TypeError, ValueError):
+                return None
+        return number(value) if isinstance(value, basestring) else value
+    return get
+
+
+class Rule(object):
+    """Base class of the rules. accept() returns False to drop an event."""
+
+    type = None
+    aggregates = False  # Whether the events it drops are aggregated
+
+    def __init__(self, config, position):
+        self.name = config.get('name') or '%s-%d' % (self.type, position)
+        self.kinds = config.get('kinds') or KINDS
+        for kind in self.kinds:
+            if kind not in KINDS:
+                raise ValueError("Unknown kind of event in rule %s: %s" % (self.name, kind))
+        self.dropped = 0
+
+    def accept(self, kind, sensors, now):
+        raise NotImplementedError
+
+    def stats(self):
+        return dict(dropped=self.dropped)
+
+
+class Where(Rule):
+    """Keep the events that match a condition."""
+
+    type = 'where'
+
+    def __init__(self, config, position):
+        Rule.__init__(self, config, position)
+        match = CONDITION.match(config['where'])
+        if match is None:
+            raise ValueError("Invalid condition in rule %s: %s" % (self.name, config['where']))
+        self.get = getter(match.group(1))
+        self.op = OPERATORS[match.group(2)]
+        self.value = number(match.group(3))
+
+    def accept(self, kind, sensors, now):
+        value = self.get(sensors)
+        try:
+            return value is not None and self.op(value, self.value)
+        except TypeError:
+            return False  # Text compared with a number in Python 3
+
+
+class RateLimit(Rule):
+    """Keep at most rate_limit events per second, with bursts of up to burst
+    events (a token bucket).
+    """
+
+    type = 'rate_limit'
+
+    def __init__(self, config, position):
+        Rule.__init__(self, config, position)
+        self.rate = float(config['rate_limit'])
+        self.burst = float(config.get('burst', max(self.rate, 1.0)))
+        self.tokens = self.burst
+        self.last = None
+
+    def accept(self, kind, sensors, now):
+        if self.last is not None:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class Sample(Rule):
+    """Keep the first n of every m events, given as 'n/m'."""
+
+    type = 'sample'
+
+    def __init__(self, config, position):
+        Rule.__init__(self, config, position)
+        try:
+            n, m = [int(value) for value in str(config['sample']).split('/')]
+        except ValueError:
+            raise ValueError("Invalid sample in rule %s, expected n/m: %s" % (self.name, config['sample']))
+        if not 0 < n <= m:
+            raise ValueError("Invalid sample in rule %s: %s" % (self.name, config['sample']))
+        self.n = n
+        self.m = m
+        self.seen = 0
+
+    def accept(self, kind, sensors, now):
+        keep = self.seen < self.n
+        self.seen = (self.seen + 1) % self.m
+        return keep
+
+
+class Aggregate(Rule):
+    """Drop the events, keeping statistics of their fields over windows of
+    aggregate seconds. due() returns the summaries of the ended windows. An
+    event that arrives after its window ended, before due() was called,
+    ends it and starts the next one.
+    """
+
+    type = 'aggregate'
+    aggregates = True
+
+    def __init__(self, config, position):
+        Rule.__init__(self, config, position)
+        self.window = float(config['aggregate'])
+        if self.window <= 0:
+            raise ValueError("Invalid window in rule %s: %s" % (self.name, config['aggregate']))
+        self.paths = config.get('fields')
+        self.fields_by_kind = {}
+        self.windows = {}  # kind: [start, count, {path: [min, total, max, values]}]
+        self.ended = []  # (kind, summary) of the windows ended by an event
+        self.summaries = 0
+
+    def fields(self, kind, sensors):
+        fields = self.fields_by_kind.get(kind)
+        if fields is None:
+            # All the numeric fields of the records of this kind, as they're first seen
+            paths = self.paths
+            if paths is None:
+                paths = ['%s.%s' % (record, field) for record in RECORDS[kind]
+                         for field in sorted(getattr(sensors, record, None) or ())]
+            fields = self.fields_by_kind[kind] = [(path, getter(path)) for path in paths]
+        return fields
+
+    def accept(self, kind, sensors, now):
+        window = self.windows.get(kind)
+        if window is not None and now >= window[0] + self.window:
+            self.ended.append(self.summary(kind, window))
+            window = None
+        if window is None:
+            window = self.windows[kind] = [math.floor(now / self.window) * self.window, 0, {}]
+        window[1] += 1
+        stats = window[2]
+        for path, get in self.fields(kind, sensors):
+            value = get(sensors)
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            field = stats.get(path)
+            if field is None:
+                stats[path] = [value, value, value, 1]
+            else:
+                if value < field[0]:
+                    field[0] = value
+                if value > field[2]:
+                    field[2] = value
+                field[1] += value
+                field[3] += 1
+        return False
+
+    def next_due(self):
+        ends = ([summary['end'] for _, summary in self.ended] +
+                [window[0] + self.window for window in self.windows.values()])
+        return min(ends) if ends else None
+
+    def summary(self, kind, window):
+        start, count, stats = window
+        fields = dict((path, dict(min=low, mean=round(float(total) / n, 6), max=high))
+                      for path, (low, total, high, n) in stats.items())
+        self.summaries += 1
+        return kind, dict(start=start, end=start + self.window, count=count, fields=fields)
+
+    def due(self, now):
+        """Return (kind, summary) for each window that ended by now."""
+        summaries, self.ended = self.ended, []
+        for kind, window in list(self.windows.items()):
+            if now < window[0] + self.window:
+                continue
+            del self.windows[kind]
+            summaries.append(self.summary(kind, window))
+        return summaries
+
+    def stats(self):
+        return dict(dropped=self.dropped, summaries=self.summaries)
+
+
+RULE_TYPES = dict((rule.type, rule) for rule in (Where, RateLimit, Sample, Aggregate))
+
+
+def create_rule(config, position):
+    types = [key for key in config if key in RULE_TYPES]
+    if len(types) != 1:
+        raise ValueError("A rule needs one of %s: %s" % (", ".join(sorted(RULE_TYPES)), config))
+    return RULE_TYPES[types[0]](config, position)
+
+
+class Rules(object):
+    """The rules of a detector, compiled into a list for each kind of event."""
+
+    def __init__(self, configs, labels=None):
+        self.rules = [create_rule(config, position) for position, config in enumerate(configs, 1)]
+        names = [rule.name for rule in self.rules]
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError("More than one rule is named %s" % name)
+
+        self.by_kind = dict((kind, [rule for rule in self.rules if kind in rule.kinds]) for kind in KINDS)
+        self.aggregates = [rule for rule in self.rules if isinstance(rule, Aggregate)]
+        self.next_due = None
+
+        labels = labels or {}
+        for rule in self.rules:
+            registry.counter('cosmicpi_rule_dropped_total', 'Events dropped by a rule',
+                             fn=lambda rule=rule: rule.dropped, rule=rule.name, **labels)
+            if isinstance(rule, Aggregate):
+                registry.counter('cosmicpi_rule_summaries_total', 'Summary events emitted by an aggregate rule',
+                                 fn=lambda rule=rule: rule.summaries, rule=rule.name, **labels)
+
+    def accept(self, kind, sensors, now=None):
+        """Return True if an event of this kind should be emitted."""
+        rules = self.by_kind.get(kind)
+        if not rules:
+            return True
+        now = time.time() if now is None else now
+        for rule in rules:
+            if not rule.accept(kind, sensors, now):
+                if not rule.aggregates:
+                    rule.dropped += 1
+                elif self.next_due is None or rule.next_due() < self.next_due:
+                    self.next_due = rule.next_due()
+                return False
+        return True
+
+    def schedule(self):
+        due = [end for end in (rule.next_due() for rule in self.aggregates) if end is not None]
+        self.next_due = min(due) if due else None
+
+    def due(self, now=None):
+        """Return (kind, summary) for each aggregate window that ended."""
+        now = time.time() if now is None else now
+        if self.next_due is None or now < self.next_due:
+            return []
+        summaries = []
+        for rule in self.aggregates:
+            summaries.extend(rule.due(now))
+        self.schedule()
+        return summaries
+
+    def stats(self):
+        return dict((rule.name, rule.stats()) for rule in self.rules)
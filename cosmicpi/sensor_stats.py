@@ -0,0 +1,170 @@
+"""
+Rolling statistics of the sensor readings, kept in memory.
+
+Instead of every consumer averaging raw events, the detector keeps the
+count, sum, sum of squares, minimum and maximum of each sensor field over
+fixed time slots, at several resolutions: by default 3600 slots of a second
+(the last hour), 1440 slots of a minute (the last day) and 720 slots of an
+hour (the last month). Each resolution is a ring of NumPy arrays, one row
+per slot and one column per field. Slots are reused as time moves on, so an
+update costs the same whatever the history, and the memory is fixed,
+about 230 kB per field with the default resolutions.
+
+The statistics of the last window seconds are computed from the finest
+resolution that covers the window, to within a slot of it:
+
+    $ cosmicpi-cli stats barometer.pressure 1h
+    {"field": "barometer.pressure", "window": 3600.0, "resolution": 1.0, "count": 3598,
+     "min": 1012.8, "max": 1013.4, "mean": 1013.1, "stddev": 0.12}
+
+Windows are given in seconds, or with a unit: 30s, 10m, 1h, 7d.
+
+Values are kept relative to the first reading of each field, so that the
+standard deviation of a field with a large offset (the pressure) doesn't
+lose its precision.
+
+Needs the "analysis" extra (pip install cosmicpi[analysis]).
+"""
+
+import math
+import re
+
+from analysis import numpy, require_numpy
+
+# (slot duration in seconds, number of slots)
+RESOLUTIONS = ((1, 3600), (60, 1440), (3600, 720))
+
+FIELDS = ('temperature.temperature', 'temperature.humidity',
+          'barometer.temperature', 'barometer.pressure', 'barometer.altitude')
+
+UNITS = {'': 1, 's': 1, 'm': 60, 'h': 3600, 'd': 86400}
+DURATION = re.compile(r'^\s*(\d+(?:\.\d*)?)\s*([smhd]?)\s*$')
+
+
+def parse_window(text):
+    """Return the number of seconds of a window such as '90', '10m' or '1h'."""
+    match = DURATION.match(text)
+    if match is None:
+        raise ValueError("Invalid window: %s" % text)
+    return float(match.group(1)) * UNITS[match.group(2)]
+
+
+class Resolution(object):
+    """Statistics of each field over slots of step seconds, in a ring."""
+
+    def __init__(self, step, slots, fields):
+        self.step = step
+        self.slots = slots
+        self.epochs = numpy.full(slots, -1, dtype=numpy.int64)  # The slot number in each row
+        self.count = numpy.zeros((slots, fields), dtype=numpy.int64)
+        self.total = numpy.zeros((slots, fields), dtype=numpy.float64)
+        self.squares = numpy.zeros((slots, fields), dtype=numpy.float64)
+        self.low = numpy.full((slots, fields), numpy.inf)
+        self.high = numpy.full((slots, fields), -numpy.inf)
+
+    def add(self, timestamp, readings):
+        """Add (column, value) readings taken at a time."""
+        epoch = int(timestamp // self.step)
+        row = epoch % self.slots
+        if self.epochs[row] != epoch:
+            self.count[row] = 0
+            self.total[row] = 0.0
+            self.squares[row] = 0.0
+            self.low[row] = numpy.inf
+            self.high[row] = -numpy.inf
+            self.epochs[row] = epoch
+        count, total, squares, low, high = (self.count[row], self.total[row], self.squares[row],
+                                            self.low[row], self.high[row])
+        for column, value in readings:
+            count[column] += 1
+            total[column] += value
+            squares[column] += value * value
+            if value < low[column]:
+                low[column] = value
+            if value > high[column]:
+                high[column] = value
+
+    def span(self):
+        return self.step * self.slots
+
+    def stats(self, column, window, now):
+        """Return the count, sum, sum of squares, minimum and maximum of a
+        field over the slots of the last window seconds.
+        """
+        last = int(now // self.step)
+        first = last - min(int(math.ceil(window / float(self.step))), self.slots) + 1
+        rows = (self.epochs >= first) & (self.epochs <= last)
+        count = int(self.count[rows, column].sum())
+        return (count, float(self.total[rows, column].sum()), float(self.squares[rows, column].sum()),
+                float(self.low[rows, column].min()) if count else None,
+                float(self.high[rows, column].max()) if count else None)
+
+
+class SensorStats(object):
+    """The rolling statistics of the sensor fields of a detector."""
+
+    def __init__(self, fields=FIELDS, resolutions=RESOLUTIONS):
+        require_numpy()
+        self.fields = list(fields)
+        self.columns = dict((field, column) for column, field in enumerate(self.fields))
+        # record: (field names, their columns), to pick the fields out of a record
+        self.records = {}
+        for field in self.fields:
+            record, _, name = field.partition('.')
+            if not name:
+                raise ValueError("Invalid field: %s" % field)
+            names, columns = self.records.setdefault(record, ([], []))
+            names.append(name)
+            columns.append(self.columns[field])
+        self.offsets = [None] * len(self.fields)
+        self.resolutions = sorted((Resolution(step, slots, len(self.fields)) for step, slots in resolutions),
+                                  key=lambda resolution: resolution.step)
+        self.updates = 0
+
+    def update(self, sensor, timestamp):
+        """Add the readings of a parsed serial line, {record: {field: value}}."""
+        for record, values in sensor.items():
+            spec = self.records.get(record)
+            if spec is None or not isinstance(values, dict):
+                continue
+            names, columns = spec
+            readings = []
+            for name, column in zip(names, columns):
+                try:
+                    value = float(values[name])
+                except (KeyError, TypeError, ValueError):
+                    continue
+                offset = self.offsets[column]
+                if offset is None:
+                    offset = self.offsets[column] = value
+                readings.append((column, value - offset))
+            if not readings:
+                continue
+
+            for resolution in self.resolutions:
+                resolution.add(timestamp, readings)
+            self.updates += 1
+
+    def stats(self, field, window, now):
+        """Return the count, minimum, maximum, mean and standard deviation of a
+        field over the last window seconds, as a dict.
+        """
+        if field not in self.columns:
+            raise KeyError(field)
+        column = self.columns[field]
+        resolution = self.resolutions[-1]
+        for candidate in self.resolutions:
+            if candidate.span() >= window:
+                resolution = candidate
+                break
+        window = min(window, resolution.span())
+        count, total, squares, low, high = resolution.stats(column, window, now)
+
+        result = dict(field=field, window=window, resolution=resolution.step, count=count,
+                      min=None, max=None, mean=None, stddev=None)
+        if count:
+            offset = self.offsets[column]
+            mean = total / count
+            result.update(min=round(low + offset, 6), max=round(high + offset, 6), mean=round(mean + offset, 6),
+                          stddev=round(math.sqrt(max(squares / count - mean * mean, 0.0)), 6))
+        return result
@@ -0,0 +1,278 @@
+"""
+A ring buffer of events in shared memory, for consumers on the Pi itself.
+
+The acquisition process appends each event, as JSON, to a memory-mapped
+file (by default in /dev/shm, so it never touches the SD card). Local
+readers map the same file and follow the writer by polling its header, which
+costs a few memory reads per event and no system calls, so they see events
+within microseconds, without a broker in between.
+
+The file starts with a 64 byte header:
+
+    "CPRING1\\0", uint64 capacity, uint64 sequence,
+    uint64 reserved, uint64 position
+
+followed by capacity bytes of records, each padded to 8 bytes:
+
+    uint32 length, uint32 0, uint64 sequence, length bytes of the message
+
+position is the number of bytes written since the ring was created, and
+sequence the number of the last message written. Before writing a record,
+the writer moves reserved to its end, and after, moves position there. A
+record that doesn't fit before the end of the ring is preceded by a wrap
+marker (length 0xFFFFFFFF) and written at its start. Readers check reserved
+after copying a record, which tells them whether the writer has come round
+and overwritten it meanwhile.
+
+A reader that falls more than the capacity behind skips to the newest
+events, and counts the ones it lost. Reading:
+
+    reader = RingReader('/dev/shm/cosmicpi-events')
+    for event in reader.events():
+        ...
+"""
+
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'CPRING1\0'
+HEADER = struct.Struct('<8sQQQQ')
+HEADER_SIZE = 64
+RECORD = struct.Struct('<IIQ')
+WRAP = 0xFFFFFFFF
+ALIGNMENT = 8
+
+PATH = '/dev/shm/cosmicpi-events'
+CAPACITY = 4 * 1024 * 1024
+
+# Offsets of the header fields
+SEQUENCE = 16
+RESERVED = 24
+COUNTERS = struct.Struct('<QQQ')
+
+
+def padding(size):
+    return -size % ALIGNMENT
+
+
+class RingWriter(object):
+    """Append messages to a ring file, creating it if needed.
+
+    A ring of the same capacity left by a previous run is continued, so its
+    readers carry on. Any other file is replaced, after clearing its magic so
+    that readers still mapping it move to the new one. write() is thread-safe.
+    """
+
+    def __init__(self, path=PATH, capacity=CAPACITY):
+        if capacity % ALIGNMENT:
+            raise ValueError("The capacity of the ring must be a multiple of %d" % ALIGNMENT)
+        self.path = path
+        self.capacity = capacity
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        size = HEADER_SIZE + capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            header = os.read(fd, HEADER.size)
+            magic, existing, sequence, reserved, position = \
+                HEADER.unpack(header) if len(header) == HEADER.size else (None, None, 0, 0, 0)
+            if magic != MAGIC or existing != capacity or os.fstat(fd).st_size != size:
+                if len(header) >= len(MAGIC):
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, b'\0' * len(MAGIC))
+                os.close(fd)
+                fd = None
+                os.remove(path)
+                fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+                os.ftruncate(fd, size)
+                sequence = position = 0
+            self.map = mmap.mmap(fd, size)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+        self.sequence = sequence
+        self.position = position
+        # The magic goes in last, readers wait for it
+        COUNTERS.pack_into(self.map, SEQUENCE, sequence, position, position)
+        HEADER.pack_into(self.map, 0, MAGIC, capacity, sequence, position, position)
+
+    def write(self, message):
+        """Append a message (bytes) and return its sequence number."""
+        size = RECORD.size + len(message)
+        size += padding(size)
+        if size > self.capacity:
+            raise ValueError("Message of %d bytes too large for the ring" % len(message))
+
+        with self.lock:
+            position = self.position
+            offset = position % self.capacity
+            if self.capacity - offset < size:
+                skip = self.capacity - offset
+                struct.pack_into('<Q', self.map, RESERVED, position + skip + size)
+                if skip >= RECORD.size:
+                    RECORD.pack_into(self.map, HEADER_SIZE + offset, WRAP, 0, 0)
+                position += skip
+                offset = 0
+            else:
+                struct.pack_into('<Q', self.map, RESERVED, position + size)
+
+            sequence = self.sequence + 1
+            start = HEADER_SIZE + offset + RECORD.size
+            self.map[start:start + len(message)] = message
+            RECORD.pack_into(self.map, HEADER_SIZE + offset, len(message), 0, sequence)
+            position += size
+            COUNTERS.pack_into(self.map, SEQUENCE, sequence, position, position)
+
+            self.sequence = sequence
+            self.position = position
+            return sequence
+
+    def stats(self):
+        return dict(sequence=self.sequence, position=self.position, capacity=self.capacity)
+
+    def close(self):
+        self.map.close()
+
+
+class RingReader(object):
+    """Follow the messages written to a ring file.
+
+    Reading starts with the next message written, or if oldest is set, with
+    the oldest one written since the writer last went round the ring. poll()
+    returns the messages written since the last call without waiting, and
+    wait() waits for some, polling every interval seconds (0 to spin, which
+    avoids the sleep system call at the cost of a CPU).
+    """
+
+    def __init__(self, path=PATH, oldest=False):
+        self.path = path
+        self.rewinding = oldest
+        self.map = None
+        self.position = None
+        self.sequence = None
+        self.received = 0
+        self.lost = 0
+
+    def attach(self):
+        """Map the ring, returns False if the writer hasn't created it yet."""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            size = os.fstat(fd).st_size
+            if size <= HEADER_SIZE:
+                return False
+            self.map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        magic, capacity, sequence, reserved, position = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or HEADER_SIZE + capacity != size:
+            self.detach()
+            return False
+        self.capacity = capacity
+        self.position = position
+        self.sequence = sequence
+        if self.rewinding:
+            self.rewind()
+        return True
+
+    def detach(self):
+        if self.map is not None:
+            self.map.close()
+        self.map = None
+
+    def rewind(self):
+        """Move to the first message of the writer's current round, the
+        oldest one whose record can be found without a scan.
+        """
+        if self.position <= self.capacity:
+            self.position, self.sequence = 0, 0
+            return
+        self.position -= self.position % self.capacity
+        self.sequence = None
+
+    def poll(self):
+        """Return the messages written since the last call, as bytes."""
+        if self.map is None and not self.attach():
+            return []
+
+        magic, capacity, sequence, reserved, position = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or capacity != self.capacity or position < self.position:
+            self.detach()  # The writer started a new ring, read it from the start
+            self.rewinding = True
+            return []
+
+        messages = []
+        while self.position < position:
+            if position - self.position > self.capacity:
+                self.skip(sequence, position)
+                break
+
+            offset = self.position % self.capacity
+            if self.capacity - offset < RECORD.size:
+                self.position += self.capacity - offset
+                continue
+            length, _, number = RECORD.unpack_from(self.map, HEADER_SIZE + offset)
+            if length == WRAP:
+                self.position += self.capacity - offset
+                continue
+
+            size = RECORD.size + length
+            size += padding(size)
+            start = HEADER_SIZE + offset + RECORD.size
+            message = self.map[start:start + length]
+
+            reserved, = struct.unpack_from('<Q', self.map, RESERVED)
+            if size > self.capacity - offset or reserved - self.position > self.capacity or \
+                    (self.sequence is not None and number != self.sequence + 1):
+                self.skip(*COUNTERS.unpack_from(self.map, SEQUENCE)[:2])  # Overwritten while reading
+                break
+
+            messages.append(message)
+            self.position += size
+            self.sequence = number
+
+        self.received += len(messages)
+        return messages
+
+    def skip(self, sequence, position):
+        """Give up on the messages that were overwritten, and go on with the
+        next one written.
+        """
+        if self.sequence is not None:
+            self.lost += sequence - self.sequence
+        self.position = position
+        self.sequence = sequence
+
+    def wait(self, timeout=None, interval=0.001):
+        """Return the next messages, or an empty list after timeout seconds."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            messages = self.poll()
+            if messages or (deadline is not None and time.time() >= deadline):
+                return messages
+            if interval:
+                time.sleep(interval)
+
+    def events(self, interval=0.001):
+        """Yield the events written to the ring, decoded, forever."""
+        while True:
+            for message in self.wait(interval=interval):
+                yield json.loads(message.decode('utf-8'))
+
+    def stats(self):
+        return dict(received=self.received, lost=self.lost, sequence=self.sequence)
+
+    def close(self):
+        self.detach()
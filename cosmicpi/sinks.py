@@ -0,0 +1,575 @@
+"""
+Event sinks: the destinations events are sent to.
+
+Each sink has its own queue and worker thread (a pipeline Stage), so a slow
+or stuck sink only fills its own queue and never holds up the others. The
+sinks are configured as a list in the YAML configuration file:
+
+    sinks:
+      - type: amqp                  # The message broker, spooled while unreachable
+      - type: log                   # The event log (the "file" logger)
+      - type: archive               # The columnar archive, see archive.py
+        directory: /data/archive
+      - type: udp                   # UDP multicast, for displays on the site
+        group: 239.255.42.99
+        port: 4299
+        kinds: [cosmic]
+      - type: unix                  # A feed for local subscribers
+        path: /var/run/cosmicpi-events.sock
+      - type: ring                  # A ring in shared memory, see shared_ring.py
+        path: /dev/shm/cosmicpi-events
+      - type: stdout
+
+Every sink also takes a name (which defaults to its type, or to the name of
+the queue it replaces), the kinds of events it receives (all by default),
+and the queue_size and overflow policy of its queue. Without a sinks section,
+events go to the broker, the event log and, with archive.enabled, the
+archive, and with ring.enabled, the shared memory ring.
+
+The udp, unix, ring and stdout sinks send each event as JSON. Local
+subscribers just connect to the socket and read lines, e.g.
+
+    socat - UNIX-CONNECT:/var/run/cosmicpi-events.sock
+"""
+
+import errno
+import logging
+import os
+import socket
+import sys
+import time
+
+from archive import ArchiveWriter
+from envelope import to_bytes
+from metrics import registry
+from pipeline import BoundedQueue, Stage, DROP_OLDEST, SPILL
+from profiling import perf_counter_ns
+from shared_ring import RingWriter
+from spool import Spool, SpoolDrainer
+
+log = logging.getLogger(__name__)
+
+
+class Sink(object):
+    """Base class of the sinks.
+
+    Subclasses implement write(), which is called on the sink's worker
+    thread with what item() returned for each event. Items must be strings
+    or tuples of plain values for the queue to be able to spill them, sinks
+    that queue anything else set spillable to False.
+    """
+
+    default_name = None
+    spillable = True
+
+    def __init__(self, config, options):
+        self.name = config.get('name') or self.default_name or config['type']
+        self.kinds = config.get('kinds')
+
+        pipeline = options.pipeline
+        overflow = config.get('overflow', pipeline['overflow'])
+        if overflow == SPILL and not self.spillable:
+            overflow = DROP_OLDEST
+        maxsize = config.get('queue_size', pipeline.get(self.name + '_queue', pipeline['sink_queue']))
+        self.queue = BoundedQueue(self.name, maxsize, overflow, pipeline['spill_dir'])
+        self.stage = Stage(self.name, self.queue, self.consume, on_idle=self.on_idle)
+
+        # The publisher is only called from the event loop thread in event loop mode
+        self.inline = False
+        # Set by Sinks when the stages are being traced, see profiling.py
+        self.tracer = None
+        self.span = self.name + ' sink'
+
+        registry.counter('cosmicpi_sink_events_total', 'Events written by a sink',
+                         fn=lambda: self.stage.processed, sink=self.name)
+        registry.counter('cosmicpi_sink_errors_total', 'Events a sink failed to write',
+                         fn=lambda: self.stage.errors, sink=self.name)
+        registry.gauge('cosmicpi_sink_lag_seconds', 'Time the oldest event has been waiting for a sink',
+                       fn=self.lag, sink=self.name)
+        self.write_time = registry.histogram('cosmicpi_sink_write_seconds', 'Time taken by a sink to write an event',
+                                             sink=self.name)
+
+    def accepts(self, event, message):
+        return self.kinds is None or event.kind in self.kinds
+
+    def item(self, event, text, message):
+        """Return what to queue for an event, given its JSON text and the
+        message to publish.
+        """
+        return text
+
+    def put(self, event, text, message):
+        self.queue.put((time.time(), self.item(event, text, message)))
+
+    def put_inline(self, payload):
+        """Write an event on the calling thread, bypassing the queue."""
+        try:
+            self.consume((None, payload))
+            self.stage.processed += 1
+        except Exception as e:
+            self.stage.errors += 1
+            log.warn("Error in the %s sink: %s" % (self.name, e))
+
+    def consume(self, item):
+        start = perf_counter_ns()
+        self.write(item[1])
+        elapsed = perf_counter_ns() - start
+        self.write_time.observe(elapsed / 1e9)
+        if self.tracer is not None:
+            self.tracer.span(self.span, elapsed)
+
+    def write(self, payload):
+        raise NotImplementedError
+
+    def on_idle(self):
+        pass
+
+    def add_detector(self, detector_id, name):
+        """Called for each detector of the process, before the sink starts."""
+        pass
+
+    def lag(self):
+        oldest = self.queue.peek()
+        return max(time.time() - oldest[0], 0.0) if oldest is not None else 0.0
+
+    def start(self):
+        self.stage.start()
+
+    def stop(self):
+        self.stage.stop()
+        self.close()
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return dict(written=self.stage.processed, errors=self.stage.errors, lag=round(self.lag(), 3))
+
+
+class AmqpSink(Sink):
+    """Publish events to the broker, or to the spool while it's unreachable.
+
+    Delta-encoded events are published as their delta, and events the delta
+    encoder skipped aren't published. In event loop mode, events are
+    published from the loop thread instead of the sink's worker.
+
+    With a spool, the queue spills to disk rather than dropping events when
+    the broker falls behind, unless the sink sets its own overflow policy.
+    Every event goes through publish() in order, so the spool stays first in,
+    first out.
+    """
+
+    default_name = 'publish'
+
+    def __init__(self, config, options, sio):
+        if options.spool['enabled'] and 'overflow' not in config:
+            config = dict(config, overflow=SPILL)
+        Sink.__init__(self, config, options)
+        self.sio = sio
+        self.inline = options.event_loop['enabled']
+
+        self.retry_interval = options.spool['retry_interval']
+        self.last_attempt = 0
+
+        self.spool = None
+        if options.spool['enabled']:
+            self.spool = Spool(options.spool['directory'], options.spool['segment_size'],
+                               options.spool['max_segments'])
+            self.drainer = SpoolDrainer(self.spool, self.sio, options.spool['batch_size'],
+                                        options.spool['retry_interval'])
+
+        self.publish_latency = registry.histogram('cosmicpi_publish_latency_seconds',
+                                                  'Time taken to hand an event to the publisher')
+        registry.gauge('cosmicpi_broker_connected', 'Whether the publisher is connected to the broker',
+                       fn=lambda: self.sio.connected)
+        if self.spool is not None:
+            registry.gauge('cosmicpi_spool_pending', 'Events in the spool waiting to be published',
+                           fn=lambda: len(self.spool))
+
+    def accepts(self, event, message):
+        return message is not None and Sink.accepts(self, event, message)
+
+    def item(self, event, text, message):
+        return message
+
+    def put(self, event, text, message):
+        if self.inline:
+            self.put_inline(message)
+        else:
+            Sink.put(self, event, text, message)
+
+    def write(self, message):
+        self.publish(message)
+
+    def publish(self, pkt):
+        """Send an event, or spool it if the broker is unreachable or there
+        is already a backlog to replay first.
+        """
+        if self.spool is None:
+            self.reconnect()
+            self.send(pkt)
+            return
+
+        if not len(self.spool) and self.sio.connected:
+            try:
+                self.send(pkt)
+                return
+            except Exception as e:
+                log.warn("Couldn't publish event, spooling: %s" % e)
+
+        self.spool.append(pkt)
+        self.drainer.drain()
+
+    def send(self, pkt):
+        start = time.time()
+        self.sio.send_event_pkt(pkt)
+        self.publish_latency.observe(time.time() - start)
+
+    def reconnect(self):
+        """Without a spool, which reconnects when it replays events, try to
+        reconnect to the broker, at most once per retry interval.
+        """
+        if self.sio.connected:
+            return
+        now = time.time()
+        if now - self.last_attempt < self.retry_interval:
+            return
+        self.last_attempt = now
+        self.sio.connect()
+
+    def on_idle(self):
+        self.sio.process_data_events()
+        if self.spool is None:
+            self.reconnect()
+            return
+        while self.drainer.drain():
+            if len(self.queue):
+                break
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+
+    def stats(self):
+        stats = Sink.stats(self)
+        stats['connected'] = self.sio.connected
+        return stats
+
+
+class LogSink(Sink):
+    """Write events to the event log, while logging.enabled is set. The kind
+    and time of each event are passed on for the log index.
+    """
+
+    default_name = 'log'
+
+    def __init__(self, config, options):
+        Sink.__init__(self, config, options)
+        self.options = options
+        self.logger = logging.getLogger(config.get('logger', 'file'))
+
+    def accepts(self, event, message):
+        return self.options.logging['enabled'] and Sink.accepts(self, event, message)
+
+    def item(self, event, text, message):
+        return (event.kind, event.timestamp, text)
+
+    def write(self, item):
+        kind, timestamp, text = item
+        self.logger.info(text, extra={'event_kind': kind, 'event_time': timestamp})
+
+
+class ArchiveSink(Sink):
+    """Append events to the columnar archive, in a subdirectory per detector
+    when the process runs several.
+    """
+
+    default_name = 'archive'
+    spillable = False  # Event objects can't be spilled to disk
+
+    def __init__(self, config, options):
+        Sink.__init__(self, config, options)
+        archive = options.archive
+        self.directory = config.get('directory', archive['directory'])
+        self.chunk_size = config.get('chunk_size', archive['chunk_size'])
+        self.flush_interval = config.get('flush_interval', archive['flush_interval'])
+        self.writers = {}  # detector_id: ArchiveWriter
+
+        registry.counter('cosmicpi_archived_total', 'Events written to the archive',
+                         fn=lambda: sum(writer.events for writer in self.writers.values()))
+
+    def add_detector(self, detector_id, name):
+        directory = self.directory if name is None else os.path.join(self.directory, name)
+        self.writers[detector_id] = ArchiveWriter(directory, detector_id, self.chunk_size, self.flush_interval)
+
+    def item(self, event, text, message):
+        return event
+
+    def write(self, event):
+        self.writers[event.detector_id].append_event(event)
+
+    def on_idle(self):
+        for writer in self.writers.values():
+            writer.flush_due()
+
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+
+class UdpSink(Sink):
+    """Send each event as a UDP datagram to a multicast group."""
+
+    GROUP = '239.255.42.99'
+    PORT = 4299
+
+    def __init__(self, config, options):
+        Sink.__init__(self, config, options)
+        self.address = (config.get('group', self.GROUP), config.get('port', self.PORT))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, config.get('ttl', 1))
+        if config.get('interface'):
+            self.socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF,
+                                   socket.inet_aton(config['interface']))
+
+    def write(self, text):
+        self.socket.sendto(to_bytes(text), self.address)
+
+    def close(self):
+        self.socket.close()
+
+
+class UnixSink(Sink):
+    """Stream events to the clients of a Unix socket, one JSON line each.
+
+    Clients can connect at any time and get the events from then on. A client
+    that doesn't keep up has its events buffered, up to max_buffer bytes,
+    after which it's disconnected.
+    """
+
+    PATH = '/var/run/cosmicpi-events.sock'
+
+    def __init__(self, config, options):
+        Sink.__init__(self, config, options)
+        self.path = config.get('path', self.PATH)
+        self.max_buffer = config.get('max_buffer', 1024 * 1024)
+        self.clients = []  # [socket, bytes waiting to be sent]
+        self.disconnected = 0
+
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        self.socket.listen(16)
+        self.socket.setblocking(0)
+        log.info("Streaming events on %s" % self.path)
+
+        registry.gauge('cosmicpi_sink_clients', 'Clients connected to a sink', fn=lambda: len(self.clients),
+                       sink=self.name)
+
+    def accept(self):
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn.setblocking(0)
+            self.clients.append([conn, bytearray()])
+
+    def write(self, text):
+        self.accept()
+        line = to_bytes(text) + b'\n'
+        for client in list(self.clients):
+            client[1] += line
+            self.flush(client)
+
+    def flush(self, client):
+        conn, pending = client
+        try:
+            while pending:
+                del pending[:conn.send(pending)]
+        except socket.error as e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.disconnect(client)
+                return
+        if len(pending) > self.max_buffer:
+            log.warn("Disconnecting a client of the %s sink, it's too slow" % self.name)
+            self.disconnect(client)
+
+    def disconnect(self, client):
+        self.clients.remove(client)
+        self.disconnected += 1
+        client[0].close()
+
+    def on_idle(self):
+        self.accept()
+        for client in list(self.clients):
+            self.flush(client)
+
+    def close(self):
+        for client in self.clients:
+            client[0].close()
+        self.socket.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def stats(self):
+        stats = Sink.stats(self)
+        stats.update(clients=len(self.clients), disconnected=self.disconnected)
+        return stats
+
+
+class RingSink(Sink):
+    """Append events to a ring buffer in shared memory.
+
+    Writing to the ring never blocks, so it's done on the detector's thread
+    rather than through a queue, which would add a thread switch to the
+    latency of local readers.
+    """
+
+    def __init__(self, config, options):
+        Sink.__init__(self, config, options)
+        ring = options.ring
+        self.ring = RingWriter(config.get('path', ring['path']), config.get('capacity', ring['capacity']))
+        log.info("Writing events to the shared memory ring %s" % self.ring.path)
+
+    def put(self, event, text, message):
+        self.put_inline(text)
+
+    def write(self, text):
+        self.ring.write(to_bytes(text))
+
+    def start(self):
+        pass
+
+    def close(self):
+        self.ring.close()
+
+    def stats(self):
+        stats = Sink.stats(self)
+        stats['sequence'] = self.ring.sequence
+        return stats
+
+
+class StdoutSink(Sink):
+    """Print each event to the standard output."""
+
+    def __init__(self, config, options):
+        Sink.__init__(self, config, options)
+        self.stream = sys.stdout
+
+    def write(self, text):
+        self.stream.write(text + '\n')
+        self.stream.flush()
+
+
+SINK_TYPES = {
+    'amqp': AmqpSink,
+    'log': LogSink,
+    'archive': ArchiveSink,
+    'udp': UdpSink,
+    'unix': UnixSink,
+    'ring': RingSink,
+    'stdout': StdoutSink,
+}
+
+
+def create_sink(config, options, sio):
+    """Return the sink described by one entry of the sinks configuration."""
+    kind = config.get('type')
+    if kind not in SINK_TYPES:
+        raise ValueError("Unknown sink type: %s, use one of %s" % (kind, ", ".join(sorted(SINK_TYPES))))
+    if kind == 'amqp':
+        return AmqpSink(config, options, sio)
+    return SINK_TYPES[kind](config, options)
+
+
+class Sinks(object):
+    """The sinks shared by all the detectors of the process.
+
+    handle() puts each event on the queue of every sink that accepts it.
+    With a tracer, the sinks time their writes with it.
+    """
+
+    def __init__(self, sio, options, tracer=None):
+        self.sio = sio
+        self.options = options
+        self.tracer = tracer
+        self.sinks = [create_sink(config, options, sio) for config in options.sinks or default_sinks(options)]
+        for sink in self.sinks:
+            sink.tracer = tracer
+
+        names = [sink.name for sink in self.sinks]
+        for name in names:
+            if names.count(name) > 1:
+                raise ValueError("More than one sink is named %s" % name)
+
+        amqp = [sink for sink in self.sinks if isinstance(sink, AmqpSink)]
+        if len(amqp) > 1:
+            raise ValueError("Only one amqp sink can be configured")
+        self.amqp = amqp[0] if amqp else None
+        self.spool = self.amqp.spool if self.amqp is not None else None
+
+        self.queues = [sink.queue for sink in self.sinks]
+        self.register_metrics()
+
+    def register_metrics(self):
+        for queue in self.queues:
+            registry.gauge('cosmicpi_queue_depth', 'Items waiting in a pipeline queue',
+                           fn=lambda queue=queue: len(queue), queue=queue.name)
+            registry.counter('cosmicpi_queue_drops_total', 'Items dropped by a full pipeline queue',
+                             fn=lambda queue=queue: queue.drops, queue=queue.name)
+
+    def add_detector(self, detector_id, name=None):
+        for sink in self.sinks:
+            sink.add_detector(detector_id, name)
+
+    def start(self):
+        for sink in self.sinks:
+            sink.start()
+
+    def start_inline(self):
+        """Start the sinks that don't run on the event loop, for event loop mode."""
+        for sink in self.sinks:
+            if not sink.inline:
+                sink.start()
+
+    def stop(self):
+        for sink in self.sinks:
+            sink.stop()
+
+    def handle(self, event, text, message):
+        """Queue an event for each sink. text is its JSON, and message what
+        to publish, which may differ from it, or None if it isn't published.
+        """
+        for sink in self.sinks:
+            if sink.accepts(event, message):
+                sink.put(event, text, message)
+
+    def publish_idle(self):
+        if self.amqp is not None:
+            self.amqp.on_idle()
+
+    def pipeline_stats(self):
+        return [(queue.name, queue.stats()) for queue in self.queues]
+
+    def stats(self):
+        return dict((sink.name, sink.stats()) for sink in self.sinks)
+
+
+def default_sinks(options):
+    """Return the sinks used without a sinks section: the broker, the event
+    log and, if they're enabled, the archive and the shared memory ring.
+    """
+    sinks = [dict(type='amqp'), dict(type='log')]
+    if options.archive['enabled']:
+        sinks.append(dict(type='archive'))
+    if options.ring['enabled']:
+        sinks.append(dict(type='ring'))
+    return sinks
@@ -0,0 +1,272 @@
+import glob
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+
+class Segment(object):
+    """A fixed-size, memory-mapped spool segment file.
+
+    Records are stored back to back as (length, crc32, payload). The mapping
+    is zero-filled when the segment is created, so a zero length marks the end
+    of the written data. A record whose checksum doesn't match (e.g. a write
+    torn by a crash) also ends the segment.
+    """
+
+    RECORD = struct.Struct('<II')
+
+    def __init__(self, path, number, size):
+        self.path = path
+        self.number = number
+
+        exists = os.path.exists(path)
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(size)
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+
+        self.end = self.scan(0)[1]
+
+    def scan(self, offset, limit=None):
+        """Return the records from offset onwards, and the offset after them."""
+        records = []
+        while limit is None or len(records) < limit:
+            if offset + self.RECORD.size > self.size:
+                break
+            length, crc = self.RECORD.unpack_from(self.map, offset)
+            start = offset + self.RECORD.size
+            if length == 0 or start + length > self.size:
+                break
+            payload = self.map[start:start + length]
+            if zlib.crc32(payload) & 0xffffffff != crc:
+                break
+            records.append(payload)
+            offset = start + length
+        return records, offset
+
+    def append(self, data):
+        """Write a record at the end of the segment. Returns False if it doesn't fit."""
+        start = self.end + self.RECORD.size
+        if start + len(data) > self.size:
+            return False
+        self.map[start:start + len(data)] = data
+        self.RECORD.pack_into(self.map, self.end, len(data), zlib.crc32(data) & 0xffffffff)
+        self.end = start + len(data)
+        return True
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class Spool(object):
+    """Append-only, segment-rotated on-disk spool of serialized events.
+
+    Events are appended to the newest segment and read back oldest first. The
+    read position is only advanced by commit(), once the records have been
+    acknowledged, and is persisted by atomically replacing a small offset file,
+    so a crash at any point replays rather than loses events. Segments that
+    have been fully read are deleted. Disk usage is bounded by max_segments:
+    when it is exceeded, the oldest segment is discarded.
+    """
+
+    OFFSET = struct.Struct('<QQ')
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, max_segments=64):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+
+        self.appended = 0
+        self.committed = 0
+        self.dropped_segments = 0
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = []
+        for path in sorted(glob.glob(os.path.join(directory, 'spool-*.seg'))):
+            number = int(os.path.basename(path)[6:-4])
+            self.segments.append(Segment(path, number, segment_size))
+
+        self.read_segment, self.read_offset = self.load_offset()
+        if not self.segments:
+            self.read_offset = 0
+        while self.segments and self.segments[0].number < self.read_segment:
+            self.segments.pop(0).remove()
+        if self.segments and self.segments[0].number > self.read_segment:
+            self.read_segment, self.read_offset = self.segments[0].number, 0
+
+        self.pending = sum(len(segment.scan(self.read_offset if segment.number == self.read_segment else 0)[0])
+                           for segment in self.segments)
+        if self.pending:
+            log.info("Spool at %s holds %d unsent events" % (directory, self.pending))
+
+    def __len__(self):
+        return self.pending
+
+    def offset_path(self):
+        return os.path.join(self.directory, 'spool.offset')
+
+    def load_offset(self):
+        try:
+            with open(self.offset_path(), 'rb') as f:
+                return self.OFFSET.unpack(f.read(self.OFFSET.size))
+        except (IOError, struct.error):
+            return 0, 0
+
+    def save_offset(self):
+        tmp = self.offset_path() + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self.OFFSET.pack(self.read_segment, self.read_offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.offset_path())
+
+    def new_segment(self):
+        number = self.segments[-1].number + 1 if self.segments else self.read_segment
+        path = os.path.join(self.directory, 'spool-%08d.seg' % number)
+        self.segments.append(Segment(path, number, self.segment_size))
+
+        while len(self.segments) > self.max_segments:
+            oldest = self.segments.pop(0)
+            lost = len(oldest.scan(self.read_offset if oldest.number == self.read_segment else 0)[0])
+            oldest.remove()
+            self.pending -= lost
+            self.dropped_segments += 1
+            self.read_segment, self.read_offset = self.segments[0].number, 0
+            self.save_offset()
+            log.warn("Spool full, discarded %d events from segment %d" % (lost, oldest.number))
+
+    def append(self, data):
+        if len(data) + Segment.RECORD.size > self.segment_size:
+            raise ValueError("Event of %d bytes doesn't fit in a spool segment" % len(data))
+
+        with self.lock:
+            if not self.segments or not self.segments[-1].append(data):
+                self.new_segment()
+                self.segments[-1].append(data)
+            self.pending += 1
+            self.appended += 1
+
+    def read(self, n):
+        """Return up to n of the oldest unacknowledged records and a cursor to
+        pass to commit() once they have been delivered.
+        """
+        with self.lock:
+            records = []
+            number, offset = self.read_segment, self.read_offset
+            for segment in self.segments:
+                if segment.number < number:
+                    continue
+                if segment.number > number:
+                    number, offset = segment.number, 0
+                batch, offset = segment.scan(offset, n - len(records))
+                records.extend(batch)
+                if len(records) >= n or segment is self.segments[-1]:
+                    break
+            return records, (number, offset, len(records))
+
+    def commit(self, cursor):
+        """Mark the records returned by read() as delivered."""
+        number, offset, count = cursor
+        with self.lock:
+            if self.segments and number < self.segments[0].number:
+                return  # Segment was discarded while its records were in flight
+            self.read_segment, self.read_offset = number, offset
+            self.pending -= count
+            self.committed += count
+            while len(self.segments) > 1 and self.segments[0].number < number:
+                self.segments.pop(0).remove()
+            self.save_offset()
+
+    def stats(self):
+        return dict(pending=self.pending, segments=len(self.segments), appended=self.appended,
+                    committed=self.committed, dropped_segments=self.dropped_segments)
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+
+
+class SpoolDrainer(object):
+    """Replay spooled events through a publisher in batches.
+
+    The publisher isn't thread safe, so drain() is meant to be called from the
+    thread that owns the publisher connection. Reconnection attempts are rate
+    limited to one per retry interval.
+
+    A batch is only committed once the publisher has settled it: the
+    batching publisher just queues events until the broker confirms them, so
+    the next batch waits for the confirms of the previous one, for up to
+    SETTLE_WAIT seconds at a time off the publisher's I/O thread. If the
+    process stops before, the batch is replayed again on restart.
+    """
+
+    SETTLE_WAIT = 1.0  # Seconds
+
+    def __init__(self, spool, publisher, batch_size=100, retry_interval=10):
+        self.spool = spool
+        self.publisher = publisher
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.last_attempt = 0
+        self.cursor = None  # Of the batch waiting to be settled
+
+    def connected(self):
+        if self.publisher.connected:
+            return True
+
+        now = time.time()
+        if now - self.last_attempt < self.retry_interval:
+            return False
+        self.last_attempt = now
+        return self.publisher.connect()
+
+    def settled(self):
+        """Commit the batch sent last once the publisher has settled it.
+        Returns False while it's waiting for confirms.
+        """
+        if self.cursor is None:
+            return True
+        if not self.publisher.wait_settled(self.SETTLE_WAIT if self.publisher.connected else 0):
+            return False
+        self.spool.commit(self.cursor)
+        self.cursor = None
+        if not len(self.spool):
+            log.info("Spool drained")
+        return True
+
+    def drain(self):
+        """Replay one batch of spooled events. Returns the number sent."""
+        if not self.settled() or not len(self.spool) or not self.connected():
+            return 0
+
+        records, cursor = self.spool.read(self.batch_size)
+        for record in records:
+            try:
+                self.publisher.send_event_pkt(record)
+            except Exception as e:
+                log.warn("Spool replay interrupted: %s" % e)
+                return 0
+
+        self.cursor = cursor
+        self.settled()
+        return len(records)
@@ -0,0 +1,108 @@
+"""Helpers for the detector status report.
+
+The status is a nested dict, built by CommandHandler.status(). It is rendered
+as text for the 's' command and the CLI monitor, and flattened into dotted
+keys to send only what changed to subscribers.
+"""
+
+PIPELINE_QUEUES = ('read', 'publish', 'log')
+
+
+def flatten(status, prefix=''):
+    """Return {'section.key': value} for a nested status dict."""
+    result = {}
+    for key, value in status.items():
+        if isinstance(value, dict):
+            result.update(flatten(value, prefix + key + '.'))
+        else:
+            result[prefix + key] = value
+    return result
+
+
+def unflatten(flat):
+    result = {}
+    for key, value in flat.items():
+        node = result
+        parts = key.split('.')
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = value
+    return result
+
+
+def delta(previous, current):
+    """Return the entries of current that are new or differ from previous."""
+    return dict((key, value) for key, value in current.items() if previous.get(key) != value)
+
+
+def format_status(status):
+    arduino = status['arduino']
+    tim = arduino['timing']
+    sts = arduino['status']
+    loc = arduino['location']
+    acl = arduino['accelerometer']
+    mag = arduino['magnetometer']
+    bmp = arduino['barometer']
+    htu = arduino['temperature']
+    vib = arduino['vibration']
+
+    response = ""
+    if 'detector' in status['monitor']:
+        response += "DETECTOR %(name)s: %(detector_id)s\n" % status['monitor']['detector']
+    response += "ARDUINO STATUS\n"
+    response += "Status........: uptime:%s counter_frequency:%s queue_size:%s missed_events:%s\n" % (
+        tim["uptime"], tim["counter_frequency"], sts["queue_size"], sts["missed_events"])
+    response += ("HardwareStatus: temp_status:%s baro_status:%s accel_status:%s mag_status:%s gps_status:%s\n" % (
+        sts["temp_status"], sts["baro_status"], sts["accel_status"], sts["mag_status"], sts["gps_status"]))
+    response += ("Location......: latitude:%s longitude:%s altitude:%s\n" % (loc["latitude"], loc["longitude"], loc["altitude"]))
+    response += ("Accelerometer.: x:%s y:%s z:%s\n" % (acl["x"], acl["y"], acl["z"]))
+    response += ("Magnetometer..: x:%s y:%s z:%s\n" % (mag["x"], mag["y"], mag["z"]))
+    response += ("Barometer.....: temperature:%s pressure:%s altitude:%s\n" % (bmp["temperature"], bmp["pressure"], bmp["altitude"]))
+    response += ("Humidity......: temperature:%s humidity:%s\n" % (htu["temperature"], htu["humidity"]))
+    response += ("Vibration.....: direction:%s count:%s\n" % (vib["direction"], vib["count"]))
+
+    monitor = status['monitor']
+    serial = monitor['serial']
+    broker = monitor['broker']
+    response += ("MONITOR STATUS\n")
+    response += ("USB device....: %s\n" % (monitor['usb_device']))
+    response += ("Serial........: bytes/s:%.0f lines/s:%.1f reconnects:%d last_line:%.1fs ago\n" % (
+        serial['bytes_per_sec'], serial['lines_per_sec'], serial['reconnects'], serial['since_last_line']))
+    response += ("Remote........: Ip:%s Port:%s UdpFlag:%s\n" % (broker['host'], broker['port'], broker['enabled']))
+    response += ("Vibration.....: Sent:%d Flag:%s\n" % (monitor['vibration']['sent'], monitor['vibration']['enabled']))
+    response += ("WeatherStation: Sent:%d Flag:%s\n" % (monitor['weather']['sent'], monitor['weather']['enabled']))
+    response += ("Events........: Sent:%d LogFlag:%s\n" % (monitor['events']['sent'], monitor['events']['logging']))
+
+    parser = monitor['parser']
+    clock = monitor['clock']
+    response += ("Clock.........: source:%s offset:%s drift:%.3fppm counter_error:%.3fppm steps:%d\n" % (
+        clock['source'], "-" if clock['offset'] is None else "%.6fs" % clock['offset'], clock['drift_ppm'],
+        clock['frequency_error_ppm'], clock['steps']))
+    response += ("Parser........: lines:%d generic:%d malformed:%s\n" % (
+        parser['lines'], parser['generic'],
+        " ".join("%s:%d" % item for item in sorted(parser.get('malformed', {}).items())) or 0))
+
+    response += ("PIPELINE STATUS\n")
+    for name in PIPELINE_QUEUES + tuple(sorted(set(status['pipeline']) - set(PIPELINE_QUEUES))):
+        stats = status['pipeline'].get(name)
+        if stats is None:
+            continue  # Not every process has a publish and a log sink
+        response += ("%s: depth:%d/%d high_water:%d drops:%d spilled:%d\n" % (
+            (name.capitalize() + " queue").ljust(14, '.'), stats['depth'], stats['capacity'],
+            stats['high_water'], stats['drops'], stats['spilled']))
+    for name, stats in sorted(status.get('sinks', {}).items()):
+        response += ("%s: written:%d errors:%d lag:%.3fs%s\n" % (
+            (name.capitalize() + " sink").ljust(14, '.'), stats['written'], stats['errors'], stats['lag'],
+            "".join(" %s:%s" % item for item in sorted(stats.items()) if item[0] not in ('written', 'errors', 'lag'))))
+    response += ("Publisher.....: %s\n" % " ".join("%s:%s" % item for item in sorted(monitor['publisher'].items())))
+    if 'spool' in monitor:
+        spool = monitor['spool']
+        response += ("Spool.........: pending:%d segments:%d committed:%d dropped_segments:%d Connected:%s\n" % (
+            spool['pending'], spool['segments'], spool['committed'], spool['dropped_segments'], spool['connected']))
+    if 'delta' in monitor:
+        delta = monitor['delta']
+        response += ("Delta.........: keyframes:%d deltas:%d deduplicated:%d sent:%d/%d bytes saved:%.1f%%\n" % (
+            delta['keyframes'], delta['deltas'], delta['deduplicated'], delta['sent_bytes'], delta['full_bytes'],
+            100 * delta['savings']))
+
+    return response
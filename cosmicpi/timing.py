@@ -0,0 +1,213 @@
+"""
+Event timing: absolute event times rebuilt from the Arduino's timing records.
+
+Once a second, on the GPS pulse per second, the firmware sends a timing record
+with its uptime, the number of counter ticks in the last second
+(counter_frequency) and the GPS time of day (time_string). Each event record
+carries the counter value at the event, in ticks since that pulse. The time of
+an event is the time of the last pulse plus ticks / counter_frequency, which
+is far finer than the host clock and doesn't include the delay between the
+particle hitting the detector and the line being read.
+
+Serial lines are stamped with the host's monotonic clock when they're read,
+to measure the latency of the pipeline.
+"""
+
+import calendar
+import re
+import time
+
+
+def clock_monotonic_ns():
+    """Return a function reading CLOCK_MONOTONIC in ns through ctypes, for
+    Python 2 on Linux, or None if it isn't available.
+    """
+    try:
+        import ctypes
+        import ctypes.util
+
+        timespec = ctypes.c_long * 2  # tv_sec, tv_nsec
+        clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or 'librt.so.1').clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.c_void_p]
+    except (ImportError, OSError, AttributeError):
+        return None
+
+    def monotonic_ns():
+        ts = timespec()
+        clock_gettime(1, ts)  # CLOCK_MONOTONIC
+        return ts[0] * 1000000000 + ts[1]
+    return monotonic_ns
+
+
+# Only Python 3.7 has time.monotonic_ns, and only Python 3 time.monotonic.
+# Python 2 falls back to CLOCK_MONOTONIC, or the host clock, which can step
+try:
+    monotonic_ns = time.monotonic_ns
+except AttributeError:
+    if hasattr(time, 'monotonic'):
+        def monotonic_ns():
+            return int(time.monotonic() * 1000000000)
+    else:
+        monotonic_ns = clock_monotonic_ns() or (lambda: int(time.time() * 1000000000))
+
+# Where the time of the last pulse came from
+GPS = 'gps'        # The GPS time of day
+UPTIME = 'uptime'  # The uptime, counted from the last GPS time
+HOST = 'host'      # The host clock, no GPS time was ever received
+
+# The field of event records with the counter value at the event
+TICKS = 'ticks'
+
+TIME_OF_DAY = re.compile(r'^(\d{1,2}):?(\d\d):?(\d\d)(?:\.\d*)?$')
+DATE_TIME = re.compile(r'^(\d{4})-?(\d\d)-?(\d\d)[T ](\d{1,2}):?(\d\d):?(\d\d)(?:\.\d*)?Z?$')
+
+_date = (None, None)
+
+
+def asctime(timestamp):
+    """Return time.asctime() of a UTC time, formatted once per second."""
+    global _date
+    second = int(timestamp)
+    cached, text = _date
+    if cached != second:
+        text = time.asctime(time.gmtime(second))
+        _date = (second, text)
+    return text
+
+
+def parse_time_string(text, near):
+    """Return the UTC time of a GPS time string, or None if there is no fix.
+
+    A time of day (HH:MM:SS or HHMMSS) is taken on the day that puts it
+    closest to near, the host time, so midnight doesn't need special care.
+    """
+    text = str(text).strip()
+    match = DATE_TIME.match(text)
+    if match is not None:
+        return calendar.timegm(tuple(int(group) for group in match.groups()) + (0, 0, 0))
+
+    match = TIME_OF_DAY.match(text)
+    if match is None:
+        return None
+    hours, minutes, seconds = (int(group) for group in match.groups())
+    if hours > 23 or minutes > 59 or seconds > 60:
+        return None
+
+    second = int(near) // 86400 * 86400 + hours * 3600 + minutes * 60 + seconds
+    if second - near > 43200:
+        second -= 86400
+    elif near - second > 43200:
+        second += 86400
+    return second
+
+
+class Clock(object):
+    """Turn counter ticks into absolute event times.
+
+    update() is called with every timing record. While the GPS has a fix, the
+    time of the pulse is the GPS time. Without a fix it's counted on from the
+    last GPS time with the Arduino's uptime, and before the first fix it's
+    taken from the host clock.
+
+    The offset of the host clock from GPS time is tracked with a moving
+    average, along with its drift and the deviation of the counter frequency
+    from its average. Both are in parts per million. A jump of more than
+    step seconds is counted as a step, and restarts the drift measurement.
+    """
+
+    def __init__(self, gps=True, smoothing=0.05, step=1.0):
+        self.gps = gps
+        self.smoothing = smoothing
+        self.step = step
+
+        self.second = None      # Time of the last pulse
+        self.uptime = None
+        self.frequency = None
+        self.received = None    # Host monotonic time of the last timing record, in ns
+        self.source = HOST
+        self.anchor = None      # (GPS time, uptime) of the last pulse with a fix
+
+        self.offset = None      # Host clock - GPS time, in seconds
+        self.baseline = None    # (host time, offset) the drift is measured from
+        self.drift = 0.0
+        self.mean_frequency = None
+        self.frequency_error = 0.0
+
+        self.updates = 0
+        self.gps_updates = 0
+        self.steps = 0
+
+    def update(self, timing, received=None, fix=True, now=None):
+        """Take the pulse of a timing record, received at the given host
+        monotonic time (ns). fix is whether the GPS reports a fix.
+        """
+        received = monotonic_ns() if received is None else received
+        now = time.time() - (monotonic_ns() - received) / 1e9 if now is None else now
+        self.updates += 1
+
+        frequency = timing.get('counter_frequency')
+        if isinstance(frequency, (int, float)) and frequency > 0:
+            self.frequency = frequency
+            if self.mean_frequency is None:
+                self.mean_frequency = float(frequency)
+            self.mean_frequency += self.smoothing * (frequency - self.mean_frequency)
+            self.frequency_error = (frequency - self.mean_frequency) / self.mean_frequency * 1e6
+
+        uptime = timing.get('uptime')
+        second = parse_time_string(timing.get('time_string', ''), now) if self.gps and fix else None
+        if second is not None:
+            self.gps_updates += 1
+            self.source = GPS
+            self.anchor = (second, uptime)
+            self.track(now, now - second)
+        elif self.anchor is not None and isinstance(uptime, (int, float)) and isinstance(self.anchor[1], (int, float)):
+            self.source = UPTIME
+            second = self.anchor[0] + (uptime - self.anchor[1])
+        else:
+            self.source = HOST
+            second = now - (self.offset or 0.0)
+
+        self.second = second
+        self.uptime = uptime
+        self.received = received
+
+    def track(self, now, offset):
+        if self.offset is None or abs(offset - self.offset) > self.step:
+            if self.offset is not None:
+                self.steps += 1
+            self.offset = offset
+            self.baseline = (now, offset)
+            self.drift = 0.0
+            return
+
+        self.offset += self.smoothing * (offset - self.offset)
+        elapsed = now - self.baseline[0]
+        if elapsed >= 60:  # Too noisy before
+            self.drift = (self.offset - self.baseline[1]) / elapsed * 1e6
+
+    def timestamp(self, ticks=None, received=None):
+        """Return the time of an event and its source, from the counter value
+        at the event, or from the host time the line was received.
+        """
+        received = monotonic_ns() if received is None else received
+        if self.second is None:
+            return time.time() - (monotonic_ns() - received) / 1e9, HOST
+
+        elapsed = (received - self.received) / 1e9
+        try:
+            fraction = float(ticks) / self.frequency
+        except (TypeError, ValueError, ZeroDivisionError):
+            fraction = None
+
+        if fraction is None or not 0 <= fraction < 1.5:
+            return self.second + elapsed, self.source
+        if elapsed - fraction > 0.5:
+            # The event came after a pulse whose timing record isn't in yet
+            return self.second + 1 + fraction, self.source
+        return self.second + fraction, self.source
+
+    def stats(self):
+        return dict(source=self.source, offset=None if self.offset is None else round(self.offset, 6),
+                    drift_ppm=round(self.drift, 3), counter_frequency=self.frequency,
+                    frequency_error_ppm=round(self.frequency_error, 3), updates=self.updates,
+                    gps_updates=self.gps_updates, steps=self.steps)
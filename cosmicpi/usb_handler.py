@@ -1,19 +1,62 @@
 import logging
+import os
+import random
+import select
 import serial
 import termios
 import time
 
+from capture import CaptureWriter
+from metrics import registry
+
 log = logging.getLogger(__name__)
 
 
 class UsbHandler(object):
+    """Read lines from the Arduino's serial port.
+
+    Data is read in chunks of whatever is waiting into a reusable buffer, and
+    complete lines are split out of it, so a burst of events costs a handful
+    of system calls rather than one per byte. If the port can't be opened, or
+    no line arrives within the timeout, the port is reopened with exponential
+    backoff.
+    """
 
-    def __init__(self, usbdev, baudrate, timeout):
+    CHUNK_SIZE = 4096
+    BACKOFF_BASE = 1
+    BACKOFF_MAX = 60
+
+    def __init__(self, usbdev, baudrate, timeout, capture=None, labels=None):
         self.usbdev   = usbdev
         self.baudrate = baudrate
         self.timeout  = timeout
         self.is_open = False
         self.enabled = True
+        self.capture = CaptureWriter(capture) if capture else None
+        if self.capture:
+            log.info("Capturing serial input to %s" % capture)
+
+        self.buffer = bytearray()
+        self.start = 0
+
+        self.failures = 0
+        self.next_attempt = 0
+
+        self.bytes = 0
+        self.lines = 0
+        self.reconnects = 0
+        self.last_line = time.time()
+        self.rate_sample = (self.last_line, 0, 0)
+        self.bytes_per_sec = 0.0
+        self.lines_per_sec = 0.0
+
+        labels = labels or {}
+        registry.counter('cosmicpi_serial_bytes_total', 'Bytes read from the serial port', fn=lambda: self.bytes,
+                         **labels)
+        registry.counter('cosmicpi_serial_lines_total', 'Lines read from the serial port', fn=lambda: self.lines,
+                         **labels)
+        registry.counter('cosmicpi_serial_reconnects_total', 'Times the serial port was reopened',
+                         fn=lambda: self.reconnects, **labels)
 
     def open(self):
         self.usb = serial.Serial(port=self.usbdev, baudrate=self.baudrate, timeout=self.timeout)
@@ -22,6 +65,8 @@ class UsbHandler(object):
         termios.tcsetattr(self.usb, termios.TCSANOW, self.attr) # and write
         log.info("Serial port %s opened" % self.usbdev)
         self.is_open = True
+        self.failures = 0
+        self.last_line = time.time()
 
     def close(self):
         try:
@@ -29,6 +74,31 @@ class UsbHandler(object):
         except:
             pass
         self.is_open = False
+        del self.buffer[:]
+        self.start = 0
+        if self.capture:
+            self.capture.file.flush()
+
+    def reconnect_later(self):
+        """Close the port and schedule the next attempt to open it."""
+        self.close()
+        delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** self.failures) * random.uniform(0.5, 1.0)
+        self.failures += 1
+        self.next_attempt = time.time() + delay
+        log.info("Reopening serial port in %.1fs" % delay)
+
+    def reopen(self):
+        """Try to open the port again once the backoff delay has passed."""
+        if time.time() < self.next_attempt:
+            return False
+        try:
+            self.open()
+            self.reconnects += 1
+            return True
+        except Exception as e:
+            log.warn("Couldn't open serial port: %s" % e)
+            self.reconnect_later()
+            return False
 
     def enable(self):
         self.enabled = True
@@ -39,30 +109,109 @@ class UsbHandler(object):
         log.info("Disabling serial port")
         self.close()
 
+    def next_line(self):
+        """Split the next complete line out of the buffer, if there is one."""
+        end = self.buffer.find(b'\n', self.start)
+        if end < 0:
+            if self.start:
+                del self.buffer[:self.start]
+                self.start = 0
+            return None
+
+        line = bytes(self.buffer[self.start:end + 1])
+        self.start = end + 1
+        return line
+
+    def fill(self, timeout):
+        """Wait up to timeout for data and append everything waiting to the buffer."""
+        fd = self.usb.fileno()
+        if not select.select([fd], [], [], timeout)[0]:
+            return 0
+
+        data = os.read(fd, max(self.usb.in_waiting, self.CHUNK_SIZE))
+        if not data:
+            raise IOError("device disconnected")
+        self.buffer.extend(data)
+        self.bytes += len(data)
+
+        now = time.time()
+        sample_time, sample_bytes, sample_lines = self.rate_sample
+        if now - sample_time >= 1:
+            self.bytes_per_sec = (self.bytes - sample_bytes) / (now - sample_time)
+            self.lines_per_sec = (self.lines - sample_lines) / (now - sample_time)
+            self.rate_sample = (now, self.bytes, self.lines)
+        return len(data)
+
+    def fileno(self):
+        return self.usb.fileno()
+
     def readline(self):
+        """Return the next line, or an empty string if none arrived within a second."""
         if not self.enabled:
             time.sleep(1)
             return ''
 
         if not self.is_open:
-            try:
-                self.open()
-            except Exception as e:
-                log.warn("Couldn't open serial port: %s" % e)
-                time.sleep(1)
+            wait = self.next_attempt - time.time()
+            if wait > 0:
+                time.sleep(min(wait, 1))
+                return ''
+            if not self.reopen():
+                return ''
 
+        line = self.next_line()
         try:
-            line = self.usb.readline()
-            if len(line) == 0:
-                log.warn("Serial input buffer empty")
-                self.close()
+            while line is None:
+                if not self.fill(1):
+                    self.check_timeout()
+                    return ''
+                line = self.next_line()
 
         except Exception as e:
             log.warn("Error reading from serial port: %s" % e)
-            self.close()
-            line = ''
+            self.reconnect_later()
+            return ''
 
+        self.received(line)
         return line
 
+    def read_lines(self):
+        """Read whatever is waiting without blocking and return the complete
+        lines. Used by the event loop when the port is readable.
+        """
+        lines = []
+        try:
+            self.fill(0)
+        except Exception as e:
+            log.warn("Error reading from serial port: %s" % e)
+            self.reconnect_later()
+            return lines
+
+        line = self.next_line()
+        while line is not None:
+            self.received(line)
+            lines.append(line)
+            line = self.next_line()
+        return lines
+
+    def received(self, line):
+        self.lines += 1
+        self.last_line = time.time()
+        if self.capture:
+            self.capture.write(line)
+
+    def check_timeout(self):
+        """Reopen the port if nothing arrived within the timeout."""
+        if self.is_open and time.time() - self.last_line > self.timeout:
+            log.warn("No serial input for %ds" % self.timeout)
+            self.reconnect_later()
+
+    def stats(self):
+        idle = time.time() - self.rate_sample[0]
+        return dict(bytes=self.bytes, lines=self.lines, reconnects=self.reconnects,
+                    bytes_per_sec=self.bytes_per_sec if idle < 2 else 0.0,
+                    lines_per_sec=self.lines_per_sec if idle < 2 else 0.0,
+                    since_last_line=time.time() - self.last_line)
+
     def write(self, arg):
         self.usb.write(arg)
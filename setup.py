@@ -10,11 +10,18 @@ setup(
     packages=find_packages(),
     zip_safe=False,
     include_package_data=True,
-    install_requires=['pika', 'netifaces', 'blessings', 'cliff'],
+    install_requires=['pika>=0.12,<1.0', 'netifaces', 'blessings', 'cliff'],
+    extras_require={
+        'archive': ['numpy'],
+        'analysis': ['numpy'],
+        'lz4': ['lz4']
+    },
     entry_points={
         "console_scripts": {
             "cosmicpi = cosmicpi:main",
-            "cosmicpi-cli = cosmicpi:cli"
+            "cosmicpi-cli = cosmicpi:cli",
+            "cosmicpi-replay = cosmicpi:replay",
+            "cosmicpi-archive = cosmicpi:archive"
         }
     }
 )
@@ -0,0 +1,29 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from delta_encoding import DeltaDecoder
+
+
+class DeltaDecoderTest(unittest.TestCase):
+
+    def test_summary_isnt_carried_into_the_next_delta(self):
+        decoder = DeltaDecoder()
+        keyframe = {"detector_id": "x", "sequence": {"number": 1}, "date": {"timestamp": 1.0},
+                    "barometer": {"pressure": 1013.0}}
+        summary = {"detector_id": "x", "sequence": {"number": 2}, "date": {"timestamp": 60.0}, "delta": 1,
+                   "summary": {"start": 0.0, "end": 60.0, "count": 58, "fields": {}}}
+        delta = {"detector_id": "x", "sequence": {"number": 3}, "date": {"timestamp": 61.0}, "delta": 2}
+
+        decoder.decode(keyframe)
+        self.assertEqual(decoder.decode(summary)["summary"]["count"], 58)
+        event = decoder.decode(delta)
+        self.assertNotIn("summary", event)
+        self.assertEqual(event["barometer"], {"pressure": 1013.0})
+        self.assertEqual(event["sequence"], {"number": 3})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import socket
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from protocol import HEADER, MAX_MESSAGE, Connection, receive_message, send_message
+
+
+class ConnectionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.client, server = socket.socketpair()
+        self.deferred = []
+        self.connection = Connection(server, self.handle)
+
+    def tearDown(self):
+        self.client.close()
+        self.connection.close()
+
+    def handle(self, connection, message):
+        if message == b'later':
+            self.deferred.append(connection.defer())
+            return None
+        return message.upper()
+
+    def flush(self):
+        while self.connection.wants_write():
+            self.connection.on_writable()
+
+    def test_deferred_reply_keeps_its_place(self):
+        for message in (b'one', b'later', b'two'):
+            send_message(self.client, message)
+        self.assertTrue(self.connection.on_readable())
+        self.flush()
+        self.assertEqual(receive_message(self.client), b'ONE')
+        self.assertTrue(self.connection.busy())
+
+        self.connection.reply(self.deferred[0], b'LATER')
+        self.flush()
+        self.assertEqual(receive_message(self.client), b'LATER')
+        self.assertEqual(receive_message(self.client), b'TWO')
+        self.assertFalse(self.connection.busy())
+
+    def test_oversized_message_closes_the_connection(self):
+        self.client.sendall(HEADER.pack(MAX_MESSAGE + 1) + b'x')
+        self.assertFalse(self.connection.on_readable())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cosmicpi'))
+
+from config import get_default_config
+from sinks import AmqpSink
+
+
+class Unreachable(object):
+    """A publisher whose broker is down."""
+
+    connected = False
+
+    def connect(self):
+        return False
+
+    def send_event_pkt(self, pkt):
+        raise IOError("Not connected to the broker")
+
+    def process_data_events(self):
+        pass
+
+
+class AmqpSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.options = argparse.Namespace(**get_default_config())
+        self.options.spool['directory'] = os.path.join(self.directory, 'spool')
+        self.options.pipeline['spill_dir'] = os.path.join(self.directory, 'spill')
+        self.options.pipeline['publish_queue'] = 3
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spool_keeps_order_when_queue_is_full(self):
+        sink = AmqpSink({'type': 'amqp'}, self.options, Unreachable())
+        messages = [('{"sequence": {"number": %d}}' % i).encode('utf-8') for i in range(10)]
+        for message in messages:
+            sink.put(None, None, message)  # The worker is behind, the queue fills up
+
+        while True:
+            item = sink.queue.get(0)
+            if item is None:
+                break
+            sink.consume(item)
+
+        records, _ = sink.spool.read(100)
+        self.assertEqual([bytes(record) for record in records], messages)
+        sink.close()
+        sink.queue.close()
+
+
+if __name__ == '__main__':
+    unittest.main()